@@ -11,6 +11,7 @@
 #-------------------------------------------------------------------------------
 
 import math
+import numpy as np
 import Utilities as util
 from Vec3 import Vec3
 from LocalSpace import LocalSpace
@@ -99,6 +100,51 @@ class Agent:
     def up_reference(self, acceleration):
         return Vec3(0, 1, 0)
 
+    # Batch version of steer() and update_speed_and_local_space() for many
+    # agents whose state is stored in NumPy arrays, one row per agent: side,
+    # up, forward, position are (N,3), speed is (N,). These are updated in
+    # place. max_force, max_speed and mass may be single values or (N,) arrays.
+    # Optional up_reference(acceleration, moving) returns (N,3) reference up
+    # vectors for roll control, given acceleration*time_step and a mask of
+    # moving agents (defaults to global up, like Agent.up_reference()).
+    @staticmethod
+    def batch_steer(side, up, forward, position, speed, steering_force,
+                    time_step, max_force, max_speed, mass=1, up_reference=None):
+        # Limit steering force by max force, adjust by mass for acceleration.
+        limit_steering_force = util.truncate_rows(steering_force, max_force)
+        acceleration = limit_steering_force / np.reshape(mass, (-1, 1))
+        # Update speed, clipped to max_speed.
+        new_velocity = forward * speed[:, None]
+        new_velocity += acceleration * time_step
+        new_speed = util.length_rows(new_velocity)
+        speed[:] = np.clip(new_speed, 0, max_speed)
+        # Update geometric state of agents which are moving. (Those which are
+        # not keep their old forward, to avoid normalizing zero vectors.)
+        moving = speed > 0
+        all_moving = np.all(moving)
+        if all_moving:
+            new_forward = new_velocity / new_speed[:, None]
+        else:
+            new_forward = forward.copy()
+            new_forward[moving] = (new_velocity[moving] /
+                                   new_speed[moving, None])
+        if up_reference:
+            reference_up = up_reference(acceleration * time_step, moving)
+        else:
+            reference_up = np.broadcast_to([0.0, 1.0, 0.0], new_forward.shape)
+        (new_side, new_up) = LocalSpace.batch_rotate_to_new_forward(new_forward,
+                                                                    reference_up)
+        new_position = position + new_forward * speed[:, None] * time_step
+        if all_moving:
+            (side[:], up[:], forward[:], position[:]) = (new_side, new_up,
+                                                         new_forward,
+                                                         new_position)
+        else:
+            side[moving] = new_side[moving]
+            up[moving] = new_up[moving]
+            forward[moving] = new_forward[moving]
+            position[moving] = new_position[moving]
+
     # Given an arbitrary steering force, return the component purely lateral
     # (perpendicular) to our forward basis. This is the part that steers/turns
     # our heading but leaves speed unchanged.
@@ -162,3 +208,26 @@ class Agent:
                              1079.7517268385,
                              1041.8997370084)
         assert Vec3.is_equal_within_epsilon(agent2.position, ref_position2, e)
+
+        # Batch version matches scalar version for several agents, including
+        # one with zero speed and one given zero force.
+        rng = np.random.default_rng(1234567890)
+        agents = [Agent() for i in range(4)]
+        forces = rng.normal(size=(len(agents), 3))
+        forces[3] = 0
+        max_speed = np.array([1, 2, 3, 4], dtype=np.float64)
+        for (a, m) in zip(agents, max_speed):
+            a.max_speed = m
+        agents[0].speed = 0.5
+        def column(name):
+            return np.array([getattr(a, name).asarray() for a in agents],
+                            dtype=np.float64)
+        arrays = [column(name) for name in ['side', 'up', 'forward', 'position']]
+        speed = np.array([a.speed for a in agents], dtype=np.float64)
+        for i in range(10):
+            for (a, f) in zip(agents, forces):
+                a.steer(Vec3.from_array(f), time_step)
+            Agent.batch_steer(*arrays, speed, forces, time_step, 0.3, max_speed)
+        for (name, array) in zip(['side', 'up', 'forward', 'position'], arrays):
+            assert np.allclose(column(name), array, atol=e)
+        assert np.allclose([a.speed for a in agents], speed, atol=e)
@@ -18,6 +18,7 @@ from Vec3 import Vec3
 import Utilities as util
 import copy
 import math
+import numpy as np
 from obstacle import Collision
 
 class Boid(Agent):
@@ -44,6 +45,18 @@ class Boid(Agent):
         # Seconds between neighbor refresh (Set to zero to turn off caching.)
         self.neighbor_refresh_rate = 0.5
         self.time_since_last_neighbor_refresh = 0
+        # Optional incremental neighbor refresh: re-rank only current neighbors
+        # and their neighbors. Falls back to a full search of the flock after
+        # "full_neighbor_search_interval" incremental refreshes or when boids
+        # may have moved enough to change which are nearest (see
+        # needs_full_neighbor_search()).
+        self.incremental_neighbor_refresh = False
+        self.full_neighbor_search_interval = 4
+        self.refreshes_since_full_search = 0
+        # At last full search: time since then, and the gap between distances
+        # to the n-th nearest neighbor and the next nearest boid.
+        self.time_since_full_search = 0
+        self.full_search_gap = 0
         # For wander_steer()
         self.wander_state = Vec3()
         # Temp? Pick a random midrange boid color.
@@ -96,61 +109,58 @@ class Boid(Agent):
     def steer_to_flock(self, time_step):
         neighbors = self.nearest_neighbors(time_step)
         f = self.weight_forward * self.forward
-        s = self.weight_separate * self.steer_to_separate(neighbors)
-        a = self.weight_align * self.steer_to_align(neighbors)
-        c = self.weight_cohere * self.steer_to_cohere(neighbors)
+        (s, a, c) = self.steer_to_separate_align_cohere(neighbors)
+        s *= self.weight_separate
+        a *= self.weight_align
+        c *= self.weight_cohere
         o = self.weight_avoid * self.steer_to_avoid()
         combined_steering = self.smoothed_steering(f + s + a + c + o)
         combined_steering = self.anti_stall_adjustment(combined_steering)
         self.annotation(s, a, c, o, combined_steering)
         return combined_steering
 
-    # Steering force component to move away from neighbors.
-    def steer_to_separate(self, neighbors):
-        direction = Vec3()
-        for neighbor in neighbors:
-            offset = self.position - neighbor.position
-            dist = offset.length()
-            weight = 1 / (dist ** self.exponent_separate)
-            weight *= 1 - util.unit_sigmoid_on_01(dist / self.max_dist_separate)
-            
-            weight *= self.angle_weight(neighbor, self.angle_separate)
-            
-            direction += offset * weight
-        return direction.normalize_or_0()
-
-    # Steering force component to align path with neighbors.
-    def steer_to_align(self, neighbors):
-        direction = Vec3()
-        for neighbor in neighbors:
-            heading_offset = neighbor.forward - self.forward
-            dist = (neighbor.position - self.position).length()
-            weight = 1 / (dist ** self.exponent_align)
-            weight *= 1 - util.unit_sigmoid_on_01(dist / self.max_dist_align)
-            
-            weight *= self.angle_weight(neighbor, self.angle_align)
-
-            direction += heading_offset.normalize_or_0() * weight
-        return direction.normalize_or_0()
-
-    # Steering force component to cohere with neighbors: toward neighbor center.
-    def steer_to_cohere(self, neighbors):
-        direction = Vec3()
+    # Separation, alignment, and cohesion in one pass over neighbors. Returns
+    # three unit vectors (or zero): away from neighbors, toward their average
+    # heading, and toward their weighted center. Each neighbor's offset,
+    # distance, and projection onto my forward axis are computed only once.
+    def steer_to_separate_align_cohere(self, neighbors):
+        separate = Vec3()
+        align = Vec3()
         neighbor_center = Vec3()
         total_weight = 0
+        p = self.position
+        f = self.forward
+        # Weight of a neighbor, falling off with distance (see angle_weight()).
+        def weight(dist, projection, max_dist, exponent, cos_angle_threshold):
+            w = 1 / (dist ** exponent)
+            w *= 1 - util.unit_sigmoid_on_01(dist / max_dist)
+            return w * (1 if projection > cos_angle_threshold else 0.1)
         for neighbor in neighbors:
-            dist = (neighbor.position - self.position).length()
-            weight = 1 / (dist ** self.exponent_cohere)
-            weight *= 1 - util.unit_sigmoid_on_01(dist / self.max_dist_cohere)
-            
-            weight *= self.angle_weight(neighbor, self.angle_cohere)
-
-            neighbor_center += neighbor.position * weight
-            total_weight += weight
+            offset = p - neighbor.position
+            dist = offset.length()
+            # Same as angle_weight(): (-offset).normalize().dot(f)
+            projection = (-offset / dist).dot(f)
+            separate += offset * weight(dist, projection,
+                                        self.max_dist_separate,
+                                        self.exponent_separate,
+                                        self.angle_separate)
+            weight_align = weight(dist, projection,
+                                  self.max_dist_align,
+                                  self.exponent_align,
+                                  self.angle_align)
+            heading_offset = neighbor.forward - f
+            align += heading_offset.normalize_or_0() * weight_align
+            weight_cohere = weight(dist, projection,
+                                   self.max_dist_cohere,
+                                   self.exponent_cohere,
+                                   self.angle_cohere)
+            neighbor_center += neighbor.position * weight_cohere
+            total_weight += weight_cohere
         if total_weight > 0:
-             neighbor_center /= total_weight
-        direction = neighbor_center - self.position
-        return direction.normalize_or_0()
+            neighbor_center /= total_weight
+        return (separate.normalize_or_0(),
+                align.normalize_or_0(),
+                (neighbor_center - p).normalize_or_0())
 
     # Steering force to avoid obstacles. Takes the max of "predictive" avoidance
     # (I will collide with obstacle within Flock.min_time_to_collide seconds)
@@ -269,16 +279,80 @@ class Boid(Agent):
     def nearest_neighbors(self, time_step, n=7):
         self.time_since_last_neighbor_refresh += time_step
         if self.time_since_last_neighbor_refresh > self.neighbor_refresh_rate:
-            self.recompute_nearest_neighbors(n)
+            if self.needs_full_neighbor_search():
+                self.recompute_nearest_neighbors(n)
+            else:
+                self.incrementally_recompute_nearest_neighbors(n)
         return self.cached_nearest_neighbors
 
-    # Recomputes a cached list of the N Boids nearest this one.
+    # True if nearest_neighbors() will do a full search on this time step.
+    def full_neighbor_search_due(self, time_step):
+        return ((self.time_since_last_neighbor_refresh + time_step >
+                 self.neighbor_refresh_rate) and
+                self.needs_full_neighbor_search(time_step))
+
+    # Number of nearest boids a full search should find, for n neighbors. In
+    # incremental mode one more, see record_full_neighbor_search().
+    def full_neighbor_search_count(self, n=7):
+        return n + 1 if self.incremental_neighbor_refresh else n
+
+    # Recomputes a cached list of the N Boids nearest this one. (Flock does the
+    # search, either batched for all boids due this step, or via spatial hash.)
     def recompute_nearest_neighbors(self, n=7):
+        count = self.full_neighbor_search_count(n)
+        neighbors = self.flock.nearest_neighbors(self, count)
+        self.cached_nearest_neighbors = neighbors[:n]
+        self.time_since_last_neighbor_refresh = 0
+        if self.incremental_neighbor_refresh:
+            self.record_full_neighbor_search(neighbors, n)
+
+    # Recomputes cached nearest neighbors using only the current neighbors and
+    # their (cached) neighbors as candidates. Since a flock's neighborhoods
+    # change slowly this usually finds the same set as a full search, at a cost
+    # of O(n²) instead of O(flock size).
+    def incrementally_recompute_nearest_neighbors(self, n=7):
+        candidates = dict.fromkeys(self.cached_nearest_neighbors)
+        for neighbor in self.cached_nearest_neighbors:
+            candidates.update(dict.fromkeys(neighbor.cached_nearest_neighbors))
+        candidates.pop(self, None)
         def distance_squared_from_me(boid):
             return (boid.position - self.position).length_squared()
-        neighbors = sorted(self.flock.boids, key=distance_squared_from_me)
-        self.cached_nearest_neighbors = neighbors[1:n+1]
+        neighbors = sorted(candidates, key=distance_squared_from_me)
+        self.cached_nearest_neighbors = neighbors[:n]
+        self.time_since_full_search += self.time_since_last_neighbor_refresh
         self.time_since_last_neighbor_refresh = 0
+        self.refreshes_since_full_search += 1
+
+    # Save reference state after a full search, for needs_full_neighbor_search(),
+    # given the n+1 nearest boids found (fewer when that is the whole flock).
+    def record_full_neighbor_search(self, neighbors, n=7):
+        self.refreshes_since_full_search = 0
+        self.time_since_full_search = 0
+        self.full_search_gap = math.inf
+        if len(neighbors) > n:
+            (nth, beyond) = [(b.position - self.position).length()
+                           for b in neighbors[n - 1 : n + 1]]
+            self.full_search_gap = beyond - nth
+
+    # Decide whether next refresh of nearest neighbors must search the whole
+    # flock, rather than being done incrementally. True if incremental mode is
+    # off, on a schedule (every full_neighbor_search_interval refreshes), or
+    # when the displacement bound is reached. The distance between two boids
+    # changes by at most 2 * max_speed * elapsed time. So until that reaches
+    # half the gap between the n-th and next nearest distances at the last full
+    # search, no other boid can have become nearer than any of those neighbors,
+    # and re-ranking them (as incrementally_recompute_nearest_neighbors() does)
+    # gives the same result as a full search. "time_step" is time still to be
+    # added to time_since_last_neighbor_refresh.
+    def needs_full_neighbor_search(self, time_step=0):
+        full = True
+        if (self.incremental_neighbor_refresh and
+                self.refreshes_since_full_search <
+                    self.full_neighbor_search_interval):
+            elapsed = (self.time_since_full_search +
+                       self.time_since_last_neighbor_refresh + time_step)
+            full = 2 * self.max_speed * elapsed >= 0.5 * self.full_search_gap
+        return full
 
     # Filter collection of boids by distance.
     # (TODO 20231012 no longer used, could be removed.)
@@ -302,26 +376,6 @@ class Boid(Agent):
     def smoothed_steering(self, steer):
         return self.steer_memory.blend(steer, 0.8) # Ad hoc smoothness param.
 
-    # Draw this Boid's “body” -- currently an irregular tetrahedron.
-    def draw(self, color=None):
-        if Draw.enable:
-            center = self.position
-            nose = center + self.forward * self.body_radius
-            tail = center - self.forward * self.body_radius
-            bd = self.body_radius * 2  # body diameter (defaults to 1)
-            apex = tail + self.up * 0.25 * bd + self.forward * 0.1 * bd
-            wingtip0 = tail + self.side * 0.3 * bd
-            wingtip1 = tail - self.side * 0.3 * bd
-            # Draw the 4 triangles of a boid's body.
-            def draw_tri(a, b, c, color):
-                Draw.add_colored_triangle(a, b, c, color)
-            if color is None:
-                color = self.color
-            draw_tri(nose, apex,     wingtip1, color * 1.00)
-            draw_tri(nose, wingtip0, apex,     color * 0.95)
-            draw_tri(apex, wingtip0, wingtip1, color * 0.90)
-            draw_tri(nose, wingtip1, wingtip0, color * 0.70)
-
     # Should this Boid be annotated? (At most its those near selected boid.)
     def should_annotate(self):
         return (Draw.enable and
@@ -333,16 +387,28 @@ class Boid(Agent):
     # Draw optional annotation of this Boid's current steering forces
     def annotation(self, separation, alignment, cohesion, avoidance, combined):
         if Draw.enable:
-            scale = 0.05
-            center = self.position
-            def relative_force_annotation(offset, color):
-                Draw.add_line_segment(center, center + offset * scale, color)
             if self.should_annotate():
-                relative_force_annotation(separation, Vec3(1, 0, 0))
-                relative_force_annotation(alignment,  Vec3(0, 1, 0))
-                relative_force_annotation(cohesion,   Vec3(0, 0, 1))
-                relative_force_annotation(avoidance,  Vec3(1, 0, 1))
-                relative_force_annotation(combined,   Vec3(0.5, 0.5, 0.5))
+                Draw.add_line_segments(
+                    self.force_annotation_segments(
+                        self.position.asarray(),
+                        [f.asarray() for f in (separation, alignment,
+                                               cohesion, avoidance,
+                                               combined)]),
+                    self.force_annotation_colors)
+
+    # Endpoints of annotation lines for relative steering forces, from given
+    # (N,3) centers for a list of (N,3) forces, as (N*forces,2,3) array. Colors
+    # for each force are in force_annotation_colors: red for separation, green
+    # for alignment, blue for cohesion, magenta for avoidance, and gray for
+    # combined.
+    force_annotation_colors = [[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 0, 1],
+                               [0.5, 0.5, 0.5]]
+    @staticmethod
+    def force_annotation_segments(centers, forces, scale=0.05):
+        centers = np.reshape(centers, (-1, 3))
+        return np.stack([np.stack([centers, centers + np.reshape(f, (-1, 3)) *
+                                   scale], axis=1) for f in forces],
+                        axis=1).reshape(-1, 2, 3)
 
     def is_neighbor(self, other_boid):
         return other_boid in self.flock.selected_boid().cached_nearest_neighbors
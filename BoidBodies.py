@@ -0,0 +1,100 @@
+#-------------------------------------------------------------------------------
+#
+# BoidBodies.py -- new flock experiments
+#
+# Draws the "bodies" of all boids in a flock as one Open3D TriangleMesh whose
+# topology never changes. Each body is an irregular tetrahedron: 4 triangles,
+# each with its own 3 vertices so it can be flat shaded. Triangle
+# indices are made once (when the boid count changes) and vertex colors only
+# when boid colors change. Each frame a template tetrahedron is transformed by
+# every boid's side/up/forward basis and position in one batched matrix
+# multiply, and only the vertex array is written.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import open3d as o3d
+import numpy as np
+import Utilities as util
+from Vec3 import Vec3
+
+class BoidBodies:
+    """One mesh of all boid bodies, moved by a batched transform."""
+
+    # Corners of body for body_radius 1, in (side, up, forward) coordinates.
+    nose = (0, 0, 1)
+    apex = (0, 0.5, -0.8)
+    wingtip0 = (0.6, 0, -1)
+    wingtip1 = (-0.6, 0, -1)
+    # The 4 triangles (12 vertices) of a body, and each one's shading.
+    template = np.array([nose, apex,     wingtip1,
+                         nose, wingtip0, apex,
+                         apex, wingtip0, wingtip1,
+                         nose, wingtip1, wingtip0], dtype=np.float64)
+    shading = np.repeat([1.00, 0.95, 0.90, 0.70], 3)
+
+    def __init__(self):
+        self.tri_mesh = o3d.geometry.TriangleMesh()
+        self.boid_count = None
+        self.colors = None
+
+    # (N,12,3) array of vertices: template scaled by body radius (scalar or
+    # (N,) array) then transformed by each boid's basis and position.
+    @staticmethod
+    def body_vertices(position, side, up, forward, radius):
+        basis = np.stack([side, up, forward], axis=1)          # (N,3,3)
+        local = np.matmul(BoidBodies.template, basis)          # (N,12,3)
+        radius = np.asarray(radius, dtype=np.float64).reshape(-1, 1, 1)
+        return local * radius + np.asarray(position)[:, None, :]
+
+    # Move bodies to given (N,3) positions and basis vectors, with body radius
+    # (scalar or (N,)) and (N,3) colors. Returns (N,12,3) vertices.
+    def update(self, position, side, up, forward, radius, colors):
+        n = len(position)
+        if n != self.boid_count:
+            self.boid_count = n
+            self.colors = None
+            self.tri_mesh.triangles = o3d.utility.Vector3iVector(
+                np.arange(n * 12, dtype=np.int32).reshape(-1, 3))
+        if self.colors is None or not np.array_equal(self.colors, colors):
+            self.colors = np.array(colors, dtype=np.float64)
+            self.tri_mesh.vertex_colors = o3d.utility.Vector3dVector(
+                self.vertex_colors().reshape(-1, 3))
+        vertices = self.body_vertices(position, side, up, forward, radius)
+        self.tri_mesh.vertices = o3d.utility.Vector3dVector(
+            vertices.reshape(-1, 3))
+        return vertices
+
+    # (N,12,3) array of shaded colors for each vertex of each body.
+    def vertex_colors(self):
+        return self.colors[:, None, :] * self.shading[None, :, None]
+
+    @staticmethod
+    def unit_test():
+        # Matches body geometry built per boid with Vec3s, for random boids.
+        rng = np.random.default_rng(1234567890)
+        forward = util.normalize_rows(rng.normal(size=(5, 3)))
+        side = util.normalize_rows(util.cross_rows(rng.normal(size=(5, 3)),
+                                                   forward))
+        up = util.cross_rows(forward, side)
+        position = rng.uniform(-50, 50, (5, 3))
+        colors = rng.uniform(0, 1, (5, 3))
+        bodies = BoidBodies()
+        vertices = bodies.update(position, side, up, forward, 0.5, colors)
+        for i in range(5):
+            (p, s, u, f) = [Vec3.from_array(a[i])
+                            for a in (position, side, up, forward)]
+            r = 0.5
+            nose = p + f * r
+            tail = p - f * r
+            apex = tail + u * 0.25 * 2 * r + f * 0.1 * 2 * r
+            wingtip0 = tail + s * 0.3 * 2 * r
+            wingtip1 = tail - s * 0.3 * 2 * r
+            expected = [nose, apex, wingtip1, nose, wingtip0, apex,
+                        apex, wingtip0, wingtip1, nose, wingtip1, wingtip0]
+            assert np.allclose(vertices[i], [v.asarray() for v in expected])
+        assert np.allclose(bodies.vertex_colors()[2, 3], colors[2] * 0.95)
+        assert len(np.asarray(bodies.tri_mesh.triangles)) == 20
+        assert np.allclose(np.asarray(bodies.tri_mesh.vertices),
+                           vertices.reshape(-1, 3))
@@ -15,7 +15,8 @@ import math
 import Utilities as util  # temp?
 from Vec3 import Vec3     # temp?
 import random             # temp?
-from LocalSpace import LocalSpace
+from MeshBuilder import MeshBuilder
+import look_at
 
 class Draw:
     """Graphics utilities based on Open3D."""
@@ -32,34 +33,69 @@ class Draw:
     # Global switch to disable drawing when needed.
     enable = True
     
-    # This TriangleMesh is refilled each frame with the moving "bodies" of boids
-    # and annotation lines.
+    # This TriangleMesh is refilled each frame with annotation lines (boid
+    # bodies have their own mesh, see BoidBodies.py). Triangles are accumulated
+    # during the frame in a MeshBuilder, then assigned to the mesh all at once
+    # by update_scene(). When clear_dynamic_mesh is off, Flock draws "spacetime
+    # boid worms": trails of recent boid bodies (see Worms.py).
     dynamic_triangle_mesh = o3d.geometry.TriangleMesh()
+    dynamic_mesh_builder = MeshBuilder()
     clear_dynamic_mesh = True
 
+    # MeshBuilders for other meshes under construction, by id() of the mesh,
+    # each value is (mesh, builder). See mesh_builder() and finish_mesh().
+    mesh_builders = {}
+
+    # The boid-tracking camera moves Open3D's camera through its ViewControl
+    # (see look_at.py) when that works, and camera_lookat is where it has been
+    # moved to look at. Otherwise (older Open3D, see update_camera()):
     # TODO 20230524 since at the moment I cannot animate Open3D's camera, this
     # is a stopgap where all drawing is offset by the given "lookat" position.
+    view_control_tracking = False
+    camera_lookat = Vec3()
     temp_camera_lookat = Vec3()
 
-    # Add a single color triangle to the scene by appending it to the given
-    # TriangleMesh which defaults to Draw.dynamic_triangle_mesh
+    # For each static scene object (by id()), the object and its translation
+    # when last uploaded, see adjust_static_scene_object().
+    static_translations = {}
+
+    # Add a single color triangle to the scene by adding it to the MeshBuilder
+    # for the given TriangleMesh which defaults to Draw.dynamic_triangle_mesh.
+    # For other meshes, triangles appear after Draw.finish_mesh(tri_mesh).
     @staticmethod
     def add_colored_triangle(v1, v2, v3, color, tri_mesh=None):
-        if tri_mesh == None:
-            tri_mesh = Draw.dynamic_triangle_mesh
-        for v in [v1, v2, v3]:
-            v = v - Draw.temp_camera_lookat  # TODO 20230524 temp workaround
-            tri_mesh.vertices.append(v.asarray())
-            tri_mesh.vertex_colors.append(color.asarray())
-        t = len(tri_mesh.triangles) * 3
-        tri_mesh.triangles.append([t, t + 1, t + 2])
+        o = Draw.temp_camera_lookat  # TODO 20230524 temp workaround
+        Draw.mesh_builder(tri_mesh).add_triangle(
+            (v1.x - o.x, v1.y - o.y, v1.z - o.z),
+            (v2.x - o.x, v2.y - o.y, v2.z - o.z),
+            (v3.x - o.x, v3.y - o.y, v3.z - o.z),
+            (color.x, color.y, color.z))
+
+    # The MeshBuilder accumulating triangles for the given TriangleMesh (default
+    # Draw.dynamic_triangle_mesh).
+    @staticmethod
+    def mesh_builder(tri_mesh=None):
+        if tri_mesh == None or tri_mesh is Draw.dynamic_triangle_mesh:
+            return Draw.dynamic_mesh_builder
+        if id(tri_mesh) not in Draw.mesh_builders:
+            Draw.mesh_builders[id(tri_mesh)] = (tri_mesh, MeshBuilder())
+        return Draw.mesh_builders[id(tri_mesh)][1]
+
+    # Assign triangles accumulated for a (non-dynamic) TriangleMesh to it, in
+    # bulk, and discard its MeshBuilder. Returns the mesh.
+    @staticmethod
+    def finish_mesh(tri_mesh):
+        (mesh, builder) = Draw.mesh_builders.pop(id(tri_mesh), (None, None))
+        if builder:
+            builder.assign_to(tri_mesh)
+        return tri_mesh
 
     # TODO 20230430 line drawing support for annotation
     # given all the problems getting LineSets to draw in bright unshaded colors,
     # trying this approach drawing lines as several triangles.
     # TODO 20230426 add line drawing support for annotation
     # TODO 20230526 note that this is implicitly adjusted by temp_camera_lookat
-    #               via being layered on top of add_triangle_single_color(). If
+    #               via being layered on top of add_line_segments(). If
     #               this is ever reimplemented using Open3D's LineSet that
     #               adjustment will need to be made explicit.
     # TODO 20231222 Added cylinder end caps. This increasingly complicated
@@ -72,28 +108,55 @@ class Draw:
                          sides=3,
                          tri_mesh=None,
                          flat_end_caps=False):
-        if tri_mesh == None:
-            tri_mesh = Draw.dynamic_triangle_mesh
-        # Vector along the segment, from v1 to v2
-        offset = v2 - v1
-        distance = offset.length()
-        if distance > 0:
-            tangent = offset / distance
-            basis1 = tangent.find_perpendicular()
-            basis2 = tangent.cross(basis1)
-            # Make transform from "line segment space" to global space.
-            ls = LocalSpace(basis1, basis2, tangent, v1)
-            for i in range(sides):
-                angle_step = math.pi * 2 / sides
-                radial = Vec3(radius, 0, 0)
-                a = ls.globalize(radial.rotate_xy_about_z(angle_step * i))
-                b = ls.globalize(radial.rotate_xy_about_z(angle_step * (i+1)))
-                c = b + offset
-                d = a + offset
-                Draw.draw_quadrilateral(d, c, b, a, color, tri_mesh)
-                if flat_end_caps:
-                    Draw.add_colored_triangle(a, b, v1, color, tri_mesh)
-                    Draw.add_colored_triangle(c, d, v2, color, tri_mesh)
+        Draw.add_line_segments([[v1.asarray(), v2.asarray()]],
+                               [color.asarray()], radius, sides, tri_mesh,
+                               flat_end_caps)
+
+    # Batch version of add_line_segment(): draws M line segments, each as a
+    # "sides"-sided cylinder, given (M,2,3) endpoints, (M,3) colors, and radius
+    # (a scalar or (M,) array). All geometry is made with NumPy then added in
+    # one call to the MeshBuilder for tri_mesh. Zero length segments are
+    # skipped.
+    @staticmethod
+    def add_line_segments(endpoints, colors, radius=0.01, sides=3,
+                          tri_mesh=None, flat_end_caps=False):
+        endpoints = np.asarray(endpoints, dtype=np.float64).reshape(-1, 2, 3)
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                                 (len(endpoints),))
+        v1 = endpoints[:, 0] - Draw.temp_camera_lookat.asarray() # TODO temp
+        offset = endpoints[:, 1] - endpoints[:, 0]
+        distance = util.length_rows(offset)
+        keep = distance > 0
+        (v1, offset, distance) = (v1[keep], offset[keep], distance[keep])
+        (colors, radius) = (colors[keep], radius[keep])
+        v2 = v1 + offset
+        # Basis perpendicular to each segment (see Vec3.find_perpendicular()).
+        tangent = offset / distance[:, None]
+        parallel = util.within_epsilon(np.abs(tangent[:, 0]), 1)
+        basis1 = np.where(parallel[:, None], [0.0, 1.0, 0.0],
+                          util.normalize_rows_or_0(
+                              util.cross_rows(tangent, np.array([1.0, 0, 0]))))
+        basis2 = util.cross_rows(tangent, basis1)
+        # Ring of points around v1 (as Vec3.rotate_xy_about_z() in segment's
+        # local space) with the first repeated at the end, shape (M,sides+1,3).
+        angle = np.arange(sides + 1) * (math.pi * 2 / sides)
+        ring = (v1[:, None, :] + radius[:, None, None] *
+                (np.cos(angle)[None, :, None] * basis1[:, None, :] -
+                 np.sin(angle)[None, :, None] * basis2[:, None, :]))
+        a = ring[:, :-1]
+        b = ring[:, 1:]
+        c = b + offset[:, None, :]
+        d = a + offset[:, None, :]
+        # Triangles per side: quadrilateral d,c,b,a and optional end caps.
+        triangles = [(d, c, b), (d, b, a)]
+        if flat_end_caps:
+            triangles += [(a, b, np.broadcast_to(v1[:, None, :], a.shape)),
+                          (c, d, np.broadcast_to(v2[:, None, :], a.shape))]
+        vertices = np.stack([np.stack(t, axis=2) for t in triangles], axis=2)
+        per_segment = sides * len(triangles)
+        Draw.mesh_builder(tri_mesh).add_triangles(
+            vertices.reshape(-1, 3, 3), np.repeat(colors, per_segment, axis=0))
 
     # Draw quadrilateral as 2 tris. Assumes planar and convex but does not care.
     @staticmethod
@@ -146,6 +209,9 @@ class Draw:
 
             ctr = Draw.vis.get_view_control()
             ctr.set_constant_z_far(containment_radius * 10)
+            Draw.view_control_tracking = look_at.view_control_is_writable(
+                Draw.vis)
+            Draw.camera_lookat = Vec3()
 
     # Close visualizer after simulation run.
     @staticmethod
@@ -153,12 +219,12 @@ class Draw:
         if Draw.enable:
             Draw.vis.destroy_window()
 
-    # Clear all flock geometry held in a TriangleMesh.
+    # Clear all flock geometry held in a TriangleMesh. (Trails for "spacetime
+    # boid worms" are kept in Flock.worms, with bounded size, instead.)
     @staticmethod
     def clear_scene():
         if Draw.enable:
-            if Draw.clear_dynamic_mesh:
-                Draw.dynamic_triangle_mesh.clear()
+            Draw.dynamic_mesh_builder.clear()
 
     # Update scene geometry. Called once each simulation step (rendered frame).
     # In this application, most geometry is regenerated anew every frame.
@@ -166,6 +232,7 @@ class Draw:
     def update_scene():
         if Draw.enable:
             # Update dynamic_triangle_mesh (boid "bodies", annotation)
+            Draw.dynamic_mesh_builder.assign_to(Draw.dynamic_triangle_mesh)
             Draw.vis.update_geometry(Draw.dynamic_triangle_mesh)
             Draw.adjust_static_scene_objects() # move static objects for lookat hack
 
@@ -181,14 +248,22 @@ class Draw:
         Draw.frame_start_time = frame_end_time
         Draw.frame_counter += 1
 
-    # Update scene camera's "look at" position.
+    # Update scene camera's "look at" position. Moves the camera (keeping any
+    # rotation and zoom by the user) by the change in lookat, so geometry is
+    # not touched. Only when that is not possible fall back to offsetting all
+    # drawing by temp_camera_lookat.
+    # TODO 20230419 ViewControl does not work in older versions of Open3D
+    # because "Visualizer.get_view_control() gives a copy."
+    # https://github.com/isl-org/Open3D/issues/6009
     @staticmethod
     def update_camera(lookat):
-        # TODO 20230419 does not work because "Visualizer.get_view_control()
-        # gives a copy." https://github.com/isl-org/Open3D/issues/6009
-        # camera = Draw.vis.get_view_control()
-        # camera.set_lookat(lookat)
-        Draw.temp_camera_lookat = lookat
+        if Draw.view_control_tracking:
+            if lookat != Draw.camera_lookat:
+                look_at.translate_view(Draw.vis,
+                                       (lookat - Draw.camera_lookat).asarray())
+                Draw.camera_lookat = lookat
+        else:
+            Draw.temp_camera_lookat = lookat
 
     # Constructs representation of global axes as a TriangleMesh.
     @staticmethod
@@ -200,7 +275,7 @@ class Draw:
         Draw.add_line_segment(-x, x, color, radius, sides, tri_mesh)
         Draw.add_line_segment(-y, y, color, radius, sides, tri_mesh)
         Draw.add_line_segment(-z, z, color, radius, sides, tri_mesh)
-        return tri_mesh
+        return Draw.finish_mesh(tri_mesh)
 
     # Construct everted sphere as TriangleMesh to visualize the spherical
     # containment for this flock simulation. It is based on a 1-to-4 triangle
@@ -247,7 +322,7 @@ class Draw:
                 b = b.rotate_xy_about_z(math.pi / 2)
                 c = c.rotate_xy_about_z(math.pi / 2)
 
-        return tri_mesh
+        return Draw.finish_mesh(tri_mesh)
 
     # TODO 20231127 Now only the axes are handled here. Refactor? Rename?
     # Translate "static" scene meshes according to Draw.temp_camera_lookat.
@@ -259,13 +334,19 @@ class Draw:
     # Adjust the translation of a given static scene object (eg obstacle) for
     # the sake of the temp_camera_lookat hack. Note that absolute translation in
     # Open3D is applied to the CENTER of the tri-mesh, not the origin of its
-    # local space.
+    # local space. The object is only translated and uploaded again when its
+    # translation has changed since last time (so never when the camera moves
+    # by ViewControl, or is not tracking).
     @staticmethod
     def adjust_static_scene_object(scene_object, original_center=Vec3()):
         if Draw.enable:
             translation = original_center - Draw.temp_camera_lookat
-            scene_object.translate(translation.asarray(), relative=False)
-            Draw.vis.update_geometry(scene_object)
+            previous = Draw.static_translations.get(id(scene_object))
+            if previous is None or previous[1] != translation:
+                scene_object.translate(translation.asarray(), relative=False)
+                Draw.vis.update_geometry(scene_object)
+                Draw.static_translations[id(scene_object)] = (scene_object,
+                                                              translation)
     
     def register_key_callback(key, callback_func):
         if Draw.enable:
@@ -283,6 +364,47 @@ class Draw:
     def new_empty_tri_mesh():
         return o3d.geometry.TriangleMesh()
 
+    @staticmethod
+    def unit_test():
+        # Triangles of a line segment from (1,2,3) to (1,2,5), radius 1, with
+        # 4 sides and end caps, as made by the earlier per-segment version
+        # (Vec3 and LocalSpace). Corners of its square cross section in xy:
+        corners = [[1, 3], [2, 2], [1, 1], [0, 2]]
+        expected = []
+        for i in range(4):
+            (a, b) = (corners[i] + [3], corners[(i + 1) % 4] + [3])
+            (d, c) = (corners[i] + [5], corners[(i + 1) % 4] + [5])
+            expected += [[d, c, b], [d, b, a], [a, b, [1, 2, 3]],
+                         [c, d, [1, 2, 5]]]
+        # Batch of segments, skipping zero length ones, with camera offset.
+        saved_lookat = Draw.temp_camera_lookat
+        Draw.temp_camera_lookat = Vec3(1, 2, 3)
+        expected = np.array(expected) - [1, 2, 3]
+        endpoints = [[[1, 2, 3], [1, 2, 5]],
+                     [[0, 0, 0], [0, 0, 0]],
+                     [[0, 0, 0], [5, 0, 0]]]
+        colors = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
+        batch = Draw.new_empty_tri_mesh()
+        Draw.add_line_segments(endpoints, colors, [1, 0.2, 0.3], 4, batch,
+                               flat_end_caps=True)
+        builder = Draw.mesh_builder(batch)
+        assert len(builder) == 2 * 4 * 4
+        assert np.allclose(builder.vertices[:16], expected, rtol=0, atol=1e-12)
+        assert np.array_equal(builder.colors[16], [[0, 0, 1]] * 3)
+        # Side triangles of last segment are at its radius from the x axis.
+        assert np.allclose(np.linalg.norm(builder.vertices[16:32:4, :, 1:] +
+                                          [2, 3], axis=2), 0.3)
+        Draw.finish_mesh(batch)
+        assert len(np.asarray(batch.triangles)) == 32
+        # One segment at a time.
+        single = Draw.new_empty_tri_mesh()
+        Draw.add_line_segment(Vec3(1, 2, 3), Vec3(1, 2, 5), Vec3(1, 0, 0), 1,
+                              4, single, flat_end_caps=True)
+        assert np.allclose(Draw.mesh_builder(single).vertices[:16], expected,
+                           rtol=0, atol=1e-12)
+        Draw.finish_mesh(single)
+        Draw.temp_camera_lookat = saved_lookat
+
 ################################################################################
 ##
 ## TODO 20230419 random test code, to be removed eventually.
@@ -0,0 +1,155 @@
+#-------------------------------------------------------------------------------
+#
+# EnsembleState.py -- new flock experiments
+#
+# Lockstep simulation of an ensemble of B independent flocks of N boids each,
+# as one vectorized state. Each member has its own random seed (so its own
+# initial conditions), tuning parameters, and obstacle set. One step advances
+# all members at once, so Python interpreter overhead per step is shared by the
+# whole ensemble, making sweeps over many small flocks cheap on one core.
+#
+# EnsembleState is a FlockState whose arrays hold B*N rows: member b is rows
+# b*N through (b+1)*N-1, so per_member() can reshape any of them to (B,N,...).
+# Neighbors are found only within a boid's own member flock, and each obstacle
+# only affects boids of members whose obstacle set contains it. There are no
+# Boid objects, so no drawing or annotation: statistics per member come from
+# stats().
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import Utilities as util
+from statistics import mean
+from Draw import Draw
+from FlockState import FlockState
+import knn
+
+class EnsembleState(FlockState):
+    """Vectorized state of B independent flocks, stepped in lockstep."""
+
+    # Initialize from a (non-vectorized) "template" Flock, which supplies the
+    # flock size, containment sphere, obstacle presets, modes, and timer. For
+    # each member: a random seed, a map of tuning parameters (see
+    # Flock.set_parameters(), default none), and an obstacle preset index
+    # (default 0). Each member's boids are made by the Flock itself, after
+    # Draw.set_random_seeds() with its seed.
+    def __init__(self, flock, seeds, parameter_sets=None, presets=None,
+                 neighbor_count=7):
+        assert not flock.vectorized
+        self.flock = flock
+        self.boids = []
+        self.member_count = len(seeds)
+        self.member_size = flock.boid_count
+        parameter_sets = parameter_sets or [{}] * self.member_count
+        presets = presets or [0] * self.member_count
+        members = []
+        for (seed, parameters) in zip(seeds, parameter_sets):
+            Draw.set_random_seeds(seed)
+            flock.boids = []
+            flock.make_boids(flock.boid_count, flock.sphere_radius,
+                             flock.sphere_center)
+            # Flock-level parameters belong to this member only.
+            saved = {name: getattr(flock, name) for name in parameters
+                     if hasattr(flock, name)}
+            flock.set_parameters(parameters)
+            members.append(FlockState(flock, neighbor_count))
+            flock.set_parameters(saved)
+        flock.boids = []
+        # Concatenate members' arrays, offsetting neighbor indices.
+        def concatenate(name):
+            return np.concatenate([getattr(m, name) for m in members])
+        for name in (['position', 'side', 'up', 'forward', 'speed',
+                      'next_steer', 'steer_memory', 'steer_memory_valid',
+                      'up_memory', 'up_memory_valid',
+                      'time_since_neighbor_refresh'] +
+                     FlockState.parameter_names):
+            setattr(self, name, concatenate(name))
+        self.min_time_to_collide = np.repeat(
+            [m.min_time_to_collide for m in members], self.member_size)
+        self.neighbor_count = members[0].neighbor_count
+        self.neighbors = np.concatenate([m.neighbors + b * self.member_size
+                                         for (b, m) in enumerate(members)])
+        # Obstacles of all members, and a mask of the boids each one affects.
+        self.obstacle_list = []
+        self.obstacle_masks = {}
+        for (b, preset) in enumerate(presets):
+            for o in flock.obstacle_presets[preset]:
+                if o not in self.obstacle_masks:
+                    self.obstacle_list.append(o)
+                    self.obstacle_masks[o] = np.zeros(len(self.position), bool)
+                self.per_member(self.obstacle_masks[o])[b] = True
+        self.last_sdf_per_obstacle = {}
+        # Per member cumulative counts.
+        self.avoidance_failures = np.zeros(self.member_count, dtype=np.int64)
+        self.stalls = np.zeros(self.member_count, dtype=np.int64)
+
+    # View of an array with one row per boid, reshaped to (B,N,...).
+    def per_member(self, array):
+        return array.reshape(self.member_count, self.member_size,
+                             *array.shape[1:])
+
+    # Parameters are gathered per member in __init__().
+    def gather_parameters(self):
+        pass
+
+    # Advance all members by one simulation step. Returns total stalls.
+    def fly_flock(self, time_step):
+        self.plan_next_steer(time_step)
+        self.apply_next_steer(time_step)
+        stalled = self.speed < (self.min_speed - util.epsilon)
+        self.stalls += self.per_member(stalled).sum(axis=1)
+        return int(np.count_nonzero(stalled))
+
+    # Refresh expired neighbor rows, searching only each boid's own member.
+    def refresh_nearest_neighbors(self, time_step):
+        self.time_since_neighbor_refresh += time_step
+        due = np.flatnonzero(self.time_since_neighbor_refresh >
+                             self.neighbor_refresh_rate)
+        if len(due):
+            self.neighbors[due] = knn.grouped_k_nearest_neighbors(
+                self.position, self.member_size, self.neighbor_count, due)
+            self.time_since_neighbor_refresh[due] = 0
+
+    def obstacles(self):
+        return self.obstacle_list
+
+    def obstacle_mask(self, obstacle):
+        return self.obstacle_masks[obstacle]
+
+    # Count avoidance failures (see FlockState) per member.
+    def count_avoidance_failures(self, obstacle):
+        current_sdf = obstacle.batch_signed_distance(self.position)
+        previous_sdf = self.last_sdf_per_obstacle.get(obstacle)
+        if previous_sdf is not None:
+            crossing = ((previous_sdf != 0) &
+                        (((current_sdf >= 0) & (previous_sdf <= 0)) |
+                         ((current_sdf <= 0) & (previous_sdf >= 0))))
+            crossing &= self.obstacle_masks[obstacle]
+            self.avoidance_failures += self.per_member(crossing).sum(axis=1)
+        self.last_sdf_per_obstacle[obstacle] = current_sdf
+
+    # No Boid objects to annotate or update.
+    def annotated_boid_indices(self):
+        return []
+    def sync_boid_speeds(self):
+        pass
+
+    # Statistics for each member, a map from metric name to (B,) array: average
+    # speed, min separation (distance between nearest pair of boids), distance
+    # from a boid to its cached nearest neighbor (max over boids), and
+    # cumulative avoidance failures and stalls. Computed as in Flock.stats() so
+    # values are identical to those of each member run as a separate Flock.
+    def stats(self):
+        nearest = knn.grouped_k_nearest_neighbors(self.position,
+                                                  self.member_size, 1)[:, 0]
+        def nn_dist(nearest):
+            return self.per_member(util.length_rows(self.position[nearest] -
+                                                    self.position))
+        speeds = self.per_member(self.speed).tolist()
+        return {'ave_speed': np.array([mean(s) for s in speeds]),
+                'min_sep': nn_dist(nearest).min(axis=1),
+                'max_nn_dist': nn_dist(self.neighbors[:, 0]).max(axis=1),
+                'avoid_fail': self.avoidance_failures.copy(),
+                'stalls': self.stalls.copy()}
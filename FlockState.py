@@ -0,0 +1,397 @@
+#-------------------------------------------------------------------------------
+#
+# FlockState.py -- new flock experiments
+#
+# Structure-of-arrays state for all Boids in a Flock, and a vectorized version
+# of Flock.fly_flock() which operates on it.
+#
+# Positions, basis vectors, speeds, and low pass filter state for all boids
+# are stored in contiguous NumPy arrays, one row per boid. The plan and apply
+# phases of a simulation step are array operations over all boids, rather than
+# per-boid method calls on Boid/Agent/Vec3 objects. Each Boid's LocalSpace is
+# replaced by a LocalSpaceView of its row, so the object API (boid.position,
+# boid.forward, boid.ls, ...) used for drawing and the GUI still works.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import io
+import contextlib
+import numpy as np
+import Utilities as util
+from Draw import Draw
+from Vec3 import Vec3
+from LocalSpace import LocalSpaceView
+from Agent import Agent
+from Boid import Boid
+import knn
+import steering
+
+class FlockState:
+    """Structure-of-arrays state for a Flock's Boids, vectorized simulation."""
+
+    # Per-boid tuning parameters, copied from Boid attributes into (N,) arrays.
+    parameter_names = ['mass', 'max_speed', 'min_speed', 'max_force',
+                       'body_radius', 'neighbor_refresh_rate',
+                       'weight_forward', 'weight_separate', 'weight_align',
+                       'weight_cohere', 'weight_avoid',
+                       'max_dist_separate', 'max_dist_align', 'max_dist_cohere',
+                       'exponent_separate', 'exponent_align', 'exponent_cohere',
+                       'angle_separate', 'angle_align', 'angle_cohere']
+
+    # Initialize from the current state of the given Flock's boids, then make
+    # each Boid's LocalSpace a view of its row in these arrays.
+    def __init__(self, flock, neighbor_count=7):
+        self.flock = flock
+        self.boids = flock.boids
+        boids = self.boids
+        assert not any(b.incremental_neighbor_refresh for b in boids), \
+            'incremental neighbor refresh is not supported when vectorized'
+        def gather_vec3(vec3s):
+            return np.array([(v.x, v.y, v.z) for v in vec3s],
+                            dtype=np.float64).reshape(-1, 3)
+        # Geometric and dynamic state.
+        self.position = gather_vec3([b.position for b in boids])
+        self.side = gather_vec3([b.side for b in boids])
+        self.up = gather_vec3([b.up for b in boids])
+        self.forward = gather_vec3([b.forward for b in boids])
+        self.speed = np.array([b.speed for b in boids], dtype=np.float64)
+        self.next_steer = np.zeros_like(self.position)
+        # Low pass filter state (util.Blender) for steering and "up" target.
+        # Before first use (Blender.value == None) memory is marked not valid.
+        def gather_blender(blenders):
+            valid = np.array([b.value is not None for b in blenders], bool)
+            values = gather_vec3([b.value if b.value is not None else Vec3()
+                                  for b in blenders])
+            return (values, valid)
+        (self.steer_memory, self.steer_memory_valid) = \
+            gather_blender([b.steer_memory for b in boids])
+        (self.up_memory, self.up_memory_valid) = \
+            gather_blender([b.up_memory for b in boids])
+        # Nearest neighbors: (N,k) index matrix and per boid time since refresh.
+        self.neighbor_count = min(neighbor_count, len(boids) - 1)
+        index = {b: i for (i, b) in enumerate(boids)}
+        self.neighbors = np.array([[index[n] for n in b.cached_nearest_neighbors]
+                                   for b in boids],
+                                  dtype=np.int64).reshape(len(boids), -1)
+        self.time_since_neighbor_refresh = np.array(
+            [b.time_since_last_neighbor_refresh for b in boids], np.float64)
+        # Map from Obstacle to (N,) signed distances at previous step.
+        self.last_sdf_per_obstacle = {}
+        for o in set().union(*[b.last_sdf_per_obstacle for b in boids]):
+            self.last_sdf_per_obstacle[o] = np.array(
+                [b.last_sdf_per_obstacle.get(o, 0) for b in boids], np.float64)
+        self.gather_parameters()
+        # Replace each Boid's LocalSpace with a view of its row.
+        for (i, b) in enumerate(boids):
+            b.ls = LocalSpaceView(self.side, self.up,
+                                  self.forward, self.position, i)
+
+    # Copy per-boid tuning parameters from Boid objects into arrays. Call again
+    # after changing those parameters on the Boids (or Flock).
+    def gather_parameters(self):
+        for name in FlockState.parameter_names:
+            setattr(self, name, np.array([getattr(b, name) for b in self.boids],
+                                         dtype=np.float64))
+        self.min_time_to_collide = self.flock.min_time_to_collide
+
+    # Vectorized equivalent of Flock.fly_flock(): a "sense/plan" phase for all
+    # boids then an "act" phase which moves them. Returns count of stalls.
+    def fly_flock(self, time_step):
+        self.plan_next_steer(time_step)
+        self.apply_next_steer(time_step)
+        self.sync_boid_speeds()
+        stalled = self.speed < (self.min_speed - util.epsilon)
+        return int(np.count_nonzero(stalled))
+
+    # Determine and store desired steering for this simulation step (see
+    # Boid.steer_to_flock()).
+    def plan_next_steer(self, time_step):
+        timer = self.flock.timer
+        with timer.span('neighbors'):
+            self.refresh_nearest_neighbors(time_step)
+        f = self.weight_forward[:, None] * self.forward
+        (s, a, c) = self.steer_to_separate_align_cohere()
+        with timer.span('avoid'):
+            o = self.weight_avoid[:, None] * self.steer_to_avoid()
+        combined = self.smoothed_steering(f + s + a + c + o)
+        combined = self.anti_stall_adjustment(combined)
+        self.annotation(s, a, c, o, combined)
+        self.next_steer = combined
+
+    # Apply desired steering for this simulation step (see Agent.steer()).
+    def apply_next_steer(self, time_step):
+        with self.flock.timer.span('integrate'):
+            self.steer(self.next_steer, time_step)
+
+    # Refresh neighbor matrix rows whose cache has expired, for all of them in
+    # one batched query (see Boid.nearest_neighbors()). Also update each such
+    # Boid's cached_nearest_neighbors, used for annotation and statistics.
+    def refresh_nearest_neighbors(self, time_step):
+        self.time_since_neighbor_refresh += time_step
+        due = np.flatnonzero(self.time_since_neighbor_refresh >
+                             self.neighbor_refresh_rate)
+        if len(due):
+            nn = knn.k_nearest_neighbors(self.position,
+                                         self.neighbor_count, due)
+            self.neighbors[due] = nn
+            self.time_since_neighbor_refresh[due] = 0
+            for (i, row) in zip(due.tolist(), nn.tolist()):
+                self.boids[i].cached_nearest_neighbors = [self.boids[j]
+                                                          for j in row]
+
+    # Weighted separation, alignment, and cohesion steering for all boids, each
+    # an (N,3) array. (See steering.py and the scalar version in Boid.py.)
+    def steer_to_separate_align_cohere(self):
+        timer = self.flock.timer
+        args = (self.position, self.forward, self.neighbors)
+        with timer.span('neighbor_geometry'):
+            geometry = steering.neighbor_geometry(*args)
+        with timer.span('separate'):
+            s = steering.steer_to_separate(*args, self.max_dist_separate,
+                                           self.exponent_separate,
+                                           self.angle_separate,
+                                           self.weight_separate, geometry)
+        with timer.span('align'):
+            a = steering.steer_to_align(*args, self.max_dist_align,
+                                        self.exponent_align, self.angle_align,
+                                        self.weight_align, geometry)
+        with timer.span('cohere'):
+            c = steering.steer_to_cohere(*args, self.max_dist_cohere,
+                                         self.exponent_cohere,
+                                         self.angle_cohere,
+                                         self.weight_cohere, geometry)
+        return (s, a, c)
+
+    # Obstacle avoidance steering, (N,3): sum of predictive and static
+    # avoidance, using batch methods of each Obstacle. (See Boid.steer_to_avoid()
+    # and methods it calls.) Also records avoidance annotation (point and
+    # weight of strongest avoidance) and counts avoidance failures.
+    def steer_to_avoid(self):
+        avoid = np.zeros_like(self.position)
+        self.annote_avoid_poi = np.zeros_like(self.position)
+        self.annote_avoid_weight = np.zeros(len(self.position))
+        if not self.flock.wrap_vs_avoid:
+            predict_avoid = self.steer_for_predictive_avoidance()
+            static_avoid = self.fly_away_from_obstacles()
+            avoid = static_avoid + predict_avoid
+        self.avoid_obstacle_annotation()
+        return avoid
+
+    # Steering for predictive obstacle avoidance, for the soonest predicted
+    # collision of each boid. (See Boid.steer_for_predictive_avoidance().)
+    def steer_for_predictive_avoidance(self):
+        with self.flock.timer.span('predict_collisions'):
+            (hit, dist, poi, normal) = self.predict_future_collisions()
+        lateral = normal - self.forward * util.dot_rows(normal,
+                                                        self.forward)[:, None]
+        avoidance = util.normalize_rows_or_0(lateral)
+        min_dist = self.speed * self.min_time_to_collide
+        if self.flock.avoid_blend_mode:
+            # Smooth weight transition from 80% to 120% of min dist.
+            # (Like util.remap_interval(dist, min_dist*0.8, min_dist*1.2, 1, 0).)
+            input_range = min_dist * 0.4
+            blend = np.where(input_range == 0, 0.5,
+                             (dist - min_dist * 0.8) /
+                             np.where(input_range == 0, 1, input_range))
+            weight = util.unit_sigmoid_on_01_array(1 - blend)
+        else:
+            weight = np.where(min_dist > dist, 1.0, 0.0)
+        weight = np.where(hit, weight, 0)
+        self.annote_avoid_poi[hit] = poi[hit]
+        self.annote_avoid_weight[hit] = weight[hit]
+        return np.where(hit[:, None], avoidance * weight[:, None], 0)
+
+    # Find the soonest future collision of each boid with any obstacle. Returns
+    # (N,) hit mask, and for each boid which hits: distance to collision, point
+    # of impact, and obstacle normal there. Counts avoidance failures: when the
+    # signed distance to an obstacle changes sign between steps. (See
+    # Boid.predict_future_collisions().)
+    def predict_future_collisions(self):
+        count = len(self.position)
+        hit = np.zeros(count, dtype=bool)
+        soonest = np.full(count, np.inf)
+        dist = np.full(count, np.inf)
+        poi = np.full((count, 3), np.nan)
+        normal = np.zeros((count, 3))
+        for obstacle in self.obstacles():
+            (p, h) = obstacle.batch_ray_intersection(self.position, self.forward,
+                                                     self.body_radius)
+            mask = self.obstacle_mask(obstacle)
+            if mask is not None:
+                h &= mask
+            d = util.length_rows(p - self.position)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                time_to_collision = d / self.speed
+            # Keep earlier obstacle when times are equal, like stable sort.
+            sooner = h & ((~hit) | (time_to_collision < soonest))
+            if np.any(sooner):
+                soonest[sooner] = time_to_collision[sooner]
+                dist[sooner] = d[sooner]
+                poi[sooner] = p[sooner]
+                normal[sooner] = obstacle.batch_normal_at_poi(
+                    p[sooner], self.position[sooner])
+                hit |= sooner
+            self.count_avoidance_failures(obstacle)
+        return (hit, dist, poi, normal)
+
+    # Obstacles which may affect these boids.
+    def obstacles(self):
+        return self.flock.obstacles
+
+    # An (N,) boolean array of boids affected by a given obstacle, or None when
+    # it affects all of them. (See EnsembleState.py.)
+    def obstacle_mask(self, obstacle):
+        return None
+
+    # Compare each boid's signed distance to obstacle with previous step's
+    # value. (A previous value of 0 means none, as in Boid.)
+    def count_avoidance_failures(self, obstacle):
+        current_sdf = obstacle.batch_signed_distance(self.position)
+        previous_sdf = self.last_sdf_per_obstacle.get(obstacle)
+        if previous_sdf is not None:
+            crossing = ((previous_sdf != 0) &
+                        (((current_sdf >= 0) & (previous_sdf <= 0)) |
+                         ((current_sdf <= 0) & (previous_sdf >= 0))))
+            for i in np.flatnonzero(crossing).tolist():
+                self.boids[i].avoidance_failure_counter += 1
+        self.last_sdf_per_obstacle[obstacle] = current_sdf
+
+    # Static avoidance: steering away from nearby obstacles. (See
+    # Boid.fly_away_from_obstacles().)
+    def fly_away_from_obstacles(self):
+        avoidance = np.zeros_like(self.position)
+        max_distance = self.body_radius * 20
+        for obstacle in self.obstacles():
+            oa = obstacle.batch_fly_away(self.position, self.forward,
+                                         max_distance, self.body_radius)
+            mask = self.obstacle_mask(obstacle)
+            if mask is not None:
+                oa[~mask] = 0
+            weight = util.length_rows(oa)
+            stronger = weight > self.annote_avoid_weight
+            if np.any(stronger):
+                self.annote_avoid_poi[stronger] = obstacle.batch_nearest_point(
+                    self.position[stronger])
+                self.annote_avoid_weight[stronger] = weight[stronger]
+            avoidance += oa
+        return avoidance
+
+    # Draw avoidance annotation for boids which want it, all in one batch. (See
+    # Boid.avoid_obstacle_annotation().)
+    def avoid_obstacle_annotation(self):
+        i = np.array(self.annotated_boid_indices(), dtype=np.int64)
+        i = i[self.annote_avoid_weight[i] > 0.01]
+        if len(i):
+            weight = self.annote_avoid_weight[i][:, None]
+            Draw.add_line_segments(
+                np.stack([self.position[i], self.annote_avoid_poi[i]], axis=1),
+                # Interp color between gray and magenta.
+                util.interpolate(weight, np.array([0.85, 0.85, 0.85]),
+                                 np.array([1.0, 0, 1])))
+
+    # Low pass filter steering, see Boid.smoothed_steering().
+    def smoothed_steering(self, steer):
+        self.steer_memory = np.where(self.steer_memory_valid[:, None],
+                                     util.interpolate(0.8, steer,
+                                                      self.steer_memory),
+                                     steer)
+        self.steer_memory_valid[:] = True
+        return self.steer_memory
+
+    # Prevent "stalls", see Boid.anti_stall_adjustment().
+    def anti_stall_adjustment(self, raw_steering):
+        prevention_margin = 1.5
+        along = util.dot_rows(raw_steering, self.forward)
+        adjust = ((self.speed < (self.min_speed * prevention_margin)) &
+                  (along < 0))
+        ahead = self.forward * (self.max_force * 0.9)[:, None]
+        side = raw_steering - self.forward * along[:, None]
+        return np.where(adjust[:, None], ahead + side, raw_steering)
+
+    # Draw annotation for those boids which want it (see Boid.annotation()),
+    # all line segments in one batch.
+    def annotation(self, separation, alignment, cohesion, avoidance, combined):
+        i = self.annotated_boid_indices()
+        if i:
+            Draw.add_line_segments(
+                Boid.force_annotation_segments(self.position[i],
+                                               [separation[i], alignment[i],
+                                                cohesion[i], avoidance[i],
+                                                combined[i]]),
+                np.tile(Boid.force_annotation_colors, (len(i), 1)))
+
+    # Indices of boids which should be annotated: the selected boid and its
+    # neighbors, when annotation is on (see Boid.should_annotate()).
+    def annotated_boid_indices(self):
+        flock = self.flock
+        indices = []
+        if Draw.enable and flock.enable_annotation and flock.tracking_camera:
+            i = flock.selected_boid_index
+            indices = [i] + self.neighbors[i].tolist()
+        return indices
+
+    # Advance all boids by time_step while applying steering_force (N,3). See
+    # Agent.batch_steer().
+    def steer(self, steering_force, time_step):
+        Agent.batch_steer(self.side, self.up, self.forward, self.position,
+                          self.speed, steering_force, time_step,
+                          self.max_force, self.max_speed, self.mass,
+                          self.up_reference)
+
+    # Bird-like roll control: blends vector toward path curvature center with
+    # global up (see Boid.up_reference()). Updates memory of "moving" boids.
+    def up_reference(self, acceleration, moving):
+        new_up = acceleration.copy()
+        new_up[:, 1] += util.length_rows(acceleration)
+        if np.all(self.up_memory_valid):
+            # Same as util.interpolate(0.95, new_up, self.up_memory).
+            blended = new_up * (1 - 0.95)
+            blended += self.up_memory * 0.95
+        else:
+            blended = np.where(self.up_memory_valid[:, None],
+                               util.interpolate(0.95, new_up, self.up_memory),
+                               new_up)
+        if np.all(moving):
+            self.up_memory = blended
+        else:
+            self.up_memory[moving] = blended[moving]
+        self.up_memory_valid |= moving
+        return util.normalize_rows_or_0(self.up_memory)
+
+    # Copy speeds from array to Boid objects, for code which reads boid.speed.
+    def sync_boid_speeds(self):
+        for (b, s) in zip(self.boids, self.speed.tolist()):
+            b.speed = s
+
+    # Compare with the object engine (Flock.fly_flock() on Boid objects) for
+    # identical seeded flocks. Flock.setup() runs a quick version, the flocks
+    # made here skip their own setup(). For a longer run: python FlockState.py
+    @staticmethod
+    def unit_test(boid_count=5, steps=2):
+        from flock import Flock  # Here, since flock.py imports this module.
+        class TestFlock(Flock):
+            def setup(self):
+                pass
+        saved_enable = Draw.enable
+        Draw.enable = False
+        flocks = []
+        for vectorized in (False, True):
+            with contextlib.redirect_stdout(io.StringIO()):
+                f = TestFlock(boid_count=boid_count, fixed_time_step=True,
+                              fixed_fps=30, vectorized=vectorized)
+                f.make_boids(boid_count, f.sphere_radius, f.sphere_center)
+                f.cycle_obstacle_selection()
+            for i in range(steps):
+                f.fly_flock(1 / 30)
+            flocks.append(f.boid_arrays())
+        Draw.enable = saved_enable
+        (objects, arrays) = flocks
+        for name in ['position', 'forward']:
+            assert np.allclose(objects[name], arrays[name], rtol=0, atol=1e-12)
+
+
+if __name__ == "__main__":
+    FlockState.unit_test(boid_count=50, steps=20)
+    print('FlockState matches object engine.')
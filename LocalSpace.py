@@ -93,8 +93,30 @@ class LocalSpace:
         new_up = new_forward.cross(new_side).normalize()
         return LocalSpace(new_side, new_up, new_forward, self.p)
 
+    # Batch version of rotate_to_new_forward() for many LocalSpaces at once:
+    # given (N,3) arrays of new forward and reference up directions, returns
+    # (N,3) arrays of new side and new up basis vectors.
+    @staticmethod
+    def batch_rotate_to_new_forward(new_forward, reference_up):
+        new_side = util.normalize_rows(util.cross_rows(reference_up, new_forward))
+        new_up = util.normalize_rows(util.cross_rows(new_forward, new_side))
+        return (new_side, new_up)
+
+    # Batch version of is_orthonormal(), for (N,3) arrays of basis vectors.
+    # Returns (N,) boolean array.
+    @staticmethod
+    def batch_is_orthonormal(i, j, k):
+        epsilon = util.epsilon * 10
+        return (util.within_epsilon(util.dot_rows(i, i), 1, epsilon) &
+                util.within_epsilon(util.dot_rows(j, j), 1, epsilon) &
+                util.within_epsilon(util.dot_rows(k, k), 1, epsilon) &
+                util.within_epsilon(util.dot_rows(i, j), 0, epsilon) &
+                util.within_epsilon(util.dot_rows(j, k), 0, epsilon) &
+                util.within_epsilon(util.dot_rows(k, i), 0, epsilon))
+
     @staticmethod
     def unit_test():
+        LocalSpaceView.unit_test()
         identity_asarray = np.array([[1, 0, 0, 0],
                                      [0, 1, 0, 0],
                                      [0, 0, 1, 0],
@@ -137,3 +159,71 @@ class LocalSpace:
         b.p = Vec3(9, 8, 7)
         assert b.i == Vec3(1, 0, 0), 'verify copy.copy() prevents sharing'
         assert a.p == Vec3(0, 0, 0), 'verify copy.copy() prevents sharing'
+
+        # Batch rotate_to_new_forward() matches scalar version.
+        rng = np.random.default_rng(1234567890)
+        forwards = util.normalize_rows(rng.normal(size=(100, 3)))
+        ups = util.normalize_rows(rng.normal(size=(100, 3)))
+        (sides, new_ups) = LocalSpace.batch_rotate_to_new_forward(forwards, ups)
+        assert np.all(LocalSpace.batch_is_orthonormal(sides, new_ups, forwards))
+        for (f, u, s, nu) in zip(forwards, ups, sides, new_ups):
+            ls = LocalSpace().rotate_to_new_forward(Vec3.from_array(f),
+                                                    Vec3.from_array(u))
+            assert np.allclose(ls.i.asarray(), s)
+            assert np.allclose(ls.j.asarray(), nu)
+        assert not LocalSpace.batch_is_orthonormal(sides, sides, forwards)[0]
+
+class LocalSpaceView(LocalSpace):
+    """LocalSpace whose i, j, k, and p are one row of shared (N,3) arrays."""
+
+    # Initialize new instance: a view of row "index" of the given arrays.
+    # Reading i, j, k, or p returns a new Vec3, assigning one writes the row.
+    def __init__(self, i_array, j_array, k_array, p_array, index):
+        self.arrays = (i_array, j_array, k_array, p_array)
+        self.index = index
+
+    def get_row(self, a):
+        return Vec3(*self.arrays[a][self.index].tolist())
+    def set_row(self, a, v):
+        self.arrays[a][self.index] = (v.x, v.y, v.z)
+
+    @property
+    def i(self):
+        return self.get_row(0)
+    @i.setter
+    def i(self, i):
+        self.set_row(0, i)
+    @property
+    def j(self):
+        return self.get_row(1)
+    @j.setter
+    def j(self, j):
+        self.set_row(1, j)
+    @property
+    def k(self):
+        return self.get_row(2)
+    @k.setter
+    def k(self, k):
+        self.set_row(2, k)
+    @property
+    def p(self):
+        return self.get_row(3)
+    @p.setter
+    def p(self, p):
+        self.set_row(3, p)
+
+    @staticmethod
+    def unit_test():
+        arrays = [np.zeros((2, 3)) for a in range(4)]
+        views = [LocalSpaceView(*arrays, index) for index in range(2)]
+        views[1].set_state_ijkp(Vec3(1, 0, 0), Vec3(0, 1, 0),
+                                Vec3(0, 0, 1), Vec3(4, 5, 6))
+        assert views[1].is_orthonormal()
+        assert np.array_equal(arrays[3], [[0, 0, 0], [4, 5, 6]])
+        arrays[3][1] = (7, 8, 9)
+        assert views[1].p == Vec3(7, 8, 9)
+        assert views[1].globalize(Vec3(1, 1, 1)) == Vec3(8, 9, 10)
+        views[0].p += Vec3(1, 2, 3)
+        assert np.array_equal(arrays[3][0], [1, 2, 3])
+        assert np.array_equal(views[1].asarray(),
+                              LocalSpace(p=Vec3(7, 8, 9)).asarray())
@@ -0,0 +1,104 @@
+#-------------------------------------------------------------------------------
+#
+# MeshBuilder.py -- new flock experiments
+#
+# Accumulates colored triangles in preallocated NumPy arrays (grown by doubling
+# when full) then assigns them all to an Open3D TriangleMesh at once. This
+# replaces appending vertices, colors, and triangles to a TriangleMesh one at a
+# time, each a call from Python into Open3D. Each triangle has its own three
+# vertices (as with Draw.add_colored_triangle()) so triangle indices are just
+# consecutive integers, made once and reused.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import open3d as o3d
+import numpy as np
+
+class MeshBuilder:
+    """Growable NumPy arrays of colored triangles, for bulk mesh assignment."""
+
+    # Initial capacity is in triangles.
+    def __init__(self, capacity=1024):
+        self.vertices = np.zeros((capacity, 3, 3))  # Per triangle, per vertex.
+        self.colors = np.zeros((capacity, 3, 3))
+        self.indices = np.arange(capacity * 3, dtype=np.int32).reshape(-1, 3)
+        self.count = 0
+
+    # Number of triangles added since last clear().
+    def __len__(self):
+        return self.count
+
+    # Remove all triangles (keeping allocated arrays).
+    def clear(self):
+        self.count = 0
+
+    # Ensure room for "count" more triangles, at least doubling when growing.
+    def reserve(self, count):
+        needed = self.count + count
+        capacity = len(self.vertices)
+        if needed > capacity:
+            capacity = max(needed, capacity * 2)
+            def grow(array):
+                bigger = np.zeros((capacity, 3, 3))
+                bigger[:self.count] = array[:self.count]
+                return bigger
+            self.vertices = grow(self.vertices)
+            self.colors = grow(self.colors)
+            self.indices = np.arange(capacity * 3,
+                                     dtype=np.int32).reshape(-1, 3)
+
+    # Add one triangle, given three xyz vertices and an rgb color (sequences
+    # of 3 numbers).
+    def add_triangle(self, v1, v2, v3, color):
+        if self.count == len(self.vertices):
+            self.reserve(1)
+        self.vertices[self.count] = (v1, v2, v3)
+        self.colors[self.count] = color
+        self.count += 1
+
+    # Add M triangles: vertices is (M,3,3), colors is (M,3) for a color per
+    # triangle or (M,3,3) for a color per vertex.
+    def add_triangles(self, vertices, colors):
+        m = len(vertices)
+        self.reserve(m)
+        colors = np.asarray(colors)
+        self.vertices[self.count : self.count + m] = vertices
+        self.colors[self.count : self.count + m] = (colors[:, None, :]
+                                                    if colors.ndim == 2
+                                                    else colors)
+        self.count += m
+
+    # Replace contents of an Open3D TriangleMesh with these triangles.
+    def assign_to(self, tri_mesh):
+        n = self.count
+        tri_mesh.vertices = o3d.utility.Vector3dVector(
+            self.vertices[:n].reshape(-1, 3))
+        tri_mesh.vertex_colors = o3d.utility.Vector3dVector(
+            self.colors[:n].reshape(-1, 3))
+        tri_mesh.triangles = o3d.utility.Vector3iVector(self.indices[:n])
+
+    @staticmethod
+    def unit_test():
+        builder = MeshBuilder(capacity=2)
+        builder.add_triangle((0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 0, 0))
+        vertices = np.arange(27, dtype=np.float64).reshape(3, 3, 3)
+        builder.add_triangles(vertices, [[0, 1, 0], [0, 0, 1], [1, 1, 1]])
+        assert len(builder) == 4 and len(builder.vertices) == 4
+        assert np.array_equal(builder.vertices[1:4], vertices)
+        assert np.array_equal(builder.colors[0], [[1, 0, 0]] * 3)
+        assert np.array_equal(builder.colors[2], [[0, 0, 1]] * 3)
+        per_vertex = np.ones((1, 3, 3))
+        builder.add_triangles(vertices[:1], per_vertex)
+        assert len(builder) == 5 and len(builder.vertices) == 8
+        assert np.array_equal(builder.vertices[0, 1], [1, 0, 0])
+        tri_mesh = o3d.geometry.TriangleMesh()
+        builder.assign_to(tri_mesh)
+        assert np.array_equal(np.asarray(tri_mesh.vertices),
+                              builder.vertices[:5].reshape(-1, 3))
+        assert np.array_equal(np.asarray(tri_mesh.triangles),
+                              np.arange(15).reshape(-1, 3))
+        builder.clear()
+        builder.assign_to(tri_mesh)
+        assert len(builder) == 0 and len(np.asarray(tri_mesh.triangles)) == 0
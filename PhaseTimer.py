@@ -0,0 +1,180 @@
+#-------------------------------------------------------------------------------
+#
+# PhaseTimer.py -- new flock experiments
+#
+# Lightweight timing of the phases of each simulation frame (neighbor search,
+# steering behaviors, integration, drawing, ...). Code to be timed is wrapped
+# in a "span":
+#
+#     with timer.span('draw'):
+#         self.draw()
+#
+# A phase may have several spans per frame, their durations are summed. Spans
+# are meant to be per frame (or per simulation step) rather than per boid, so
+# timing costs little. It is off by default: set enable (trace_frames() does
+# that) to collect timing. At the end of each frame the per-phase totals are added to a
+# rolling window of recent frames, from which averages and percentiles are
+# computed. Optionally, spans for a given range of frames are written to a
+# JSON file in Chrome trace event format, for viewing in chrome://tracing or
+# https://ui.perfetto.dev
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import tempfile
+from collections import deque
+import numpy as np
+
+class PhaseTimer:
+    """Per-phase frame timing with rolling statistics and trace export."""
+
+    # Initialize new instance.
+    def __init__(self, window=100, enable=False):
+        self.enable = enable    # When False, spans do nothing.
+        self.window = window    # Number of recent frames kept for statistics.
+        self.history = {}       # Map from phase name to deque of frame totals.
+        self.current = {}       # Map from phase name to total for this frame.
+        self.frame = 0          # Count of completed frames.
+        # Optional Chrome trace of frames first..last (inclusive) to path.
+        self.trace_first = None
+        self.trace_last = None
+        self.trace_path = None
+        self.trace_events = []
+        self.start_time = time.perf_counter()
+
+    # Returns a context manager which times a span of the given phase.
+    def span(self, phase):
+        return Span(self, phase) if self.enable else PhaseTimer.no_span
+
+    # Record a span which started and ended at the given perf_counter() times.
+    def add(self, phase, start, end):
+        self.current[phase] = self.current.get(phase, 0) + end - start
+        if self.tracing():
+            self.trace_events.append({'name': phase,
+                                      'ph': 'X',
+                                      'ts': (start - self.start_time) * 1e6,
+                                      'dur': (end - start) * 1e6,
+                                      'pid': 0,
+                                      'tid': 0,
+                                      'args': {'frame': self.frame}})
+
+    # Called at end of each frame: save this frame's phase totals, and write
+    # trace file after last frame of trace range.
+    def end_frame(self):
+        for phase in set(self.history) | set(self.current):
+            if phase not in self.history:
+                self.history[phase] = deque(maxlen=self.window)
+            self.history[phase].append(self.current.get(phase, 0))
+        self.current = {}
+        if self.trace_path and self.frame == self.trace_last:
+            self.write_trace(self.trace_path)
+            self.trace_path = None
+        self.frame += 1
+
+    # Request a Chrome trace of frames first through last, written to path.
+    # (Also turns timing on.)
+    def trace_frames(self, first, last, path='flock_trace.json'):
+        self.enable = True
+        self.trace_first = first
+        self.trace_last = last
+        self.trace_path = path
+        self.trace_events = []
+
+    # True when spans of the current frame go into the trace.
+    def tracing(self):
+        return (self.trace_path is not None and
+                self.trace_first <= self.frame <= self.trace_last)
+
+    # Write trace events recorded so far as a Chrome trace event JSON file.
+    def write_trace(self, path):
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': self.trace_events,
+                       'displayTimeUnit': 'ms'}, file)
+
+    # Names of all phases timed so far.
+    def phases(self):
+        return list(self.history)
+
+    # Average seconds per frame spent in phase over recent frames.
+    def average(self, phase):
+        return self.percentile(phase, None)
+
+    # Given percentile (0-100) of seconds per frame spent in phase over recent
+    # frames. (Average, if percent is None.)
+    def percentile(self, phase, percent):
+        times = self.history.get(phase)
+        if not times:
+            return 0
+        if percent is None:
+            return float(np.mean(times))
+        return float(np.percentile(times, percent))
+
+    # Map from phase name to map of statistics (in milliseconds).
+    def summary(self):
+        return {phase: {'average': self.average(phase) * 1000,
+                        'p50': self.percentile(phase, 50) * 1000,
+                        'p95': self.percentile(phase, 95) * 1000,
+                        'max': self.percentile(phase, 100) * 1000}
+                for phase in self.phases()}
+
+    # Shared do-nothing span for when timer is disabled.
+    class NoSpan:
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+    no_span = NoSpan()
+
+    @staticmethod
+    def unit_test():
+        assert not PhaseTimer().enable
+        timer = PhaseTimer(window=3, enable=True)
+        for frame in range(5):
+            for i in range(2):
+                with timer.span('a'):
+                    pass
+            if frame == 4:
+                with timer.span('b'):
+                    pass
+            timer.end_frame()
+        assert timer.frame == 5
+        assert len(timer.history['a']) == 3
+        assert len(timer.history['b']) == 1  # Phase first seen in last frame.
+        assert timer.percentile('a', 0) <= timer.average('a')
+        assert timer.average('a') <= timer.percentile('a', 100)
+        assert timer.average('none') == 0
+        assert set(timer.summary()) == {'a', 'b'}
+        timer.enable = False
+        with timer.span('c'):
+            pass
+        assert 'c' not in timer.current
+        # Tracing turns timing on, records only frames in range, writes file.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            timer.trace_frames(6, 7, path)
+            assert timer.enable
+            for frame in range(5, 9):
+                with timer.span('a'):
+                    pass
+                assert timer.tracing() == (frame in (6, 7))
+                timer.end_frame()
+            with open(path) as file:
+                events = json.load(file)['traceEvents']
+        assert [e['args']['frame'] for e in events] == [6, 7]
+        assert events[0]['name'] == 'a' and events[0]['ph'] == 'X'
+
+# Times one span of a phase, see PhaseTimer.span().
+class Span:
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        self.timer.add(self.phase, self.start, time.perf_counter())
+        return False
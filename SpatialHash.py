@@ -0,0 +1,172 @@
+#-------------------------------------------------------------------------------
+#
+# SpatialHash.py -- new flock experiments
+#
+# Uniform spatial hash grid, for finding the nearest neighbors of a Boid without
+# sorting the whole flock. Space is divided into cubical cells of a given size.
+# Each cell (keyed by its integer xyz index) holds a list of the objects (Boids,
+# Agents, anything with a "position" Vec3) inside it.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import math
+import numpy as np
+from Vec3 import Vec3
+import Utilities as util
+
+class SpatialHash:
+    """Uniform spatial hash grid for nearest neighbor queries."""
+
+    # Initialize new instance.
+    def __init__(self, cell_size=10, target_occupancy=None):
+        self.cell_size = cell_size  # Edge length of cubical cells.
+        self.cells = {}             # Map from cell key (ix, iy, iz) to list.
+        self.count = 0              # Total number of objects in grid.
+        # When not None, each rebuild() adjusts cell_size toward this average
+        # number of objects per (non-empty) cell, tracking the flock's density.
+        self.target_occupancy = target_occupancy
+
+    # Integer xyz index of the cell containing a given position.
+    def cell_key(self, position):
+        s = self.cell_size
+        return (math.floor(position.x / s),
+                math.floor(position.y / s),
+                math.floor(position.z / s))
+
+    # Empty the grid then insert each given object according to its position.
+    # Called once per simulation step, since objects move between cells.
+    def rebuild(self, objects):
+        if self.target_occupancy and self.cells:
+            self.adjust_cell_size()
+        self.cells = {}
+        for o in objects:
+            key = self.cell_key(o.position)
+            cell = self.cells.get(key)
+            if cell is None:
+                self.cells[key] = [o]
+            else:
+                cell.append(o)
+        self.count = len(objects)
+
+    # Scale cell size (for next rebuild) by the cube root of the ratio between
+    # target and current average occupancy. Change is limited to 2x per step.
+    def adjust_cell_size(self):
+        occupancy = self.count / len(self.cells)
+        ratio = util.clip(self.target_occupancy / occupancy, 0.125, 8)
+        self.cell_size *= ratio ** (1 / 3)
+
+    # Returns a list of the n objects nearest the given one, sorted by distance,
+    # not including the given object itself. Searches the cell containing it,
+    # then successive "rings" (cubical shells of cells) around that, until it
+    # has n candidates which are certain to be nearer than any unsearched cell.
+    def nearest_neighbors(self, query, n=7):
+        p = query.position
+        s = self.cell_size
+        (cx, cy, cz) = self.cell_key(p)
+        # Distance from p to nearest wall of its own cell.
+        margin = min(p.x - cx * s, (cx + 1) * s - p.x,
+                     p.y - cy * s, (cy + 1) * s - p.y,
+                     p.z - cz * s, (cz + 1) * s - p.z)
+        candidates = []  # List of (distance squared, object) pairs.
+        seen = 0
+        ring = 0
+        while True:
+            for key in SpatialHash.ring_of_keys(cx, cy, cz, ring):
+                cell = self.cells.get(key)
+                if cell:
+                    seen += len(cell)
+                    for o in cell:
+                        if o is not query:
+                            candidates.append(
+                                ((o.position - p).length_squared(), o))
+            candidates.sort(key=SpatialHash.first)
+            if seen >= self.count:
+                break
+            # Any object outside the rings searched so far is at least this far
+            # from the query point, so nearer candidates are the true nearest.
+            if len(candidates) >= n:
+                if candidates[n - 1][0] <= (ring * s + margin) ** 2:
+                    break
+            ring += 1
+            # Far from the occupied cells (eg an outlier query) rings are mostly
+            # empty, so instead visit all occupied cells beyond those searched.
+            if (2 * ring + 1) ** 3 - (2 * ring - 1) ** 3 > len(self.cells):
+                for (key, cell) in self.cells.items():
+                    if max(abs(key[0] - cx), abs(key[1] - cy),
+                           abs(key[2] - cz)) >= ring:
+                        for o in cell:
+                            if o is not query:
+                                candidates.append(
+                                    ((o.position - p).length_squared(), o))
+                candidates.sort(key=SpatialHash.first)
+                break
+        return [o for (d, o) in candidates[:n]]
+
+    # Sort key for (distance squared, object) pairs.
+    @staticmethod
+    def first(pair):
+        return pair[0]
+
+    # Generate the keys of all cells on the surface of the cube "ring" cells out
+    # from the given center cell. For ring 0 that is just the center cell.
+    @staticmethod
+    def ring_of_keys(cx, cy, cz, ring):
+        r = ring
+        for x in range(-r, r + 1):
+            x_on_face = abs(x) == r
+            for y in range(-r, r + 1):
+                if x_on_face or abs(y) == r:
+                    for z in range(-r, r + 1):
+                        yield (cx + x, cy + y, cz + z)
+                else:
+                    yield (cx + x, cy + y, cz - r)
+                    if r > 0:
+                        yield (cx + x, cy + y, cz + r)
+
+    @staticmethod
+    def unit_test():
+        # Count of keys in each ring is difference of cubes: (2r+1)³ - (2r-1)³
+        assert len(list(SpatialHash.ring_of_keys(0, 0, 0, 0))) == 1
+        assert len(list(SpatialHash.ring_of_keys(0, 0, 0, 1))) == 26
+        assert len(set(SpatialHash.ring_of_keys(5, 6, 7, 3))) == 343 - 125
+
+        # Compare with brute force sort for random points in a box.
+        class Point:
+            def __init__(self, position):
+                self.position = position
+        rng = np.random.default_rng(1234567890)
+        points = [Point(Vec3.from_array(xyz))
+                  for xyz in rng.uniform(-20, 20, (80, 3))]
+        # Include some coincident points and an isolated outlier.
+        points.append(Point(points[0].position))
+        points.append(Point(Vec3(200, 0, 0)))
+        for cell_size in [1, 7, 100]:
+            sh = SpatialHash(cell_size)
+            sh.rebuild(points)
+            assert sh.count == len(points)
+            for q in points:
+                def dist2(o):
+                    return (o.position - q.position).length_squared()
+                brute = sorted([o for o in points if o is not q], key=dist2)
+                found = sh.nearest_neighbors(q, 7)
+                assert len(found) == 7
+                assert [dist2(o) for o in found] == [dist2(o) for o in brute[:7]]
+
+        # Adaptive cell size converges toward target occupancy.
+        sh = SpatialHash(100, target_occupancy=3)
+        for i in range(10):
+            sh.rebuild(points)
+        assert util.between(sh.count / len(sh.cells), 1.5, 6)
+        for q in points[:20]:
+            def dist2(o):
+                return (o.position - q.position).length_squared()
+            brute = sorted([o for o in points if o is not q], key=dist2)
+            found = sh.nearest_neighbors(q, 7)
+            assert [dist2(o) for o in found] == [dist2(o) for o in brute[:7]]
+
+        # Fewer objects than requested neighbors.
+        sh = SpatialHash(10)
+        sh.rebuild(points[:3])
+        assert len(sh.nearest_neighbors(points[0], 7)) == 2
@@ -86,6 +86,54 @@ def remap_interval_clip(x, in0, in1, out0, out1):
 def zero_crossing(a, b):
     return ((a >= 0) and (b <= 0)) or ((a <= 0) and (b >= 0))
 
+# Operations on NumPy arrays of 3d vectors, one per row (shape (...,3)), used
+# to process all Boids of a Flock at once. Arithmetic is written out to match
+# the corresponding Vec3 methods so results agree up to round-off.
+
+# Dot products of corresponding rows: (...,3) → (...).
+def dot_rows(a, b):
+    return ((a[..., 0] * b[..., 0]) +
+            (a[..., 1] * b[..., 1]) +
+            (a[..., 2] * b[..., 2]))
+
+# Length of each row: (...,3) → (...).
+def length_rows(a):
+    return np.sqrt(dot_rows(a, a))
+
+# Normalize each row (see Vec3.normalize()).
+def normalize_rows(a):
+    return a / length_rows(a)[..., None]
+
+# Normalize each row, except zero length rows (see Vec3.normalize_or_0()).
+def normalize_rows_or_0(a):
+    length_squared = dot_rows(a, a)
+    zero = within_epsilon(length_squared, 0)
+    return a / np.where(zero, 1, np.sqrt(length_squared))[..., None]
+
+# Cross products of corresponding rows (see Vec3.cross()). Faster than
+# np.cross() for (N,3) arrays.
+def cross_rows(a, b):
+    c = np.empty(np.broadcast_shapes(np.shape(a), np.shape(b)))
+    (ax, ay, az) = (a[..., 0], a[..., 1], a[..., 2])
+    (bx, by, bz) = (b[..., 0], b[..., 1], b[..., 2])
+    c[..., 0] = ay * bz - az * by
+    c[..., 1] = az * bx - ax * bz
+    c[..., 2] = ax * by - ay * bx
+    return c
+
+# Scale rows longer than max_length (scalar or (...) array) to that length
+# (see Vec3.truncate()).
+def truncate_rows(a, max_length):
+    length = length_rows(a)
+    scale = np.where(length <= max_length, 1,
+                     max_length / np.where(length > 0, length, 1))
+    return a * scale[..., None]
+
+# Array version of unit_sigmoid_on_01() (and logistic()) for NumPy arrays.
+def unit_sigmoid_on_01_array(x):
+    x = np.maximum(x, -50)
+    return 1 / (1 + np.exp(-12 * (x - 0.5)))
+
 # Takes a 32 bit value and shuffles it around to produce a new 32 bit value.
 # "Robert Jenkins' 32 bit integer hash function" from "Integer Hash Function"
 # (1997) by Thomas Wang (https://gist.github.com/badboy/6267743)
@@ -126,16 +174,19 @@ class Blender:
 # Measure the execution time of a given "work load" function (of no arguments)
 # and an optional suggested repetition count.
 def executions_per_second(work_load, count=2000):
+    seconds = seconds_per_execution(work_load, count)
+    executions_per_second = 1 / seconds
+    print('seconds_per_execution =', seconds)
+    print('executions_per_second =', executions_per_second)
+    return executions_per_second
+
+# Average seconds per call of a given "work load" function (of no arguments)
+# over "count" calls, without logging (see microbenchmark.py).
+def seconds_per_execution(work_load, count=2000):
     start = time.perf_counter()
     for i in range(count):
         work_load()
-    elapsed_seconds = time.perf_counter() - start
-    
-    executions_per_second = count / elapsed_seconds
-    seconds_per_execution = 1 / executions_per_second
-    print('seconds_per_execution =', seconds_per_execution)
-    print('executions_per_second =', executions_per_second)
-    return executions_per_second
+    return (time.perf_counter() - start) / count
 
 
 @staticmethod
@@ -160,6 +211,19 @@ def unit_test():
     assert unit_sigmoid_on_01(0.5) == 0.5
     assert within_epsilon(unit_sigmoid_on_01(-1000), 0)
     assert within_epsilon(unit_sigmoid_on_01(+1000), 1)
+    x = np.array([-1000, 0, 0.25, 0.5, 1, 1000])
+    assert np.allclose(unit_sigmoid_on_01_array(x),
+                       [unit_sigmoid_on_01(v) for v in x])
+
+    rows = np.array([[3, 0, 4], [0, 0, 0], [1, 2, 2]], dtype=np.float64)
+    assert np.array_equal(dot_rows(rows, rows), [25, 0, 9])
+    assert np.array_equal(length_rows(rows), [5, 0, 3])
+    assert np.allclose(normalize_rows_or_0(rows),
+                       [[0.6, 0, 0.8], [0, 0, 0], [1/3, 2/3, 2/3]])
+    assert np.array_equal(cross_rows(rows, rows[[2, 0, 1]]),
+                          np.cross(rows, rows[[2, 0, 1]]))
+    assert np.allclose(truncate_rows(rows, 4), [[2.4, 0, 3.2], [0, 0, 0],
+                                                [1, 2, 2]])
 
     assert remap_interval(1.5, 1, 2, 20, 30) == 25
     assert remap_interval(1.5, 2, 1, 30, 20) == 25
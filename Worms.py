@@ -0,0 +1,91 @@
+#-------------------------------------------------------------------------------
+#
+# Worms.py -- new flock experiments
+#
+# "Spacetime boid worms": trails of boid bodies over the last frame_count
+# frames. Each frame's triangles are written into one slot of a fixed-size
+# circular buffer, overwriting the oldest frame in place. All slots are drawn
+# as one Open3D TriangleMesh whose triangle indices are made once. So memory,
+# and the size of each frame's upload to the GPU, stay constant however long
+# worms are drawn. Unused slots are all zero: degenerate triangles, not seen.
+# Optionally older frames fade toward the background color.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import open3d as o3d
+import numpy as np
+
+class Worms:
+    """Trails of past frames' triangles in a circular vertex buffer."""
+
+    # Keep frame_count frames. When "fade", colors shade toward "background"
+    # with age.
+    def __init__(self, frame_count=100, fade=True, background=(1, 1, 1)):
+        assert frame_count > 0
+        self.frame_count = frame_count
+        self.fade = fade
+        self.background = np.array(background, dtype=np.float64)
+        self.tri_mesh = o3d.geometry.TriangleMesh()
+        self.vertices = None    # (frame_count, triangles per frame, 3, 3)
+        self.colors = None
+        self.next = 0           # Slot for next frame.
+
+    # Forget all frames.
+    def clear(self):
+        if self.vertices is not None:
+            self.vertices[:] = 0
+            self.colors[:] = 0
+        self.next = 0
+
+    # Write one frame of (T,3,3) triangle vertices and (T,3,3) vertex colors
+    # over the oldest frame. Triangles per frame must stay the same, otherwise
+    # the buffer is reallocated and earlier frames forgotten.
+    def add_frame(self, vertices, colors):
+        if self.vertices is None or self.vertices.shape[1:] != vertices.shape:
+            shape = (self.frame_count,) + vertices.shape
+            self.vertices = np.zeros(shape)
+            self.colors = np.zeros(shape)
+            self.next = 0
+            self.tri_mesh.triangles = o3d.utility.Vector3iVector(
+                np.arange(self.vertices.size // 3,
+                          dtype=np.int32).reshape(-1, 3))
+        self.vertices[self.next] = vertices
+        self.colors[self.next] = colors
+        self.next = (self.next + 1) % self.frame_count
+
+    # Colors of each slot, faded by age (0 for newest frame) if "fade".
+    def faded_colors(self):
+        if not self.fade:
+            return self.colors
+        age = (self.next - 1 - np.arange(self.frame_count)) % self.frame_count
+        fraction = (age / self.frame_count)[:, None, None, None]
+        return self.colors + (self.background - self.colors) * fraction
+
+    # Write buffer to tri_mesh (same size every frame).
+    def update_mesh(self):
+        if self.vertices is not None:
+            self.tri_mesh.vertices = o3d.utility.Vector3dVector(
+                self.vertices.reshape(-1, 3))
+            self.tri_mesh.vertex_colors = o3d.utility.Vector3dVector(
+                self.faded_colors().reshape(-1, 3))
+
+    @staticmethod
+    def unit_test():
+        worms = Worms(frame_count=3, background=(1, 1, 1))
+        def frame(value):
+            return np.full((2, 3, 3), float(value))
+        for i in range(5):
+            worms.add_frame(frame(i), frame(0))
+        # Slots hold frames 3, 4, 2; frame 4 is newest.
+        assert [worms.vertices[s, 0, 0, 0] for s in range(3)] == [3, 4, 2]
+        colors = worms.faded_colors()
+        assert [colors[s, 0, 0, 0] for s in range(3)] == [1/3, 0, 2/3]
+        worms.update_mesh()
+        assert len(np.asarray(worms.tri_mesh.vertices)) == 3 * 2 * 3
+        assert len(np.asarray(worms.tri_mesh.triangles)) == 3 * 2
+        worms.clear()
+        assert not worms.vertices.any() and worms.next == 0
+        worms.add_frame(np.ones((4, 3, 3)), np.ones((4, 3, 3)))
+        assert worms.vertices.shape == (3, 4, 3, 3)
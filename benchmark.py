@@ -0,0 +1,234 @@
+#-------------------------------------------------------------------------------
+#
+# benchmark.py -- new flock experiments
+#
+# Scaling benchmark: time headless simulation (see headless.py) over a range of
+# flock sizes for each of Flock's pre-defined obstacle sets. For each obstacle
+# set, fits an empirical complexity curve (seconds per step ~ a * n^b) to the
+# measurements. The time for one call to Flock.stats() (as used by log_stats())
+# is measured and fitted the same way, as a separate series. Results can be
+# saved as a JSON baseline, then later runs are compared against it, flagging
+# any slowdown beyond a given threshold.
+#
+# Usage:
+#     python benchmark.py --save                   # Measure, write baseline.
+#     python benchmark.py                          # Measure, compare.
+#     python benchmark.py --object --save          # Same for object engine.
+#     python benchmark.py --counts 100 1000 --presets 0 3 --threshold 0.5
+#
+# Measurements depend on the machine, so a baseline is only meaningful for
+# comparisons on the machine where it was made. By default it uses the
+# vectorized engine (FlockState). The object engine (--object) is too slow for
+# 20,000 boids, so by default it is measured only up to 2000. The baseline file
+# holds results for each engine, saving one engine's results keeps the other's.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import io
+import os
+import sys
+import json
+import platform
+import contextlib
+import numpy as np
+import headless
+
+default_counts = [100, 200, 500, 1000, 2000, 5000, 10000, 20000]
+default_object_counts = [100, 200, 500, 1000, 2000]
+default_baseline = 'benchmark_baseline.json'
+
+# Time "steps" simulation steps for each boid count and each obstacle preset.
+# Returns a map with run settings and, for each preset, the seconds per step at
+# each count plus the fitted complexity curve, and the same for Flock.stats().
+def measure(counts=default_counts, presets=None, steps=20, fps=30,
+            seed=1234567890, vectorized=True, log=sys.stderr):
+    results = {'engine': 'vectorized' if vectorized else 'object',
+               'steps': steps,
+               'fps': fps,
+               'seed': seed,
+               'machine': platform.platform() + ' ' + platform.python_version(),
+               'presets': {}}
+    # When presets is None, all are measured, their number is known after the
+    # first run.
+    remaining = [0] if presets is None else list(presets)
+    while remaining:
+        preset = remaining.pop(0)
+        seconds_per_step = []
+        seconds_per_stats = []
+        for count in counts:
+            # Discard Flock's startup logging.
+            with contextlib.redirect_stderr(io.StringIO()):
+                run = headless.run(count, seed, preset, steps, fps, vectorized)
+            seconds_per_step.append(run['seconds'] / steps)
+            seconds_per_stats.append(run['stats_seconds'])
+            if log:
+                print('preset', preset, 'boids', count,
+                      'ms/step', ms(seconds_per_step[-1]),
+                      'ms/stats', ms(seconds_per_stats[-1]),
+                      file=log, flush=True)
+        results['presets'][str(preset)] = {
+            'obstacles': run['obstacles'],
+            'counts': list(counts),
+            'seconds_per_step': seconds_per_step,
+            'fit': fit_complexity(counts, seconds_per_step),
+            'seconds_per_stats': seconds_per_stats,
+            'stats_fit': fit_complexity(counts, seconds_per_stats)}
+        if presets is None and preset == 0:
+            remaining = list(range(1, run['preset_count']))
+    return results
+
+# Fit an empirical complexity curve to (boid count, seconds per step) data. The
+# power law t = coefficient * n^exponent is a least squares line in log-log
+# space. Also reports which of the usual models fits best (with a free constant
+# factor, again in log space).
+def fit_complexity(counts, seconds):
+    log_n = np.log(np.asarray(counts, dtype=np.float64))
+    log_t = np.log(np.asarray(seconds, dtype=np.float64))
+    if len(counts) < 2:
+        return {'exponent': None, 'coefficient': None, 'best_model': None}
+    (exponent, log_coefficient) = np.polyfit(log_n, log_t, 1)
+    models = {'n': log_n,
+              'n log n': log_n + np.log(log_n),
+              'n^2': 2 * log_n}
+    def residual(log_model):
+        offset = log_t - log_model
+        return float(((offset - offset.mean()) ** 2).sum())
+    best_model = min(models, key=lambda name: residual(models[name]))
+    return {'exponent': float(exponent),
+            'coefficient': float(np.exp(log_coefficient)),
+            'best_model': best_model}
+
+# The series measured for each preset: key of times, key of fitted curve, and
+# units for printing.
+series = [('seconds_per_step', 'fit', 'ms/step'),
+          ('seconds_per_stats', 'stats_fit', 'ms/stats')]
+
+# Compare results with a baseline (both as returned by measure()). Returns a
+# list of regressions, each a string describing a measurement (preset, count,
+# and series) which is more than "threshold" (as a fraction, 0.25 means 25%)
+# slower than in the baseline, or a fitted exponent more than "threshold"
+# larger (so 0.25 flags a change from n^1 to n^1.3).
+def compare(results, baseline, threshold=0.25):
+    regressions = []
+    for (preset, current) in results['presets'].items():
+        base = baseline['presets'].get(preset)
+        if base is None:
+            continue
+        for (times, fit, units) in series:
+            base_times = dict(zip(base['counts'], base[times]))
+            for (count, t) in zip(current['counts'], current[times]):
+                b = base_times.get(count)
+                if b and t > b * (1 + threshold):
+                    regressions.append('preset ' + preset + ', ' +
+                                       str(count) + ' boids: ' + ms(t) + ' ' +
+                                       units + ' vs ' + ms(b) +
+                                       ' baseline (' + str(round(t / b, 2)) +
+                                       'x)')
+            e = current[fit]['exponent']
+            b = base[fit]['exponent']
+            if e is not None and b is not None and e > b + threshold:
+                regressions.append('preset ' + preset + ': ' + units +
+                                   ' complexity exponent ' +
+                                   str(round(e, 2)) + ' vs ' +
+                                   str(round(b, 2)) + ' baseline')
+    return regressions
+
+# Seconds as a string of milliseconds.
+def ms(seconds):
+    return str(round(seconds * 1000, 3))
+
+# Print tables of results, one per series (ms/step, ms/stats): time per preset
+# and count, and fitted curve.
+def print_table(results, file=sys.stdout):
+    presets = results['presets']
+    counts = sorted({c for p in presets.values() for c in p['counts']})
+    for (times_key, fit_key, units) in series:
+        print(units + ' (' + results['engine'] + ' engine, ' +
+              str(results['steps']) + ' steps)', file=file)
+        print('preset' + ''.join([str(c).rjust(10) for c in counts]) +
+              '  exponent  best fit', file=file)
+        for (preset, p) in presets.items():
+            times = dict(zip(p['counts'], p[times_key]))
+            fit = p[fit_key]
+            print(preset.rjust(6) +
+                  ''.join([(ms(times[c]) if c in times else '').rjust(10)
+                           for c in counts]) +
+                  ('' if fit['exponent'] is None else
+                   str(round(fit['exponent'], 2)).rjust(10) + '  ' +
+                   fit['best_model']), file=file)
+
+def unit_test():
+    # Exact power laws are recovered by the fit.
+    counts = [100, 1000, 10000]
+    fit = fit_complexity(counts, [3e-6 * n ** 2 for n in counts])
+    assert abs(fit['exponent'] - 2) < 1e-9
+    assert abs(fit['coefficient'] - 3e-6) < 1e-12
+    assert fit['best_model'] == 'n^2'
+    fit = fit_complexity(counts, [2e-5 * n for n in counts])
+    assert fit['best_model'] == 'n'
+    # Only changes beyond threshold are regressions, in either series.
+    def results(times, stats_times=(0.001, 0.002, 0.004)):
+        return {'presets': {'0': {'counts': counts,
+                                  'seconds_per_step': times,
+                                  'fit': fit_complexity(counts, times),
+                                  'seconds_per_stats': stats_times,
+                                  'stats_fit': fit_complexity(counts,
+                                                              stats_times)}}}
+    baseline = results([0.001, 0.01, 0.1])
+    assert compare(results([0.0012, 0.01, 0.09]), baseline, 0.25) == []
+    assert len(compare(results([0.0013, 0.01, 0.1]), baseline, 0.25)) == 1
+    assert len(compare(results([0.001, 0.03, 0.9]), baseline, 0.25)) == 3
+    regressions = compare(results([0.001, 0.01, 0.1], [0.001, 0.002, 0.006]),
+                          baseline, 0.25)
+    assert len(regressions) == 1 and 'ms/stats' in regressions[0]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Flock scaling benchmark.')
+    parser.add_argument('--counts', type=int, nargs='+', default=None,
+                        help='boid counts to measure (default depends on '
+                             'engine).')
+    parser.add_argument('--presets', type=int, nargs='+', default=None,
+                        help='obstacle presets to measure (default: all).')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='simulation steps per measurement.')
+    parser.add_argument('--object', action='store_true',
+                        help='use object engine rather than vectorized.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown (fraction) reported as regression.')
+    parser.add_argument('--baseline', type=str, default=default_baseline,
+                        help='pathname of baseline JSON file.')
+    parser.add_argument('--save', action='store_true',
+                        help='write results as new baseline.')
+    args = parser.parse_args()
+    unit_test()
+    counts = args.counts or (default_object_counts if args.object
+                             else default_counts)
+    results = measure(counts, args.presets, args.steps,
+                      vectorized=not args.object)
+    print_table(results)
+    # Baseline file is a map from engine name to results for that engine.
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baselines = json.load(file)
+    if args.save:
+        baselines[results['engine']] = results
+        with open(args.baseline, 'w') as file:
+            json.dump(baselines, file, indent=4)
+        print('Saved', results['engine'], 'baseline:', args.baseline)
+    else:
+        baseline = baselines.get(results['engine'])
+        if baseline is None:
+            print('No', results['engine'], 'engine baseline in',
+                  args.baseline)
+            sys.exit(1)
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print('REGRESSION:', r)
+        print(len(regressions), 'regressions (threshold ' +
+              str(args.threshold) + ')')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,430 @@
+#-------------------------------------------------------------------------------
+#
+# codec.py -- new flock experiments
+#
+# Optional compressed encoding of flock recordings (see recording.py), for long
+# captures of big flocks. The file has the same magic number and JSON header as
+# a raw recording (with "encoding": "quantized") followed by one variable size
+# record per frame, then a frame index.
+#
+# Positions are quantized to 16 bit fixed point relative to the containment
+# sphere: q = round((position - center) / step), where step is position_range
+# (default twice the sphere radius) divided by 32767. Every keyframe_interval
+# frames a keyframe stores q and its per-frame delta v (q minus previous q) as
+# int16. Other frames store the change in delta since the previous frame (so a
+# boid moving at constant velocity has all zeros): as int8 when every change
+# fits, else int16, else the frame becomes a keyframe. Decoding then updates
+# v += change, q += v. Since these are differences of quantized values, that
+# sums integers exactly, and error does not accumulate. A frame with any boid
+# beyond position_range is stored raw as float64 (the next is a keyframe).
+#
+# Orientation (forward and up, both or neither) is stored as a unit quaternion,
+# "smallest three" encoded: index of the largest component (as uint8) and the
+# other three as int16 (they are at most 1/sqrt(2) in magnitude). Speed is
+# stored as float16.
+#
+# Maximum reconstruction error is guaranteed, and given in the header:
+# position: step/2 per coordinate; forward and up: max_orientation_error
+# (distance between unit vectors, about 1.5e-4); speed: a relative error of
+# 2^-11 (the precision of float16). Per boid: position is 3 bytes on a delta
+# frame (12 on a keyframe) versus 24 as float64; orientation is 7 bytes versus
+# 48; speed 2 versus 8. So 4-8x smaller than float64 (2-4x versus raw float32
+# recordings).
+#
+# Each record is an 8 byte prefix (its first byte is the record kind) then
+# blocks for position, orientation, and speed, padded to a multiple of 8 bytes.
+# On close, the byte offset of each record is written as a uint64 array, then a
+# trailer: b'FLOCKIDX', frame count, and offset of the index (both uint64). A
+# file without trailer (say cut short by a crash) is indexed by walking records
+# (their size depends only on kind). To read frame t: decode the keyframe at or
+# before t, then add the deltas up to t, so random access reads at most
+# keyframe_interval records. Sequential reading decodes one record per frame.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import os
+import math
+import struct
+import tempfile
+import numpy as np
+import Utilities as util
+import recording
+
+# Record kinds.
+keyframe = 0
+delta8 = 1
+delta16 = 2
+raw = 3
+
+index_magic = b'FLOCKIDX'
+prefix_bytes = 8
+quaternion_scale = 32767 * math.sqrt(2)   # Smallest three are <= 1/sqrt(2).
+
+# Bound on error of decoded forward and up vectors. Each of the smallest three
+# quaternion components is within h (half a quantization step) so those three
+# are within sqrt(3)*h, and the largest component (at least 1/2, from
+# sqrt(1 - sum of squares)) is within sqrt(3) times that. So the quaternion is
+# within 2*sqrt(3)*h, and a vector it rotates within twice that. Doubled again
+# for safety.
+max_orientation_error = 8 * math.sqrt(3) * (0.5 / quaternion_scale)
+
+# Convert orthonormal bases (N,3 arrays of side, up, and forward, the columns of
+# a rotation matrix) to (N,4) unit quaternions (w,x,y,z). Uses the formula
+# which is most accurate for each row, based on its largest component. Also
+# returns (N,) index of largest component.
+def bases_to_quaternions(side, up, forward):
+    (m00, m10, m20) = (side[:, 0], side[:, 1], side[:, 2])
+    (m01, m11, m21) = (up[:, 0], up[:, 1], up[:, 2])
+    (m02, m12, m22) = (forward[:, 0], forward[:, 1], forward[:, 2])
+    t = np.stack([1 + m00 + m11 + m22,
+                  1 + m00 - m11 - m22,
+                  1 - m00 + m11 - m22,
+                  1 - m00 - m11 + m22], axis=1)
+    largest = np.argmax(t, axis=1)
+    s = 2 * np.sqrt(np.maximum(t[np.arange(len(t)), largest], util.epsilon))
+    # For each choice of largest component: (w,x,y,z) times s.
+    candidates = np.stack(
+        [np.stack([s * s / 4, m21 - m12, m02 - m20, m10 - m01], axis=1),
+         np.stack([m21 - m12, s * s / 4, m01 + m10, m02 + m20], axis=1),
+         np.stack([m02 - m20, m01 + m10, s * s / 4, m12 + m21], axis=1),
+         np.stack([m10 - m01, m02 + m20, m12 + m21, s * s / 4], axis=1)])
+    q = candidates[largest, np.arange(len(t))] / s[:, None]
+    return (q, largest)
+
+# Convert (N,4) unit quaternions (w,x,y,z) to (N,3) arrays of up and forward
+# (the second and third columns of their rotation matrices).
+def quaternions_to_up_forward(q):
+    (w, x, y, z) = (q[:, 0], q[:, 1], q[:, 2], q[:, 3])
+    up = np.stack([2 * (x * y - w * z),
+                   1 - 2 * (x * x + z * z),
+                   2 * (y * z + w * x)], axis=1)
+    forward = np.stack([2 * (x * z + w * y),
+                        2 * (y * z - w * x),
+                        1 - 2 * (x * x + y * y)], axis=1)
+    return (up, forward)
+
+# Encode orientations given by (N,3) forward and up (up need not be exactly
+# perpendicular to forward) as "smallest three" quaternions: (N,3) int16 and
+# (N,) uint8 index of the omitted largest component.
+def encode_orientations(forward, up):
+    forward = util.normalize_rows(forward)
+    side = util.normalize_rows(util.cross_rows(up, forward))
+    up = util.cross_rows(forward, side)
+    (q, largest) = bases_to_quaternions(side, up, forward)
+    rows = np.arange(len(q))
+    # q and -q are the same rotation, choose the one with positive largest.
+    q *= np.where(q[rows, largest] < 0, -1, 1)[:, None]
+    others = (largest[:, None] + np.arange(1, 4)) % 4
+    small = np.rint(q[rows[:, None], others] * quaternion_scale)
+    return (small.astype('<i2'), largest.astype(np.uint8))
+
+# Inverse of encode_orientations(): returns (N,3) arrays of forward and up.
+def decode_orientations(small, largest):
+    largest = largest.astype(np.int64)
+    rows = np.arange(len(largest))
+    q = np.empty((len(largest), 4))
+    others = (largest[:, None] + np.arange(1, 4)) % 4
+    q[rows[:, None], others] = small / quaternion_scale
+    q[rows, largest] = np.sqrt(np.maximum(0, 1 - (q[rows[:, None], others] ** 2)
+                                          .sum(axis=1)))
+    (up, forward) = quaternions_to_up_forward(q)
+    return (forward, up)
+
+# True if all of an array's values are within +/- limit.
+def fits(array, limit):
+    return np.abs(array).max(initial=0) <= limit
+
+class QuantizedRecorder(recording.Recorder):
+    """Recorder which writes the quantized, delta encoded format."""
+
+    # Like Recorder, plus: keyframe_interval (frames between keyframes) and
+    # position_range (distance from sphere center which can be quantized,
+    # default twice the sphere radius).
+    def __init__(self, path, boid_count, fields=('position',),
+                 keyframe_interval=30, position_range=None, sphere_radius=50,
+                 sphere_center=(0, 0, 0), **kwargs):
+        self.keyframe_interval = keyframe_interval
+        self.origin = np.array(sphere_center, dtype=np.float64)
+        self.step = (position_range or 2 * sphere_radius) / 32767
+        self.previous = None     # Quantized positions of previous frame,
+        self.velocity = None     # and their change from the frame before.
+        self.offsets = []        # Byte offset of each frame's record.
+        self.kind_counts = [0, 0, 0, 0]
+        orientation = [f in fields for f in ('forward', 'up')]
+        assert all(orientation) or not any(orientation), \
+            'forward and up are recorded together'
+        super().__init__(path, boid_count, fields, sphere_radius=sphere_radius,
+                         sphere_center=sphere_center, **kwargs)
+        self.offset = self.file.tell()
+
+    # Header map for recording, with encoding parameters and error bounds.
+    def header(self, *args):
+        return dict(super().header(*args),
+                    encoding='quantized',
+                    keyframe_interval=self.keyframe_interval,
+                    position_origin=self.origin.tolist(),
+                    position_step=self.step,
+                    max_error={'position': self.step / 2,
+                               'forward': max_orientation_error,
+                               'up': max_orientation_error,
+                               'speed_relative': 2 ** -11})
+
+    # Encode and write one frame, given a map from field name to array.
+    def write_frame(self, arrays):
+        position = np.reshape(arrays['position'], (-1, 3))
+        q = np.rint((position - self.origin) / self.step)
+        kind = keyframe
+        if not fits(q, 32767):
+            (kind, block) = (raw, position.astype('<f8'))
+            (q, velocity) = (None, None)
+        elif (self.previous is not None and
+              len(self.offsets) % self.keyframe_interval != 0):
+            velocity = q - self.previous
+            change = velocity - self.velocity
+            if fits(change, 127):
+                (kind, block) = (delta8, change.astype(np.int8))
+            elif fits(change, 32767):
+                (kind, block) = (delta16, change.astype('<i2'))
+        if kind == keyframe:
+            velocity = np.zeros_like(q)
+            if self.previous is not None and fits(q - self.previous, 32767):
+                velocity = q - self.previous
+            block = np.concatenate([q, velocity]).astype('<i2')
+        (self.previous, self.velocity) = (q, velocity)
+        blocks = [bytes([kind]) + bytes(prefix_bytes - 1), block.tobytes()]
+        if 'forward' in self.fields:
+            (small, largest) = encode_orientations(
+                np.reshape(arrays['forward'], (-1, 3)),
+                np.reshape(arrays['up'], (-1, 3)))
+            blocks += [small.tobytes(), largest.tobytes()]
+        if 'speed' in self.fields:
+            blocks.append(np.ravel(arrays['speed']).astype('<f2').tobytes())
+        data = b''.join(blocks)
+        data += bytes(-len(data) % 8)
+        self.file.write(data)
+        self.offsets.append(self.offset)
+        self.offset += len(data)
+        self.kind_counts[kind] += 1
+        self.frame_count += 1
+
+    # Write frame index and trailer, then close file.
+    def close(self):
+        if not self.file.closed:
+            index_offset = self.file.tell()
+            self.file.write(np.array(self.offsets, dtype='<u8').tobytes())
+            self.file.write(index_magic + struct.pack('<QQ', len(self.offsets),
+                                                      index_offset))
+        super().close()
+
+    # Map of statistics: frames recorded, counts of each record kind, bytes of
+    # frame data, and ratio of the size of those frames as float64 to that.
+    def stats(self):
+        frame_bytes = self.offset - (self.offsets[0] if self.offsets else 0)
+        float64_bytes = 8 * self.width * self.boid_count * self.frame_count
+        return {'frames_recorded': self.frame_count,
+                'keyframes': self.kind_counts[keyframe],
+                'delta8_frames': self.kind_counts[delta8],
+                'delta16_frames': self.kind_counts[delta16],
+                'raw_frames': self.kind_counts[raw],
+                'frame_bytes': frame_bytes,
+                'compression_vs_float64':
+                    float64_bytes / frame_bytes if frame_bytes else 0}
+
+class QuantizedRecording:
+    """Read-only view of a quantized recording, decoding frames on demand."""
+
+    # Open recording file, map it into memory and read (or rebuild) its index.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            (self.header, self.data_offset) = recording.read_header(file)
+        assert self.header.get('encoding') == 'quantized'
+        self.boid_count = n = self.header['boid_count']
+        self.fields = [f for (f, w) in self.header['fields']]
+        self.time_step = self.header['time_step']
+        self.max_error = self.header['max_error']
+        self.origin = np.array(self.header['position_origin'])
+        self.step = self.header['position_step']
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        # Size of blocks after the prefix: position (by kind) then others.
+        other = ((7 * n if 'forward' in self.fields else 0) +
+                 (2 * n if 'speed' in self.fields else 0))
+        def padded(size):
+            return size + (-size % 8)
+        self.record_bytes = [padded(prefix_bytes + 3 * n * b + other)
+                             for b in (4, 1, 2, 8)]
+        self.offsets = self.read_index()
+        self.frame_count = len(self.offsets)
+        self.steps = np.arange(self.frame_count)  # Never has gaps.
+        self.kinds = self.data[self.offsets].astype(np.int64)
+        # For each frame, the most recent keyframe (or raw frame) at or before it.
+        starts = np.where((self.kinds == keyframe) | (self.kinds == raw),
+                          np.arange(self.frame_count), 0)
+        self.keyframe_of = np.maximum.accumulate(starts) if len(starts) else []
+        self.cached = None      # (frame index, quantized positions, deltas)
+
+    # (frames,) array of record offsets, from index if present, else by walking
+    # records up to the last complete one.
+    def read_index(self):
+        size = len(self.data)
+        trailer = self.data[size - 24 :].tobytes() if size >= 24 else b''
+        if trailer[:8] == index_magic:
+            (count, index_offset) = struct.unpack('<QQ', trailer[8:])
+            return np.frombuffer(self.data, dtype='<u8', count=count,
+                                 offset=index_offset).astype(np.int64)
+        offsets = []
+        offset = self.data_offset
+        while offset < size and self.data[offset] <= raw:
+            end = offset + self.record_bytes[self.data[offset]]
+            if end > size:
+                break
+            offsets.append(offset)
+            offset = end
+        return np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return self.frame_count
+
+    # Array of count values of type dtype at byte offset, from memory map.
+    def block(self, offset, dtype, count):
+        return np.frombuffer(self.data, dtype=dtype, count=count, offset=offset)
+
+    # (N*3,) int64 quantized positions for frame "index" (which must not be a
+    # raw frame): decode its keyframe then apply the following changes.
+    # Sequential access (from previous call) decodes just one record.
+    def quantized_positions(self, index):
+        start = self.keyframe_of[index]
+        count = 3 * self.boid_count
+        if self.cached and start <= self.cached[0] <= index:
+            (first, q, v) = (self.cached[0] + 1, self.cached[1].copy(),
+                             self.cached[2].copy())
+        else:
+            key = self.block(self.offsets[start] + prefix_bytes, '<i2',
+                             2 * count).astype(np.int64)
+            (first, q, v) = (start + 1, key[:count], key[count:])
+        for f in range(first, index + 1):
+            dtype = np.int8 if self.kinds[f] == delta8 else '<i2'
+            v += self.block(self.offsets[f] + prefix_bytes, dtype, count)
+            q += v
+        self.cached = (index, q, v)
+        return q
+
+    # (N,3) float64 positions for frame "index".
+    def decode_positions(self, index):
+        index = range(self.frame_count)[index]
+        offset = self.offsets[index] + prefix_bytes
+        if self.kinds[index] == raw:
+            p = self.block(offset, '<f8', 3 * self.boid_count)
+            return p.reshape(-1, 3).copy()
+        q = self.quantized_positions(index).reshape(-1, 3)
+        return self.origin + q * self.step
+
+    # Map from field name to array for one frame.
+    def frame(self, index):
+        index = range(self.frame_count)[index]
+        n = self.boid_count
+        result = {'position': self.decode_positions(index)}
+        offset = (self.offsets[index] + prefix_bytes +
+                  3 * n * [4, 1, 2, 8][self.kinds[index]])
+        if 'forward' in self.fields:
+            small = self.block(offset, '<i2', 3 * n).reshape(-1, 3)
+            largest = self.block(offset + 6 * n, np.uint8, n)
+            (result['forward'], result['up']) = decode_orientations(small,
+                                                                    largest)
+            offset += 7 * n
+        if 'speed' in self.fields:
+            result['speed'] = self.block(offset, '<f2', n).astype(np.float64)
+        return {f: result[f] for f in self.fields}
+
+    # Sequence of one field's value for each frame, decoded when indexed.
+    def field(self, name):
+        assert name in self.fields, 'field not recorded: ' + name
+        return FieldFrames(self, name)
+
+    # Sequence of (N,3) positions of all boids on each frame.
+    @property
+    def positions(self):
+        return self.field('position')
+
+class FieldFrames:
+    """Frames of one field of a QuantizedRecording, as a lazy sequence."""
+
+    def __init__(self, recording, name):
+        self.recording = recording
+        self.name = name
+
+    def __len__(self):
+        return len(self.recording)
+
+    def __getitem__(self, index):
+        if self.name == 'position':
+            return self.recording.decode_positions(index)
+        return self.recording.frame(index)[self.name]
+
+def unit_test():
+    rng = np.random.default_rng(1234567890)
+    # Round trip of orientations, including 180 degree rotations (w=0).
+    forward = util.normalize_rows(rng.normal(size=(1000, 3)))
+    up = util.normalize_rows(util.cross_rows(forward, rng.normal(size=(1000, 3))))
+    forward[:3] = [[0, 0, -1], [0, 0, 1], [-1, 0, 0]]
+    up[:3] = [[0, -1, 0], [0, 1, 0], [0, 1, 0]]
+    (f, u) = decode_orientations(*encode_orientations(forward, up))
+    assert util.length_rows(f - forward).max() < max_orientation_error
+    assert util.length_rows(u - up).max() < max_orientation_error
+    # 20 boids with slowly changing velocity. One jumps out of range and back,
+    # another jumps too far for an int8 change (there and back again).
+    n = 20
+    frames = []
+    position = rng.uniform(-40, 40, (n, 3))
+    velocity = rng.normal(scale=0.3, size=(n, 3))
+    for i in range(100):
+        velocity += rng.normal(scale=0.01, size=(n, 3))
+        position = position + velocity
+        position[0] = [0, 0, 150 if 50 <= i < 52 else 0]
+        position[1] += 2 if i == 70 else 0
+        forward = util.normalize_rows(rng.normal(size=(n, 3)))
+        up = util.normalize_rows(util.cross_rows(forward,
+                                                 rng.normal(size=(n, 3))))
+        frames.append({'position': position, 'forward': forward, 'up': up,
+                       'speed': rng.uniform(0, 20, n)})
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.flockq')
+        recorder = QuantizedRecorder(path, n, ['up', 'speed', 'forward'],
+                                     keyframe_interval=16, sphere_radius=50,
+                                     sphere_center=(0, 0, 0), seed=123)
+        for frame in frames:
+            recorder.write_frame(frame)
+        recorder.file.flush()
+        # Until closed, there is no index, records are walked instead.
+        recorder.file.write(b'\0' * 5)
+        recorder.file.flush()
+        assert len(QuantizedRecording(path)) == 100
+        recorder.close()
+        stats = recorder.stats()
+        assert stats['raw_frames'] == 2
+        assert stats['keyframes'] == 8  # 7 by interval, 1 after raw frames.
+        # Before and after the jump (70, 71), and after keyframes which had no
+        # previous frame so no delta (1, 53).
+        assert stats['delta16_frames'] == 4
+        assert stats['compression_vs_float64'] > 5
+        playback = QuantizedRecording(path)
+        assert playback.fields == ['position', 'up', 'speed', 'forward']
+        assert playback.header['seed'] == 123 and len(playback) == 100
+        error = playback.max_error
+        # Random access, in both directions, is within the error bounds.
+        for i in [99, 0, 50, 51, 52, 70, 33, 34, 35, 17, 98]:
+            frame = playback.frame(i)
+            assert np.abs(frame['position'] -
+                          frames[i]['position']).max() <= error['position']
+            assert np.array_equal(playback.positions[i], frame['position'])
+            for name in ('forward', 'up'):
+                assert (util.length_rows(frame[name] -
+                                         frames[i][name]).max() <= error[name])
+            assert np.all(np.abs(frame['speed'] - frames[i]['speed']) <=
+                          frames[i]['speed'] * error['speed_relative'])
+        # Sequential decoding matches random access.
+        assert np.array_equal(playback.positions[40],
+                              QuantizedRecording(path).positions[40])
+        del playback  # Release memory map before directory is removed.
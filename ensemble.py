@@ -0,0 +1,247 @@
+#-------------------------------------------------------------------------------
+#
+# ensemble.py -- new flock experiments
+#
+# Run an ensemble of headless flock simulations (see headless.py): the same
+# scenario over many random seeds and many sets of tuning parameters, to study
+# robustness. Runs are spread over a pool of worker processes (by default one
+# per core). Results of each run are yielded as soon as it finishes, then the
+# whole ensemble is summarized in one table, a row per parameter set giving
+# distributions of avoid_fail, stalls, and min separation over seeds.
+#
+# Each run constructs its own Flock, which calls Draw.set_random_seeds() with
+# that run's seed, so results do not depend on which worker does a run, or in
+# what order.
+#
+# Alternatively, in "lockstep" mode (see run_lockstep()) all runs are simulated
+# together in one process as a single EnsembleState, sharing each step's
+# interpreter overhead. Better for many small flocks, particularly on one core.
+#
+# Usage:
+#     python ensemble.py --seeds 8 --parameter weight_separate=18,23,28 \
+#                                  --parameter min_time_to_collide=0.6,0.8
+#     python ensemble.py --seeds 100 --boids 50 --lockstep
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import io
+import sys
+import json
+import itertools
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import headless
+from Draw import Draw
+from flock import Flock
+from EnsembleState import EnsembleState
+
+# List of runs (each a map of keyword arguments for headless.run()) for each
+# combination of seed and parameter set (a map from parameter name to value,
+# see Flock.set_parameters()). Other settings (boid_count, preset, steps, fps,
+# vectorized) are shared by all runs.
+def make_runs(seeds, parameter_sets=None, **settings):
+    return [dict(settings, seed=seed, parameters=parameters)
+            for (parameters, seed) in itertools.product(parameter_sets or [{}],
+                                                        seeds)]
+
+# List of parameter sets for every combination of the given values, from a map
+# of parameter name to list of values.
+def parameter_grid(values):
+    names = list(values)
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*[values[n] for n in names])]
+
+# Run in worker process: one headless simulation, with its logging discarded.
+def run_one(run):
+    with contextlib.redirect_stderr(io.StringIO()):
+        return headless.run(**run)
+
+# Generator of results (as returned by headless.run()) in order of completion,
+# for the given list of runs, spread over max_workers processes (default: one
+# per core).
+def run_ensemble(runs, max_workers=None):
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(run_one, run) for run in runs]
+        for future in as_completed(futures):
+            yield future.result()
+
+# Simulate all runs at once, in lockstep, as one EnsembleState. Runs may differ
+# in seed, parameters, and preset but share boid_count, steps, and fps (and
+# use the vectorized engine). Returns a list of results like those of
+# headless.run(), but with steps_per_second for the whole ensemble, and stats
+# only for metrics provided by EnsembleState.stats().
+def run_lockstep(runs):
+    first = runs[0]
+    (boid_count, steps, fps) = [first.get(name, default) for (name, default)
+                                in [('boid_count', 200), ('steps', 1000),
+                                    ('fps', 30)]]
+    for run in runs:
+        assert run.get('boid_count', 200) == boid_count
+        assert run.get('steps', 1000) == steps and run.get('fps', 30) == fps
+    Draw.enable = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        flock = Flock(boid_count=boid_count, fixed_time_step=True,
+                      fixed_fps=fps)
+    state = EnsembleState(flock,
+                          [run.get('seed', 1234567890) for run in runs],
+                          [run.get('parameters') or {} for run in runs],
+                          [run.get('preset', 0) for run in runs])
+    # Like headless.run(): statistics sampled every 100 steps and at end.
+    min_sep = np.full(len(runs), np.inf)
+    elapsed = 0
+    for step in range(1, steps + 1):
+        start = time.perf_counter()
+        state.fly_flock(1 / fps)
+        elapsed += time.perf_counter() - start
+        if step % 100 == 0 or step == steps:
+            stats = state.stats()
+            min_sep = np.minimum(min_sep, stats['min_sep'])
+    steps_per_second = steps / elapsed if elapsed > 0 else 0
+    return [{'boids': boid_count,
+             'seed': run.get('seed', 1234567890),
+             'preset': run.get('preset', 0),
+             'steps': steps,
+             'fps': fps,
+             'vectorized': True,
+             'seconds': elapsed,
+             'steps_per_second': steps_per_second,
+             'boid_steps_per_second':
+                 steps_per_second * boid_count * len(runs),
+             'parameters': run.get('parameters') or {},
+             'stats': {name: value[b].item() for (name, value) in
+                       stats.items()},
+             'min_sep_sampled': min_sep[b].item()}
+            for (b, run) in enumerate(runs)]
+
+# Summarize results of an ensemble: a list of rows, one per parameter set (in
+# order first seen), each with number of runs and a distribution summary (see
+# distribution()) of each metric over those runs.
+def aggregate(results):
+    groups = {}
+    for r in results:
+        key = json.dumps(r['parameters'], sort_keys=True)
+        groups.setdefault(key, []).append(r)
+    rows = []
+    for group in groups.values():
+        def metric(get):
+            return distribution([get(r) for r in group])
+        rows.append({'parameters': group[0]['parameters'],
+                     'runs': len(group),
+                     'avoid_fail': metric(lambda r: r['stats']['avoid_fail']),
+                     'stalls': metric(lambda r: r['stats']['stalls']),
+                     'min_sep': metric(lambda r: r['min_sep_sampled'])})
+    return rows
+
+# Map of summary statistics for a list of values.
+def distribution(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {'mean': float(values.mean()),
+            'min': float(values.min()),
+            'p10': float(np.percentile(values, 10)),
+            'median': float(np.median(values)),
+            'max': float(values.max())}
+
+# Print one line for a finished run.
+def print_run(result, file=sys.stdout):
+    stats = result['stats']
+    print('seed=' + str(result['seed']) +
+          ''.join([', ' + n + '=' + str(v)
+                   for (n, v) in result['parameters'].items()]) +
+          ': avoid_fail=' + str(stats['avoid_fail']) +
+          ', stalls=' + str(stats['stalls']) +
+          ', min_sep=' + str(result['min_sep_sampled'])[0:5] +
+          ', steps/sec=' + str(round(result['steps_per_second'], 1)),
+          file=file, flush=True)
+
+# Print table of aggregated results from aggregate().
+def print_table(rows, file=sys.stdout):
+    statistics = ['mean', 'min', 'median', 'max']
+    def dist(d):
+        return ''.join([str(round(d[s], 2)).rjust(8) for s in statistics])
+    metrics = ['avoid_fail', 'stalls', 'min_sep']
+    print('    ' + ''.join(['  ' + m.center(32, '-') for m in metrics]),
+          file=file)
+    print('runs' + ('  ' + ''.join([s.rjust(8) for s in statistics])) * 3 +
+          '  parameters', file=file)
+    for row in rows:
+        print(str(row['runs']).rjust(4) + '  ' +
+              dist(row['avoid_fail']) + '  ' +
+              dist(row['stalls']) + '  ' +
+              dist(row['min_sep']) + '  ' +
+              json.dumps(row['parameters']), file=file)
+
+def unit_test():
+    grid = parameter_grid({'a': [1, 2], 'b': [3]})
+    assert grid == [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]
+    runs = make_runs([5, 6, 7], grid, steps=10)
+    assert len(runs) == 6
+    assert runs[0] == {'steps': 10, 'seed': 5, 'parameters': {'a': 1, 'b': 3}}
+    def result(parameters, avoid_fail, min_sep):
+        return {'parameters': parameters,
+                'stats': {'avoid_fail': avoid_fail, 'stalls': 0},
+                'min_sep_sampled': min_sep}
+    rows = aggregate([result({'a': 1}, 3, 0.5),
+                      result({'a': 2}, 0, 1.0),
+                      result({'a': 1}, 5, 0.7)])
+    assert [r['runs'] for r in rows] == [2, 1]
+    assert rows[0]['avoid_fail']['mean'] == 4
+    assert rows[0]['min_sep']['min'] == 0.5
+    assert rows[1]['stalls']['max'] == 0
+    # Lockstep ensemble gives the same statistics as separate runs.
+    runs = make_runs([5, 6], boid_count=20, steps=20, vectorized=True)
+    for (lockstep, separate) in zip(run_lockstep(runs), map(run_one, runs)):
+        assert lockstep['min_sep_sampled'] == separate['min_sep_sampled']
+        for (name, value) in lockstep['stats'].items():
+            assert value == separate['stats'][name], name
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run ensemble of flocks.')
+    parser.add_argument('--seeds', type=int, default=4,
+                        help='number of random seeds per parameter set.')
+    parser.add_argument('--first_seed', type=int, default=1234567890,
+                        help='first seed, others follow consecutively.')
+    parser.add_argument('--parameter', type=str, action='append', default=[],
+                        help='name=value1,value2,... (may be repeated).')
+    parser.add_argument('--boids', type=int, default=200,
+                        help='number of boids in flock.')
+    parser.add_argument('--preset', type=int, default=0,
+                        help='index of pre-defined obstacle set.')
+    parser.add_argument('--steps', type=int, default=1000,
+                        help='number of simulation steps.')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='use NumPy array engine (see FlockState.py).')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: cores).')
+    parser.add_argument('--lockstep', action='store_true',
+                        help='simulate all runs together in one process.')
+    parser.add_argument('--json', type=str, default=None,
+                        help='pathname for JSON file of all results.')
+    args = parser.parse_args()
+    unit_test()
+    values = {}
+    for p in args.parameter:
+        (name, value_list) = p.split('=')
+        values[name] = [float(v) for v in value_list.split(',')]
+    runs = make_runs(range(args.first_seed, args.first_seed + args.seeds),
+                     parameter_grid(values),
+                     boid_count=args.boids,
+                     preset=args.preset,
+                     steps=args.steps,
+                     vectorized=args.vectorized)
+    results = []
+    for result in (run_lockstep(runs) if args.lockstep else
+                   run_ensemble(runs, args.workers)):
+        print_run(result)
+        results.append(result)
+    print()
+    rows = aggregate(results)
+    print_table(rows)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'runs': results, 'aggregate': rows}, file, indent=4)
@@ -18,7 +18,7 @@
 
 import sys
 import math
-import itertools
+import numpy as np
 import open3d as o3d
 from Vec3 import Vec3
 from Boid import Boid
@@ -30,7 +30,19 @@ from LocalSpace import LocalSpace
 from obstacle import EvertedSphereObstacle
 from obstacle import PlaneObstacle
 from obstacle import CylinderObstacle
+from SpatialHash import SpatialHash
+from FlockState import FlockState
+from PhaseTimer import PhaseTimer
+from MeshBuilder import MeshBuilder
+from BoidBodies import BoidBodies
+from Worms import Worms
 import shape
+import obstacle
+import knn
+import steering
+import recording
+import codec
+import look_at
 
 class Flock:
     def __init__(self,
@@ -40,7 +52,14 @@ class Flock:
                  max_simulation_steps = math.inf,
                  fixed_time_step = False,
                  fixed_fps = 60,
-                 seed = 1234567890):
+                 seed = 1234567890,
+                 vectorized = False,
+                 worm_frames = 100,
+                 worm_fade = True,
+                 incremental_neighbor_refresh = False,
+                 phase_timing = False,
+                 record = None,
+                 record_fields = ('position',)):
         self.boid_count = boid_count              # Number of boids in Flock.
         self.sphere_radius = sphere_diameter / 2  # Radius of boid containment.
         self.sphere_center = sphere_center        # Center of boid containment.
@@ -64,10 +83,41 @@ class Flock:
         self.obstacle_presets = self.pre_defined_obstacle_sets()
         self.obstacle_selection_counter = 0
         self.total_stalls = 0
+        # Nearest neighbor search: "batch" finds neighbors for all boids due
+        # for a refresh in one vectorized call per step (see knn.py), "grid"
+        # does a query per boid on a uniform spatial hash grid.
+        self.neighbor_search = 'batch'
+        self.spatial_hash = SpatialHash(target_occupancy=3)
+        self.prefetched_neighbors = {}  # Map from Boid to list of neighbors.
+        # When True, boids' scheduled neighbor refreshes re-rank neighbors of
+        # neighbors, with occasional full searches (see Boid.py). Not supported
+        # by the vectorized engine.
+        self.incremental_neighbor_refresh = incremental_neighbor_refresh
+        # When True, boid state is kept in NumPy arrays and each simulation
+        # step is computed for all boids at once (see FlockState.py).
+        self.vectorized = vectorized
+        self.state = None
+        # Per-phase timing of each frame (see PhaseTimer.py and timing_stats()),
+        # when phase_timing is True or a trace is requested by trace_frames().
+        self.timer = PhaseTimer(enable=phase_timing)
+        # When not None, a Recorder which saves each step (see recording.py).
+        self.recorder = None
+        # When not None, run() records the flock to a file at this path, with
+        # these fields, starting after boids and obstacles are made.
+        self.record = record
+        self.record_fields = record_fields
+        # Mesh of all boid bodies (see BoidBodies.py) and, for the boids it was
+        # made for, their colors, body radii, and index in self.boids.
+        self.boid_bodies = BoidBodies()
+        self.boid_draw_cache = None
+        # Trails of recent boid bodies, when Draw.clear_dynamic_mesh is off:
+        # the last worm_frames frames, fading with age if worm_fade.
+        self.worms = Worms(frame_count=worm_frames, fade=worm_fade)
         # If there is ever a need to have multiple Flock instances at the same
-        # time, these steps with global effect should be reconsidered:
-        Draw.set_random_seeds(seed)
+        # time, these steps with global effect should be reconsidered. (Seeded
+        # after unit tests, so they may use random numbers freely.)
         self.setup()
+        Draw.set_random_seeds(seed)
 
     # Run boids simulation.
     def run(self):
@@ -75,26 +125,38 @@ class Flock:
         Draw.start_visualizer(self.sphere_radius, self.sphere_center)
         Flock.vis_pairs.add_pair(Draw.vis, self)  # Pairing for key handlers.
         self.register_single_key_commands() # For Open3D visualizer GUI.
+        if Draw.enable:
+            Draw.vis.add_geometry(self.boid_bodies.tri_mesh, False)
+            Draw.vis.add_geometry(self.worms.tri_mesh, False)
         self.make_boids(self.boid_count, self.sphere_radius, self.sphere_center)
         self.draw()
         self.cycle_obstacle_selection()
+        if self.record:
+            self.start_recording(self.record, self.record_fields,
+                                 streaming=True)
         while self.still_running():
             if self.run_simulation_this_frame():
                 Draw.clear_scene()
-                self.fly_flock(1 / self.fixed_fps
-                               if self.fixed_time_step or not Draw.enable
-                               else Draw.frame_duration)
+                with self.timer.span('fly_flock'):
+                    self.fly_flock(1 / self.fixed_fps
+                                   if self.fixed_time_step or not Draw.enable
+                                   else Draw.frame_duration)
                 ################################################################
                 # TODO 20240218 Signed distance function.
 #                self.sphere_wrap_around()
                 ################################################################
-                self.draw()
-                Draw.update_scene()
+                with self.timer.span('draw'):
+                    self.draw()
+                with self.timer.span('update_scene'):
+                    Draw.update_scene()
                 if not self.simulation_paused:
                     Draw.measure_frame_duration()
-                self.log_stats()
+                with self.timer.span('log_stats'):
+                    self.log_stats()
                 self.update_fps()
+                self.timer.end_frame()
         Draw.close_visualizer()
+        self.stop_recording()
         print('Exit at step:', Draw.frame_counter)
 
     # Populate this flock by creating "count" boids with uniformly distributed
@@ -106,14 +168,39 @@ class Flock:
             self.init_boid(boid, radius, center)
             self.boids.append(boid)
         # Initialize per-Boid cached_nearest_neighbors. Randomize time stamp.
+        n = max([b.full_neighbor_search_count() for b in self.boids], default=7)
+        self.prefetched_neighbors = self.batch_nearest_neighbors(self.boids, n)
         for b in self.boids:
             b.recompute_nearest_neighbors()
             t = util.frandom01() * b.neighbor_refresh_rate
             b.time_since_last_neighbor_refresh = t
+        if self.vectorized:
+            self.state = FlockState(self)
+
+    # Set tuning parameters from a map of name to value. A name may be an
+    # attribute of Flock (like min_time_to_collide) or of Boid (like
+    # weight_separate or max_dist_align), set on every boid in the flock, or
+    # both (see boid_options).
+    def set_parameters(self, parameters):
+        for (name, value) in parameters.items():
+            if hasattr(self, name):
+                setattr(self, name, value)
+            if name in Flock.boid_options or not hasattr(self, name):
+                assert self.boids and hasattr(self.boids[0], name), name
+                for b in self.boids:
+                    setattr(b, name, value)
+        assert not (self.state and self.incremental_neighbor_refresh)
+        if self.state:
+            self.state.gather_parameters()
+
+    # Flock attributes which are also set on each of its boids.
+    boid_options = ['incremental_neighbor_refresh']
 
     def init_boid(self, boid, radius, center):
         boid.sphere_radius = radius
         boid.sphere_center = center
+        for name in Flock.boid_options:
+            setattr(boid, name, getattr(self, name))
         
         # uniform over whole sphere enclosure
         #    boid.ls = boid.ls.randomize_orientation()
@@ -135,66 +222,223 @@ class Flock:
                                self.tracking_camera else Vec3())
             for o in self.obstacles:
                 o.draw()
-            for boid in self.boids:
-                boid.draw(color=(Vec3(0, 1, 0) if
-                                 self.is_neighbor_of_selected(boid) else None))
-
-    def is_neighbor_of_selected(self, boid):
-        return (self.enable_annotation and
-                self.tracking_camera and
-                self.selected_boid().is_neighbor(boid))
+            self.draw_boid_bodies()
+
+    # Draw all boid bodies with one batched transform (see BoidBodies.py).
+    # Neighbors of the selected boid are green when annotating. For "spacetime
+    # boid worms" (when Draw.clear_dynamic_mesh is off) bodies are also added
+    # to the circular buffer of recent frames in self.worms.
+    def draw_boid_bodies(self):
+        if not (self.boid_draw_cache and self.boid_draw_cache[0] == self.boids):
+            self.boid_draw_cache = (
+                list(self.boids),
+                np.array([b.color.asarray() for b in self.boids]).reshape(-1, 3),
+                np.array([b.body_radius for b in self.boids]),
+                {id(b): i for (i, b) in enumerate(self.boids)})
+        (colors, radius, index) = self.boid_draw_cache[1:]
+        if self.enable_annotation and self.tracking_camera:
+            colors = colors.copy()
+            for n in self.selected_boid().cached_nearest_neighbors:
+                colors[index[id(n)]] = (0, 1, 0)
+        arrays = self.boid_arrays()
+        vertices = self.boid_bodies.update(
+            arrays['position'] - Draw.temp_camera_lookat.asarray(),
+            arrays['side'], arrays['up'], arrays['forward'], radius, colors)
+        Draw.vis.update_geometry(self.boid_bodies.tri_mesh)
+        if not Draw.clear_dynamic_mesh:
+            body_colors = self.boid_bodies.vertex_colors()
+            self.worms.add_frame(vertices.reshape(-1, 3, 3),
+                                 body_colors.reshape(-1, 3, 3))
+            self.worms.update_mesh()
+            Draw.vis.update_geometry(self.worms.tri_mesh)
 
     # Fly each boid in flock for one simulation step. Consists of two sequential
     # steps to avoid artifacts from order of boids. First a "sense/plan" phase
     # which computes the desired steering based on current state. Then an "act"
     # phase which actually moves the boids.
     def fly_flock(self, time_step):
-        for boid in self.boids:
-            boid.plan_next_steer(time_step)
-        for boid in self.boids:
-            boid.apply_next_steer(time_step)
-        for boid in self.boids:
-            if boid.speed < (boid.min_speed - util.epsilon):
-                self.total_stalls += 1
+        if self.state:
+            self.total_stalls += self.state.fly_flock(time_step)
+        else:
+            with self.timer.span('neighbors'):
+                self.prepare_neighbor_search(time_step)
+            with self.timer.span('steer'):
+                for boid in self.boids:
+                    boid.plan_next_steer(time_step)
+            with self.timer.span('integrate'):
+                for boid in self.boids:
+                    boid.apply_next_steer(time_step)
+            for boid in self.boids:
+                if boid.speed < (boid.min_speed - util.epsilon):
+                    self.total_stalls += 1
+        if self.recorder:
+            with self.timer.span('record'):
+                self.recorder.record(self)
+
+    # Called before each step's sense/plan phase. For "grid" neighbor search,
+    # rebuild the spatial hash. For "batch", find neighbors of all boids which
+    # will need a full search this step, to be handed out by nearest_neighbors().
+    def prepare_neighbor_search(self, time_step):
+        if self.neighbor_search == 'grid':
+            self.spatial_hash.rebuild(self.boids)
+        else:
+            due = [b for b in self.boids
+                   if b.full_neighbor_search_due(time_step)]
+            n = max([b.full_neighbor_search_count() for b in due], default=7)
+            self.prefetched_neighbors = self.batch_nearest_neighbors(due, n)
+
+    # Returns a list of the n boids nearest the given one. Normally prefetched
+    # (perhaps more than n, sorted by distance), otherwise search from scratch.
+    def nearest_neighbors(self, boid, n=7):
+        neighbors = self.prefetched_neighbors.pop(boid, None)
+        if neighbors is None or len(neighbors) < min(n, len(self.boids) - 1):
+            if self.neighbor_search == 'grid':
+                neighbors = self.spatial_hash.nearest_neighbors(boid, n)
+            else:
+                neighbors = self.batch_nearest_neighbors([boid], n)[boid]
+        return neighbors[:n]
+
+    # Given a list of boids, return a map from each to a list of its n nearest
+    # neighbors in this flock, computed in one vectorized call.
+    def batch_nearest_neighbors(self, boids, n=7):
+        result = {}
+        if boids:
+            index = {b: i for (i, b) in enumerate(self.boids)}
+            queries = [index[b] for b in boids]
+            nn = knn.k_nearest_neighbors(self.boid_positions(), n, queries)
+            for (b, row) in zip(boids, nn.tolist()):
+                result[b] = [self.boids[i] for i in row]
+        return result
+
+    # Map from name ('position', 'side', 'forward', 'up', 'speed') to (N,3) or
+    # (N,) array of that property for all boids.
+    def boid_arrays(self):
+        if self.state:
+            state = self.state
+            return {'position': state.position, 'side': state.side,
+                    'forward': state.forward, 'up': state.up,
+                    'speed': state.speed}
+        def gather(name):
+            return np.array([getattr(b, name).asarray() for b in self.boids],
+                            dtype=np.float64).reshape(-1, 3)
+        return {'position': self.boid_positions(),
+                'side': gather('side'),
+                'forward': gather('forward'),
+                'up': gather('up'),
+                'speed': np.array([b.speed for b in self.boids])}
+
+    # Start recording each simulation step to a file at the given path (see
+    # recording.py). Always records positions, "fields" may add 'forward',
+    # 'up', and 'speed'. When "streaming" the file is written on a background
+    # thread (see StreamingRecorder for its options, like chunk_frames). When
+    # "quantized" it is compressed (see QuantizedRecorder in codec.py, for
+    # options like keyframe_interval). Other keyword arguments are added to the
+    # recording's header. Call after make_boids(), the recording's boid count
+    # is fixed when it starts.
+    def start_recording(self, path, fields=('position',), streaming=False,
+                        quantized=False, **options):
+        assert self.boids, 'start_recording() before make_boids()'
+        self.stop_recording()
+        assert not (streaming and quantized)
+        recorder_class = (recording.StreamingRecorder if streaming else
+                          codec.QuantizedRecorder if quantized else
+                          recording.Recorder)
+        self.recorder = recorder_class(
+            path, len(self.boids), fields,
+            time_step=1 / self.fixed_fps,
+            sphere_radius=self.sphere_radius,
+            sphere_center=self.sphere_center.asarray().tolist(),
+            obstacles=[str(o) for o in self.obstacles], **options)
+
+    # Finish recording, if any. Returns recorder statistics, or None.
+    def stop_recording(self):
+        stats = None
+        if self.recorder:
+            self.recorder.close()
+            stats = self.recorder.stats()
+            self.recorder = None
+        return stats
+
+    # Returns an (N,3) array of the positions of all boids in this Flock.
+    def boid_positions(self):
+        return np.array([(b.position.x, b.position.y, b.position.z)
+                         for b in self.boids], dtype=np.float64).reshape(-1, 3)
 
     # Calculate and log various statistics for flock.
     def log_stats(self):
         if (not self.simulation_paused) and (Draw.frame_counter % 100 == 0):
-            average_speed = mean([b.speed for b in self.boids])
-            # Loop over all unique pairs of distinct boids (ab==ba, not aa)
-            min_sep = math.inf
-            ave_sep = 0
-            pair_count = 0
-            # Via https://stackoverflow.com/a/942551/1991373
-            for (p, q) in itertools.combinations(self.boids, 2):
-                dist = (p.position - q.position).length()
-                if min_sep > dist:
-                    min_sep = dist
-                ave_sep += dist
-                pair_count += 1
-                if dist < 2 * p.body_radius:
-                    self.cumulative_sep_fail += 1
-            ave_sep /= pair_count
-            #
-            max_nn_dist = 0
-            total_avoid_fail = 0
-            for b in self.boids:
-                n = b.cached_nearest_neighbors[0]
-                dist = (b.position - n.position).length()
-                if max_nn_dist < dist:
-                    max_nn_dist = dist
-                total_avoid_fail += b.avoidance_failure_counter
+            stats = self.stats()
             print(str(Draw.frame_counter) +
                   ' fps=' + str(round(self.fps.value)) +
-                  ', ave_speed=' + str(average_speed)[0:5] +
-                  ', min_sep=' + str(min_sep)[0:5] +
-                  ', ave_sep=' + str(ave_sep)[0:5] +
-                  ', max_nn_dist=' + str(max_nn_dist)[0:5] +
+                  ', ave_speed=' + str(stats['ave_speed'])[0:5] +
+                  ', min_sep=' + str(stats['min_sep'])[0:5] +
+                  ', ave_sep=' + str(stats['ave_sep'])[0:5] +
+                  ', max_nn_dist=' + str(stats['max_nn_dist'])[0:5] +
                   ', cumulative_sep_fail/boid=' +
-                      (str(self.cumulative_sep_fail / len(self.boids)) +
-                      '00')[0:5] +
-                  ', avoid_fail=' + str(total_avoid_fail) +
-                  ', stalls=' + str(self.total_stalls))
+                      (str(stats['cumulative_sep_fail/boid']) + '00')[0:5] +
+                  ', avoid_fail=' + str(stats['avoid_fail']) +
+                  ', stalls=' + str(stats['stalls']))
+            if self.timer.enable:
+                print('    average ms per frame:' +
+                      ','.join([' ' + phase + '=' + str(stats['average'])[0:5]
+                                for (phase, stats) in
+                                self.timing_stats().items()]))
+
+    # Measure flock statistics now, returned as a map from metric name to
+    # value. Separation failures found now are added to cumulative_sep_fail,
+    # so this is normally called at a fixed interval (every 100 frames). Use
+    # accumulate=False for values at other times, which leaves it unchanged.
+    def stats(self, accumulate=True):
+        average_speed = mean([b.speed for b in self.boids])
+        positions = self.boid_positions()
+        (min_sep, sep_fail) = self.separation_stats(positions)
+        if accumulate:
+            self.cumulative_sep_fail += sep_fail
+        ave_sep = knn.average_pair_distance(positions)
+        #
+        max_nn_dist = 0
+        total_avoid_fail = 0
+        for b in self.boids:
+            n = b.cached_nearest_neighbors[0]
+            dist = (b.position - n.position).length()
+            if max_nn_dist < dist:
+                max_nn_dist = dist
+            total_avoid_fail += b.avoidance_failure_counter
+        return {'ave_speed': float(average_speed),
+                'min_sep': min_sep,
+                'ave_sep': float(ave_sep),
+                'max_nn_dist': float(max_nn_dist),
+                'cumulative_sep_fail/boid':
+                    self.cumulative_sep_fail / len(self.boids),
+                'avoid_fail': int(total_avoid_fail),
+                'stalls': self.total_stalls}
+
+    # Minimum distance between any two boids, and number of "separation
+    # failures": pairs closer than twice the body radius (of the first boid of
+    # the pair). Found using a grid of pairs within that distance. Only when
+    # there are none, min separation comes from a nearest neighbor search.
+    def separation_stats(self, positions):
+        body_radius = np.array([b.body_radius for b in self.boids])
+        (i, j, dist) = knn.pairs_within_distance(positions,
+                                                 2 * body_radius.max())
+        sep_fail = int(np.count_nonzero(dist < 2 * body_radius[i]))
+        if len(dist):
+            min_sep = dist.min()
+        else:
+            nearest = knn.k_nearest_neighbors(positions, 1)[:, 0]
+            offsets = positions[nearest] - positions
+            min_sep = np.sqrt(util.dot_rows(offsets, offsets).min())
+        return (float(min_sep), sep_fail)
+
+    # Rolling per-phase frame timing statistics, a map from phase name (like
+    # 'neighbors' or 'draw') to a map of average, p50, p95, and max in ms.
+    def timing_stats(self):
+        return self.timer.summary()
+
+    # Write a Chrome/Perfetto trace event JSON file for the given (inclusive)
+    # range of frames, counting from first frame of run().
+    def trace_frames(self, first, last, path='flock_trace.json'):
+        self.timer.trace_frames(first, last, path)
 
     # Keep track of a smoothed (LPF) version of frames per second metric.
     def update_fps(self):
@@ -268,7 +512,12 @@ class Flock:
     def toggle_dynamic_erase(self):
         self = Flock.convert_to_flock(self)
         Draw.clear_dynamic_mesh = not Draw.clear_dynamic_mesh
-        if self.tracking_camera and not Draw.clear_dynamic_mesh:
+        if Draw.clear_dynamic_mesh and Draw.enable:
+            self.worms.clear()
+            self.worms.update_mesh()
+            Draw.vis.update_geometry(self.worms.tri_mesh)
+        if (self.tracking_camera and not Draw.clear_dynamic_mesh and
+                not Draw.view_control_tracking):
             print('!!! "spacetime boid worms" do not work correctly with ' +
                   'boid tracking camera mode ("C" key). Awaiting fix for ' +
                   'Open3D bug 6009.')
@@ -437,6 +686,19 @@ class Flock:
         Agent.unit_test()
         util.unit_test()
         shape.unit_test()
+        obstacle.unit_test()
+        SpatialHash.unit_test()
+        knn.unit_test()
+        PhaseTimer.unit_test()
+        steering.unit_test()
+        FlockState.unit_test()
+        recording.unit_test()
+        codec.unit_test()
+        MeshBuilder.unit_test()
+        BoidBodies.unit_test()
+        Draw.unit_test()
+        Worms.unit_test()
+        look_at.unit_test()
         print('All unit tests OK.')
 
 
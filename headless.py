@@ -0,0 +1,130 @@
+#-------------------------------------------------------------------------------
+#
+# headless.py -- new flock experiments
+#
+# Run a flock simulation without graphics, for a fixed number of steps at a
+# fixed time step, and report simulation speed (steps per second and boid-steps
+# per second), the final flock statistics (as logged by log_stats()), and the
+# per-phase timing, as JSON on stdout. Startup logging goes to stderr, so stdout
+# is just the JSON.
+#
+# Usage:
+#     python headless.py --boids 500 --seed 1234567890 --preset 0 --steps 1000
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import sys
+import math
+import json
+import time
+import contextlib
+from Draw import Draw
+from flock import Flock
+
+# Simulate a flock of boid_count boids for the given number of steps, with
+# obstacle set "preset" (an index into Flock.pre_defined_obstacle_sets()), and
+# optional map of tuning parameters (see Flock.set_parameters()). Returns a map
+# of timing results and final flock statistics, including the min separation
+# over all statistics samples and the average time taken by Flock.stats().
+# Optionally records each step to the file at path "record" (see
+# Flock.start_recording()), on a background thread if "stream", compressed if
+# "quantized". Then recorder statistics are included.
+def run(boid_count=200, seed=1234567890, preset=0, steps=1000, fps=30,
+        vectorized=False, parameters=None, record=None,
+        record_fields=('position',), stream=False, quantized=False):
+    Draw.enable = False
+    Draw.frame_counter = 0
+    # Keep stdout clean for JSON: Flock logs versions and obstacles on setup.
+    with contextlib.redirect_stdout(sys.stderr):
+        flock = Flock(boid_count=boid_count,
+                      max_simulation_steps=steps,
+                      fixed_time_step=True,
+                      fixed_fps=fps,
+                      seed=seed,
+                      vectorized=vectorized,
+                      phase_timing=True)
+        flock.make_boids(flock.boid_count, flock.sphere_radius,
+                         flock.sphere_center)
+        flock.set_parameters(parameters or {})
+        flock.obstacle_selection_counter = preset
+        flock.cycle_obstacle_selection()
+    if record:
+        flock.start_recording(record, record_fields, stream, quantized,
+                              seed=seed, preset=preset)
+    # Like Flock.run() minus drawing. Only fly_flock() is timed, statistics
+    # are sampled every 100 steps (for cumulative_sep_fail). Final values are
+    # reported without adding to cumulative_sep_fail.
+    stats = None
+    min_sep = math.inf
+    elapsed = 0
+    stats_times = []  # Seconds taken by each call to flock.stats().
+    def timed_stats(accumulate=True):
+        start = time.perf_counter()
+        stats = flock.stats(accumulate)
+        stats_times.append(time.perf_counter() - start)
+        return stats
+    while flock.still_running():
+        start = time.perf_counter()
+        flock.fly_flock(1 / fps)
+        elapsed += time.perf_counter() - start
+        flock.timer.end_frame()
+        Draw.frame_counter += 1
+        if Draw.frame_counter % 100 == 0:
+            stats = timed_stats()
+            min_sep = min(min_sep, stats['min_sep'])
+    if stats is None or Draw.frame_counter % 100 != 0:
+        stats = timed_stats(accumulate=False)
+        min_sep = min(min_sep, stats['min_sep'])
+    recording_stats = flock.stop_recording()
+    steps_per_second = steps / elapsed if elapsed > 0 else 0
+    return {'boids': boid_count,
+            'seed': seed,
+            'preset': preset,
+            'obstacles': [str(o) for o in flock.obstacles],
+            'preset_count': len(flock.obstacle_presets),
+            'steps': steps,
+            'fps': fps,
+            'vectorized': vectorized,
+            'seconds': elapsed,
+            'steps_per_second': steps_per_second,
+            'boid_steps_per_second': steps_per_second * boid_count,
+            'parameters': parameters or {},
+            'stats': stats,
+            'min_sep_sampled': min_sep,
+            'stats_seconds': sum(stats_times) / len(stats_times),
+            'phases': flock.timing_stats(),
+            'recording': recording_stats}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Run flock without graphics.')
+    parser.add_argument('--boids', type=int, default=200,
+                        help='number of boids in flock.')
+    parser.add_argument('--seed', type=int, default=1234567890,
+                        help='random number seed.')
+    parser.add_argument('--preset', type=int, default=0,
+                        help='index of pre-defined obstacle set.')
+    parser.add_argument('--steps', type=int, default=1000,
+                        help='number of simulation steps.')
+    parser.add_argument('--fps', type=int, default=30,
+                        help='fixed frame rate (time step is 1/fps).')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='use NumPy array engine (see FlockState.py).')
+    parser.add_argument('--record', type=str, default=None,
+                        help='pathname of recording file to write.')
+    parser.add_argument('--record_fields', type=str, nargs='+',
+                        default=['position'],
+                        help='per boid fields: position forward up speed.')
+    parser.add_argument('--stream', action='store_true',
+                        help='write recording on a background thread.')
+    parser.add_argument('--quantized', action='store_true',
+                        help='write compressed recording (see codec.py).')
+    args = parser.parse_args()
+    result = run(args.boids, args.seed, args.preset, args.steps, args.fps,
+                 args.vectorized, record=args.record,
+                 record_fields=args.record_fields, stream=args.stream,
+                 quantized=args.quantized)
+    print(json.dumps(result, indent=4))
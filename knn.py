@@ -0,0 +1,389 @@
+#-------------------------------------------------------------------------------
+#
+# knn.py -- new flock experiments
+#
+# Batched k-nearest-neighbor queries over an (N,3) array of positions, using
+# NumPy. Finds the neighbors of many points in one vectorized call rather than
+# one Python-level query per Boid.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+# Upper bound on the number of distances held in memory at once. Query points
+# are processed in blocks of rows so that rows * N stays under this limit.
+max_block_elements = 2 ** 22
+
+# Given an (N,3) array of positions, returns an (Q,k) array of integer indices
+# into it: the k nearest neighbors of each query point, sorted by increasing
+# distance, not including the query point itself. "queries" is an optional
+# sequence of Q indices into "positions" (defaults to all N). If there are
+# fewer than k other points, k is reduced to N-1.
+#
+# Large queries use a uniform grid to gather candidates from the 27 cells
+# around each query point (see grid_candidates()). Any row whose result cannot
+# be shown correct by that, and all rows of small queries, use brute_force().
+def k_nearest_neighbors(positions, k=7, queries=None):
+    positions = np.asarray(positions, dtype=np.float64)
+    count = len(positions)
+    queries = (np.arange(count) if queries is None
+               else np.asarray(queries, dtype=np.int64).reshape(-1))
+    k = min(k, count - 1)
+    result = np.empty((len(queries), max(k, 0)), dtype=np.int64)
+    if k <= 0 or len(queries) == 0:
+        return result
+    unresolved = np.arange(len(queries))
+    if len(queries) * count > grid_threshold:
+        unresolved = grid_candidates(positions, k, queries, result)
+    if len(unresolved):
+        result[unresolved] = brute_force(positions, k, queries[unresolved])
+    return result
+
+# Use grid_candidates() when Q*N exceeds this.
+grid_threshold = 2 ** 20
+
+# Each block of query rows gets squared distances to all points, then
+# np.argpartition() selects candidates in O(N) per row. Those few candidates
+# are re-ranked by exactly computed squared distance (same arithmetic as
+# Vec3.length_squared()) so results agree with a sort of Python Vec3s.
+def brute_force(positions, k, queries):
+    count = len(positions)
+    result = np.empty((len(queries), k), dtype=np.int64)
+    # Keep a couple of spare candidates in case of round-off in the fast pass.
+    c = min(k + 2, count - 1)
+    squared_lengths = np.einsum('ij,ij->i', positions, positions)
+    rows_per_block = max(1, max_block_elements // count)
+    for start in range(0, len(queries), rows_per_block):
+        rows = queries[start : start + rows_per_block]
+        q = positions[rows]
+        # Fast pass: |p|² + |q|² - 2p·q, then exclude the query point itself.
+        d2 = squared_lengths[None, :] + squared_lengths[rows, None]
+        d2 -= 2 * (q @ positions.T)
+        d2[np.arange(len(rows)), rows] = np.inf
+        candidates = np.argpartition(d2, c - 1, axis=1)[:, :c]
+        result[start : start + len(rows)] = rank_candidates(positions, k, rows,
+                                                            candidates)
+    return result
+
+# Given (Q,C) candidate indices for each query row, return (Q,k) indices of
+# the k nearest, ranked by exact squared distance.
+def rank_candidates(positions, k, rows, candidates):
+    offsets = positions[candidates] - positions[rows][:, None, :]
+    exact = (offsets[..., 0] * offsets[..., 0] +
+             offsets[..., 1] * offsets[..., 1] +
+             offsets[..., 2] * offsets[..., 2])
+    order = np.argsort(exact, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(candidates, order, axis=1)
+
+# Vectorized version of SpatialHash: sorts points by grid cell, then for each
+# query gathers all points in the 3x3x3 block of cells around it and selects
+# the k nearest. Cell size is set from the average occupancy of the cell
+# containing each point. Rows not resolved (fewer than k candidates, or k-th
+# distance beyond the region searched, so an unseen point might be nearer) are
+# retried on a coarser grid. Rows whose block of cells holds more than
+# max_block_elements points are not retried. Writes rows of "result",
+# returning the indices of rows still unresolved after the given number of
+# passes.
+def grid_candidates(positions, k, queries, result, passes=3):
+    count = len(positions)
+    low = positions.min(axis=0)
+    extent = np.maximum(positions.max(axis=0) - low, 1e-9)
+    # Initial cell size for k points per cell at uniform density in bounding
+    # box, then adjusted for actual occupancy (eg flock in a tight clump).
+    cell_size = (np.prod(extent) * k / count) ** (1 / 3)
+    keys = grid_keys(positions, low, cell_size)[0]
+    occupancy = np.unique(keys, return_counts=True)[1]
+    occupancy = (occupancy ** 2).sum() / count
+    cell_size *= (0.5 * k / occupancy) ** (1 / 3)
+    unresolved = np.arange(len(queries))
+    too_dense = []
+    for i in range(passes):
+        rows = queries[unresolved]
+        (nearest, ok, dense) = grid_pass(positions, k, rows, low, cell_size)
+        result[unresolved[ok]] = nearest[ok]
+        too_dense.append(unresolved[dense])
+        unresolved = unresolved[~(ok | dense)]
+        if len(unresolved) == 0:
+            break
+        cell_size *= 2
+    return np.concatenate(too_dense + [unresolved])
+
+# Integer key of the grid cell containing each position, plus cell indices and
+# grid dimensions. Cell indices start at 1, leaving a margin of empty cells.
+def grid_keys(positions, low, cell_size):
+    cells = np.floor((positions - low) / cell_size).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    return (keys, cells, dims)
+
+# One grid_candidates() pass at a given cell size. Returns (Q,k) neighbors for
+# the given query rows, a (Q,) boolean array: True where result is certain,
+# and another: True for rows with too many points in their block of cells to
+# search within max_block_elements (left for brute_force()). The other rows
+# are searched in blocks of rows, each holding at most max_block_elements
+# candidates.
+def grid_pass(positions, k, rows, low, cell_size):
+    (order, starts, counts, cells) = grid_block_ranges(positions, rows, low,
+                                                       cell_size)
+    totals = counts.sum(axis=1)
+    nearest = np.zeros((len(rows), k), np.int64)
+    ok = np.zeros(len(rows), bool)
+    dense = totals > max_block_elements
+    searched = np.flatnonzero(~dense)
+    for block in row_blocks(totals[searched], k):
+        b = searched[block]
+        (nearest[b], ok[b]) = grid_block_nearest(positions, k, rows[b], order,
+                                                 starts[b], counts[b], low,
+                                                 cell_size, cells)
+    return (nearest, ok, dense)
+
+# Finds k nearest of the candidates in each query row's block of cells, given
+# their ranges from grid_block_ranges(). Returns (Q,k) neighbors and a (Q,)
+# boolean array: True where result is certain.
+def grid_block_nearest(positions, k, rows, order, starts, counts, low,
+                       cell_size, cells):
+    (row_of_pair, candidate, d2, totals) = grid_block_pairs(positions, rows,
+                                                            order, starts,
+                                                            counts)
+    d2[candidate == rows[row_of_pair]] = np.inf
+    pair_count = len(candidate)
+    # Scatter pairs into padded (Q,M) matrices, select and sort k nearest.
+    width = max(totals.max(), k)
+    column = np.arange(pair_count) - np.repeat(np.cumsum(totals) - totals,
+                                               totals)
+    candidates = np.zeros((len(rows), width), np.int64)
+    distances = np.full((len(rows), width), np.inf)
+    candidates[row_of_pair, column] = candidate
+    distances[row_of_pair, column] = d2
+    if width > k:
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        candidates = np.take_along_axis(candidates, nearest, axis=1)
+        distances = np.take_along_axis(distances, nearest, axis=1)
+    order = np.argsort(distances, axis=1, kind='stable')
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    kth_d2 = np.take_along_axis(distances, order[:, -1:], axis=1)[:, 0]
+    # Certain when k-th neighbor is nearer than the nearest wall of the
+    # searched block of cells (inf when too few candidates).
+    within_cell = (positions[rows] - low) / cell_size - (cells[rows] - 1)
+    margin = 1 + np.minimum(within_cell, 1 - within_cell).min(axis=1)
+    ok = kth_d2 <= (margin * cell_size) ** 2
+    return (candidates, ok)
+
+# Sorts points into a grid of the given cell size. Returns the point indices
+# in order of cell key, then for each query row the (Q,27) start (in that
+# order) and count of the points in each cell of the 3x3x3 block of cells
+# around it, and the grid cell indices of all points.
+def grid_block_ranges(positions, rows, low, cell_size):
+    (keys, cells, dims) = grid_keys(positions, low, cell_size)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    offsets = np.array([(x * dims[1] + y) * dims[2] + z
+                        for x in (-1, 0, 1)
+                        for y in (-1, 0, 1)
+                        for z in (-1, 0, 1)])
+    nearby = keys[rows][:, None] + offsets[None, :]
+    starts = np.searchsorted(sorted_keys, nearby, 'left')
+    counts = np.searchsorted(sorted_keys, nearby, 'right') - starts
+    return (order, starts, counts, cells)
+
+# Splits rows into consecutive blocks (a list of slices) given each row's
+# candidate count. Each block has at least one row, and otherwise rows times
+# its widest row (at least min_width) stays under max_block_elements.
+def row_blocks(totals, min_width=1):
+    blocks = []
+    start = 0
+    max_rows = max(1, max_block_elements // min_width)
+    while start < len(totals):
+        width = np.maximum.accumulate(totals[start : start + max_rows])
+        size = np.maximum(width, min_width) * np.arange(1, len(width) + 1)
+        end = start + max(1, np.searchsorted(size, max_block_elements,
+                                             'right'))
+        blocks.append(slice(start, end))
+        start = end
+    return blocks
+
+# For each query row, all points in the 3x3x3 block of grid cells around it,
+# given their ranges from grid_block_ranges(): returns a flat list of (query
+# row, candidate point) pairs as two arrays (row is an index into "rows"), the
+# squared distance of each pair (same arithmetic as Vec3.length_squared()),
+# and number of pairs per row.
+def grid_block_pairs(positions, rows, order, starts, counts):
+    totals = counts.sum(axis=1)
+    starts = starts.ravel()
+    counts = counts.ravel()
+    pair_count = totals.sum()
+    row_of_pair = np.repeat(np.arange(len(rows)), totals)
+    range_start_of_pair = np.repeat(starts, counts)
+    first_pair_of_range = np.repeat(np.cumsum(counts) - counts, counts)
+    candidate = order[range_start_of_pair +
+                      np.arange(pair_count) - first_pair_of_range]
+    offset = positions[candidate] - positions[rows][row_of_pair]
+    d2 = (offset[:, 0] * offset[:, 0] +
+          offset[:, 1] * offset[:, 1] +
+          offset[:, 2] * offset[:, 2])
+    return (row_of_pair, candidate, d2, totals)
+
+# Like k_nearest_neighbors() but for positions made of consecutive groups of
+# group_size points (eg several independent flocks in one array), where each
+# point's neighbors are only those in its own group. Returns (Q,k) indices into
+# "positions". Small groups use one brute force search over all query rows,
+# each against the points of its group. Large groups are searched one at a
+# time with k_nearest_neighbors().
+def grouped_k_nearest_neighbors(positions, group_size, k=7, queries=None):
+    positions = np.asarray(positions, dtype=np.float64)
+    count = len(positions)
+    queries = (np.arange(count) if queries is None
+               else np.asarray(queries, dtype=np.int64).reshape(-1))
+    k = min(k, group_size - 1)
+    result = np.empty((len(queries), max(k, 0)), dtype=np.int64)
+    if k <= 0 or len(queries) == 0:
+        return result
+    group = queries // group_size
+    if group_size > grouped_brute_force_limit:
+        for g in np.unique(group).tolist():
+            rows = np.flatnonzero(group == g)
+            first = g * group_size
+            result[rows] = first + k_nearest_neighbors(
+                positions[first : first + group_size], k,
+                queries[rows] - first)
+        return result
+    c = min(k + 2, group_size - 1)
+    rows_per_block = max(1, max_block_elements // (3 * group_size))
+    for start in range(0, len(queries), rows_per_block):
+        rows = queries[start : start + rows_per_block]
+        # Candidates: all points in each query's group, except itself.
+        candidates = (group[start : start + rows_per_block, None] * group_size +
+                      np.arange(group_size)[None, :])
+        offsets = positions[candidates] - positions[rows][:, None, :]
+        d2 = np.einsum('ijk,ijk->ij', offsets, offsets)
+        d2[candidates == rows[:, None]] = np.inf
+        nearest = np.argpartition(d2, c - 1, axis=1)[:, :c]
+        result[start : start + len(rows)] = rank_candidates(
+            positions, k, rows, np.take_along_axis(candidates, nearest, 1))
+    return result
+
+# Groups larger than this use k_nearest_neighbors() per group.
+grouped_brute_force_limit = 1000
+
+# Returns all pairs of points nearer than a given distance to each other, as
+# two arrays of indices into "positions" (i, j) with i < j, and an array of
+# the distance between each pair. Found via a grid whose cell size is that
+# distance, in blocks of rows (see row_blocks()).
+def pairs_within_distance(positions, distance):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    if len(positions) < 2 or distance <= 0:
+        return (np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0))
+    rows = np.arange(len(positions))
+    (order, starts, counts, cells) = grid_block_ranges(positions, rows,
+                                                       positions.min(axis=0),
+                                                       distance)
+    (i, j, d) = ([], [], [])
+    for block in row_blocks(counts.sum(axis=1)):
+        (row_of_pair, candidate, d2, totals) = grid_block_pairs(
+            positions, rows[block], order, starts[block], counts[block])
+        row_of_pair = rows[block][row_of_pair]
+        near = (candidate > row_of_pair) & (d2 < distance ** 2)
+        i.append(row_of_pair[near])
+        j.append(candidate[near])
+        d.append(np.sqrt(d2[near]))
+    return (np.concatenate(i), np.concatenate(j), np.concatenate(d))
+
+# Average distance between all N*(N-1)/2 unique pairs of points. Computed in
+# blocks of rows, each against all later points, so memory use is bounded by
+# max_block_elements.
+def average_pair_distance(positions):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    count = len(positions)
+    total = 0.0
+    rows_per_block = max(1, max_block_elements // (3 * count))
+    for start in range(0, count - 1, rows_per_block):
+        block = positions[start : start + rows_per_block]
+        # Offsets from each row of block to all points after the block's first.
+        offsets = positions[None, start + 1 :, :] - block[:, None, :]
+        d = np.sqrt(offsets[..., 0] * offsets[..., 0] +
+                    offsets[..., 1] * offsets[..., 1] +
+                    offsets[..., 2] * offsets[..., 2])
+        # Keep only points after each row: column c is point start + 1 + c.
+        later = (np.arange(d.shape[1])[None, :] >=
+                 np.arange(len(block))[:, None])
+        total += d[later].sum()
+    return total / (count * (count - 1) / 2)
+
+def unit_test():
+    rng = np.random.default_rng(1234567890)
+    positions = rng.uniform(-30, 30, (300, 3))
+    def sorted_by_distance(i, k):
+        d2 = ((positions - positions[i]) ** 2).sum(axis=1)
+        d2[i] = np.inf
+        return d2, np.argsort(d2, kind='stable')[:k]
+    nn = k_nearest_neighbors(positions, 7)
+    assert nn.shape == (300, 7)
+    for i in range(len(positions)):
+        d2, expected = sorted_by_distance(i, 7)
+        assert np.allclose(d2[nn[i]], d2[expected])
+        assert i not in nn[i]
+    # Subset of queries, and small blocks (forces several passes).
+    global max_block_elements
+    saved_block_elements = max_block_elements
+    max_block_elements = 1000
+    subset = [5, 0, 299, 17]
+    nn = k_nearest_neighbors(positions, 3, subset)
+    max_block_elements = saved_block_elements
+    assert nn.shape == (4, 3)
+    for (row, i) in enumerate(subset):
+        d2, expected = sorted_by_distance(i, 3)
+        assert np.allclose(d2[nn[row]], d2[expected])
+    # Grid search on a dense clump plus sparse outliers, compare brute force.
+    # Then with small blocks, so rows are split into several blocks and those
+    # in the clump are too dense for the grid and left for brute force.
+    global grid_threshold
+    saved_grid_threshold = grid_threshold
+    grid_threshold = 0
+    clumped = np.vstack([rng.normal(0, 1, (300, 3)),
+                         rng.uniform(-100, 100, (30, 3))])
+    everything = np.arange(len(clumped))
+    grid = np.empty((len(clumped), 7), dtype=np.int64)
+    unresolved = grid_candidates(clumped, 7, everything, grid, 1)
+    assert len(unresolved) < len(clumped) / 10
+    expected = brute_force(clumped, 7, everything)
+    assert np.array_equal(k_nearest_neighbors(clumped, 7), expected)
+    max_block_elements = 200
+    dense = grid_pass(clumped, 7, everything, clumped.min(axis=0), 1)[2]
+    assert 0 < np.count_nonzero(dense) < len(clumped)
+    assert np.array_equal(k_nearest_neighbors(clumped, 7), expected)
+    max_block_elements = saved_block_elements
+    grid_threshold = saved_grid_threshold
+    # Fewer points than k.
+    assert k_nearest_neighbors(positions[:3], 7).shape == (3, 2)
+    assert k_nearest_neighbors(positions[:1], 7).shape == (1, 0)
+    assert k_nearest_neighbors([[0, 0, 0], [3, 0, 0], [1, 0, 0]], 2)[0].tolist() == [2, 1]
+    # Neighbors within groups match separate searches of each group.
+    expected = k_nearest_neighbors(positions[100:200], 7) + 100
+    grouped = grouped_k_nearest_neighbors(positions, 100, 7)
+    assert np.array_equal(grouped[100:200], expected)
+    grouped = grouped_k_nearest_neighbors(positions, 100, 7, [150, 100, 199])
+    assert np.array_equal(grouped, expected[[50, 0, 99]])
+    grouped = grouped_k_nearest_neighbors(positions, 3, 7)
+    assert np.all(grouped // 3 == np.arange(300)[:, None] // 3)
+    global grouped_brute_force_limit
+    saved_brute_force_limit = grouped_brute_force_limit
+    grouped_brute_force_limit = 10
+    grouped = grouped_k_nearest_neighbors(positions, 100, 7)
+    grouped_brute_force_limit = saved_brute_force_limit
+    assert np.array_equal(grouped[100:200], expected)
+    # Pairs within a distance, and average distance, compared to brute force.
+    diffs = clumped[:, None, :] - clumped[None, :, :]
+    all_d = np.sqrt((diffs ** 2).sum(axis=2))
+    upper = np.triu(np.ones_like(all_d, dtype=bool), 1)
+    (i, j, d) = pairs_within_distance(clumped, 0.5)
+    assert np.all(i < j)
+    assert len(i) == np.count_nonzero(upper & (all_d < 0.5)) > 0
+    assert np.allclose(d, all_d[i, j])
+    assert np.isclose(average_pair_distance(clumped), all_d[upper].mean())
+    max_block_elements = 1000
+    assert np.isclose(average_pair_distance(clumped), all_d[upper].mean())
+    blocked = pairs_within_distance(clumped, 0.5)
+    max_block_elements = saved_block_elements
+    assert all(np.array_equal(a, b) for (a, b) in zip(blocked, (i, j, d)))
@@ -31,8 +31,15 @@
 # you!!!
 #
 # ------------------------------------------------------------------------------
+#
+# Update: with Open3D 0.18, the legacy Visualizer's ViewControl can be modified
+# through pinhole camera parameters. Draw.update_camera() uses translate_view()
+# below for the boid-tracking camera when view_control_is_writable().
+#
+# ------------------------------------------------------------------------------
 
 import open3d as o3d
+import numpy as np
 
 #    void setOpen3DVisualizerViewByFromAt(open3d::visualization::Visualizer& vis,
 #                                         const Eigen::Vector3d& look_from,
@@ -57,52 +64,75 @@ import open3d as o3d
 #    }
 
 
+# There is no Python analog to gl_util::LookAt(), so look_at_matrix() computes
+# that view matrix with NumPy. Open3D's pinhole camera extrinsic uses the
+# OpenCV convention (camera looks along +z, with +y down) so no negation is
+# needed.
 def setOpen3DVisualizerViewByFromAt(vis, look_from, look_at, up = [0, 1, 0]):
-
-
-#    open3d::visualization::gl_util::LookAt()
-
-    o3d.visualization.gl_util.look_at(look_from, look_at, up)
-
-#    cam = o3d.visualization.rendering.Camera()
-#    cam = o3d.camera.PinholeCameraParameters()
-#    cam = o3d.visualization.rendering.FilamentCamera()
-#    cam = o3d.visualization.rendering.Camera()
-    
-#    // Compute 4x4 from/at matrix.
-#    using namespace open3d::visualization::gl_util;
-#    Eigen::Matrix4d la_matrix = LookAt(look_from, look_at, up).cast<double>();
-
-
-
-#    // Get current PinholeCameraParameters.
-#    open3d::camera::PinholeCameraParameters pcp;
-#    vis.GetViewControl().ConvertToPinholeCameraParameters(pcp);
-
+    set_extrinsic(vis, look_at_matrix(look_from, look_at, up))
+
+# 4x4 extrinsic (world to camera) matrix for a camera at look_from aimed at
+# look_at, with "up" roughly up on screen.
+def look_at_matrix(look_from, look_at, up=(0, 1, 0)):
+    look_from = np.asarray(look_from, dtype=np.float64)
+    forward = np.asarray(look_at, dtype=np.float64) - look_from
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    matrix = np.identity(4)
+    matrix[:3, :3] = [right, down, forward]
+    matrix[:3, 3] = -matrix[:3, :3] @ look_from
+    return matrix
+
+# Given a 4x4 extrinsic matrix, returns one for the same camera moved (without
+# rotating) by the given offset in world space.
+def translated_extrinsic(extrinsic, offset):
+    matrix = np.array(extrinsic, dtype=np.float64)
+    matrix[:3, 3] -= matrix[:3, :3] @ np.asarray(offset, dtype=np.float64)
+    return matrix
+
+# Current 4x4 extrinsic matrix of a Visualizer's camera.
+def get_extrinsic(vis):
+    pcp = vis.get_view_control().convert_to_pinhole_camera_parameters()
+    return np.array(pcp.extrinsic)
+
+# Set a Visualizer's camera to a 4x4 extrinsic matrix, keeping its intrinsics.
+def set_extrinsic(vis, extrinsic):
     vc = vis.get_view_control()
-
-    # Get current PinholeCameraParameters.
     pcp = vc.convert_to_pinhole_camera_parameters()
-    
-    print(vis.get_view_control().convert_to_pinhole_camera_parameters().intrinsic.width)
-    print(vis.get_view_control().convert_to_pinhole_camera_parameters().intrinsic.height)
-    
-    print(pcp.intrinsic.width, pcp.intrinsic.height)
-    
-
-#    vc.convert_from_pinhole_camera_parameters(pcp)
+    pcp.extrinsic = extrinsic
     vc.convert_from_pinhole_camera_parameters(pcp, True)
 
-
-#
-#    // Overwrite the pcp's previous view matrix with the new look_at matrix.
-#    // (I am deeply puzzled by the need for that negation, but here we are.)
-#    pcp.extrinsic_ = -la_matrix;
-#    pcp.extrinsic_(3, 3) = 1;
-#    
-#    // Write back PinholeCameraParameters with new from/at view matrix.
-#    vis.GetViewControl().ConvertFromPinholeCameraParameters(pcp);
-
+# Move a Visualizer's camera by an offset in world space, keeping its
+# orientation, so the "look at" point moves by the same offset. Used to track
+# a moving object while keeping any rotation or zoom made by the user.
+def translate_view(vis, offset):
+    set_extrinsic(vis, translated_extrinsic(get_extrinsic(vis), offset))
+
+# True if this Visualizer's camera can be moved through its ViewControl. That
+# failed in older versions of Open3D, see issue 6009: "get_view_control()
+# gives a copy". Tries a small move and moves back.
+def view_control_is_writable(vis):
+    try:
+        before = get_extrinsic(vis)
+        translate_view(vis, [1, 0, 0])
+        moved = not np.allclose(get_extrinsic(vis), before)
+        set_extrinsic(vis, before)
+        return moved
+    except (AttributeError, RuntimeError, TypeError):
+        return False
+
+def unit_test():
+    # Camera at look_from sees look_at straight ahead (on +z), up is -y.
+    m = look_at_matrix([1, 2, 10], [1, 2, 0])
+    assert np.allclose(m @ [1, 2, 0, 1], [0, 0, 10, 1])
+    assert np.allclose(m @ [1, 3, 10, 1], [0, -1, 0, 1])
+    assert np.allclose(m @ [2, 2, 10, 1], [1, 0, 0, 1])
+    # Translating camera and scene together leaves the view unchanged.
+    t = translated_extrinsic(m, [5, -6, 7])
+    assert np.allclose(t @ [6, -4, 7, 1], m @ [1, 2, 0, 1])
+    assert np.allclose(t[:3, :3], m[:3, :3])
 
 
 def test_look_at():
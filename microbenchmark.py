@@ -0,0 +1,193 @@
+#-------------------------------------------------------------------------------
+#
+# microbenchmark.py -- new flock experiments
+#
+# Microbenchmarks of the primitives in the simulation's inner loops: Vec3
+# arithmetic, LocalSpace transforms, ray/shape intersection, and such. Each is
+# timed in nanoseconds per operation: after a warm-up run, several repeats each
+# time a batch of calls (sized so a repeat takes about repeat_seconds). Reports
+# median, min, mean and standard deviation over repeats. Results can be saved
+# as a JSON baseline, then later runs are compared against it, flagging any
+# slowdown beyond a given threshold. Comparison uses the min over repeats, as
+# least affected by other activity on the machine (see Python's timeit docs).
+#
+# Usage:
+#     python microbenchmark.py --save              # Measure, write baseline.
+#     python microbenchmark.py                     # Measure, compare.
+#     python microbenchmark.py --cases vec3_add vec3_cross --threshold 0.5
+#
+# As with benchmark.py, a baseline is only meaningful on the machine where it
+# was made.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import sys
+import json
+import math
+import platform
+import statistics
+import numpy as np
+from Vec3 import Vec3
+from LocalSpace import LocalSpace
+import Utilities as util
+import shape
+
+default_baseline = 'microbenchmark_baseline.json'
+
+# Map from case name to a function of no arguments which performs one operation.
+# Operands are made up front (with a private generator, to leave the global
+# random sequence unchanged) so only the operation itself is timed.
+def make_cases():
+    rng = np.random.default_rng(1234567890)
+    def vec3():
+        return Vec3.from_array(rng.uniform(-1, 1, 3))
+    def unit_vec3():
+        return vec3().normalize()
+    a = vec3()
+    b = vec3()
+    forward = unit_vec3()
+    up = unit_vec3()
+    ls = LocalSpace().rotate_to_new_forward(unit_vec3(), Vec3(0, 1, 0))
+    ls.p = vec3()
+    # Ray from inside the sphere, aimed at the plane's origin and the
+    # cylinder's axis, so all intersections exist.
+    origin = vec3() * 10
+    tangent = -origin.normalize()
+    axis = unit_vec3()
+    return {'vec3_add':     lambda: a + b,
+            'vec3_sub':     lambda: a - b,
+            'vec3_scale':   lambda: a * 1.5,
+            'vec3_dot':     lambda: a.dot(b),
+            'vec3_length':  lambda: a.length(),
+            'vec3_normalize': lambda: a.normalize(),
+            'vec3_cross':   lambda: a.cross(b),
+            'rotate_to_new_forward':
+                lambda: ls.rotate_to_new_forward(forward, up),
+            'globalize':    lambda: ls.globalize(a),
+            'localize':     lambda: ls.localize(a),
+            'ray_sphere_intersection':
+                lambda: shape.ray_sphere_intersection(origin, tangent,
+                                                      50, Vec3()),
+            'ray_plane_intersection':
+                lambda: shape.ray_plane_intersection(origin, tangent,
+                                                     Vec3(), axis),
+            'ray_cylinder_intersection':
+                lambda: shape.ray_cylinder_intersection(origin, tangent,
+                                                        -axis * 20, axis,
+                                                        5, 40),
+            'distance_between_lines':
+                lambda: shape.distance_between_lines(origin, tangent,
+                                                     Vec3(), axis),
+            'unit_sigmoid_on_01': lambda: util.unit_sigmoid_on_01(0.3)}
+
+# Time one operation. Picks a batch size ("number" of calls) so one repeat
+# takes about repeat_seconds, does one untimed warm-up repeat, then "repeat"
+# timed repeats. Returns a map of statistics in nanoseconds per operation.
+def time_case(operation, repeat=7, repeat_seconds=0.05):
+    number = 1
+    while util.seconds_per_execution(operation, number) * number < 0.005:
+        number *= 10
+    number = max(1, math.ceil(
+        repeat_seconds / util.seconds_per_execution(operation, number)))
+    util.seconds_per_execution(operation, number)  # Warm-up.
+    ns = [util.seconds_per_execution(operation, number) * 1e9
+          for r in range(repeat)]
+    return {'median': statistics.median(ns),
+            'min': min(ns),
+            'mean': statistics.mean(ns),
+            'stdev': statistics.stdev(ns) if repeat > 1 else 0,
+            'number': number,
+            'repeat': repeat}
+
+# Time each named case (default: all). Returns a map with run settings and a
+# map from case name to statistics from time_case().
+def measure(names=None, repeat=7, repeat_seconds=0.05, log=sys.stderr):
+    cases = make_cases()
+    results = {'machine': platform.platform() + ' ' + platform.python_version(),
+               'cases': {}}
+    for name in (names or cases):
+        results['cases'][name] = time_case(cases[name], repeat, repeat_seconds)
+        if log:
+            print(name, round(results['cases'][name]['median'], 1), 'ns/op',
+                  file=log, flush=True)
+    return results
+
+# Compare results with a baseline (both as returned by measure()). Returns a
+# list of regressions, each a string describing a case whose min is more than
+# "threshold" (as a fraction, 0.25 means 25%) slower than in the baseline.
+def compare(results, baseline, threshold=0.25):
+    regressions = []
+    for (name, stats) in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base and stats['min'] > base['min'] * (1 + threshold):
+            regressions.append(name + ': ' + ns(stats['min']) +
+                               ' ns/op vs ' + ns(base['min']) +
+                               ' baseline (' +
+                               str(round(stats['min'] / base['min'], 2)) +
+                               'x)')
+    return regressions
+
+# Nanoseconds as a string with one decimal place.
+def ns(nanoseconds):
+    return str(round(nanoseconds, 1))
+
+# Print table of results in ns/op, with baseline min if given.
+def print_table(results, baseline=None, file=sys.stdout):
+    width = max(len(name) for name in results['cases'])
+    print('ns/op'.ljust(width) + '    median       min      mean     stdev' +
+          ('  baseline' if baseline else ''), file=file)
+    for (name, stats) in results['cases'].items():
+        base = baseline and baseline['cases'].get(name)
+        print(name.ljust(width) +
+              ''.join([ns(stats[s]).rjust(10)
+                       for s in ['median', 'min', 'mean', 'stdev']]) +
+              (ns(base['min']).rjust(10) if base else ''), file=file)
+
+def unit_test():
+    # Every case runs and returns something.
+    for operation in make_cases().values():
+        assert operation() is not None
+    stats = time_case(make_cases()['vec3_add'], repeat=3, repeat_seconds=0.001)
+    assert stats['min'] <= stats['median'] and stats['min'] <= stats['mean']
+    assert stats['number'] >= 1 and stats['repeat'] == 3
+    # Only slowdowns beyond threshold are regressions.
+    def results(mins):
+        return {'cases': {name: {'min': m} for (name, m) in mins.items()}}
+    baseline = results({'a': 100, 'b': 200})
+    assert compare(results({'a': 120, 'b': 100, 'c': 999}), baseline) == []
+    assert len(compare(results({'a': 130, 'b': 200}), baseline, 0.25)) == 1
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Flock microbenchmarks.')
+    parser.add_argument('--cases', type=str, nargs='+', default=None,
+                        help='names of cases to measure (default: all).')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='timed repeats per case.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown (fraction) reported as regression.')
+    parser.add_argument('--baseline', type=str, default=default_baseline,
+                        help='pathname of baseline JSON file.')
+    parser.add_argument('--save', action='store_true',
+                        help='write results as new baseline.')
+    args = parser.parse_args()
+    unit_test()
+    results = measure(args.cases, args.repeat)
+    if args.save:
+        print_table(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=4)
+        print('Saved baseline:', args.baseline)
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print_table(results, baseline)
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            print('REGRESSION:', r)
+        print(len(regressions), 'regressions (threshold ' +
+              str(args.threshold) + ')')
+        sys.exit(1 if regressions else 0)
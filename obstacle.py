@@ -12,6 +12,7 @@
 
 import math
 import shape
+import numpy as np
 from Vec3 import Vec3
 from Draw import Draw
 import Utilities as util
@@ -55,6 +56,43 @@ class Obstacle:
     def draw(self):
         pass
 
+    # Batch versions of the methods above, for all boids at once. Query points,
+    # agent positions and forwards are (N,3) arrays, one row per boid, while
+    # max_distance and body_radius may be single values or (N,) arrays. These
+    # defaults call the scalar method for each row. Subclasses override them
+    # with vectorized versions.
+
+    # Returns (N,3) points of intersection and (N,) "hit" mask, False (and
+    # point NaN) where the ray misses.
+    def batch_ray_intersection(self, origins, tangents, body_radius):
+        body_radius = np.broadcast_to(body_radius, (len(origins),))
+        points = [self.ray_intersection(o, t, r) for (o, t, r) in
+                  zip(vec3s(origins), vec3s(tangents), body_radius.tolist())]
+        hit = np.array([p is not None for p in points], dtype=bool)
+        return (np.array([p.asarray() if p else (np.nan,) * 3 for p in points],
+                         dtype=np.float64).reshape(-1, 3), hit)
+
+    def batch_normal_at_poi(self, pois, agent_positions):
+        return rows([self.normal_at_poi(poi, p) for (poi, p) in
+                     zip(vec3s(pois), vec3s(agent_positions))])
+
+    def batch_nearest_point(self, query_points):
+        return rows([self.nearest_point(q) for q in vec3s(query_points)])
+
+    def batch_fly_away(self, agent_positions, agent_forwards,
+                       max_distance, body_radius):
+        count = len(agent_positions)
+        max_distance = np.broadcast_to(max_distance, (count,)).tolist()
+        body_radius = np.broadcast_to(body_radius, (count,)).tolist()
+        return rows([self.fly_away(p, f, m, r) for (p, f, m, r) in
+                     zip(vec3s(agent_positions), vec3s(agent_forwards),
+                         max_distance, body_radius)])
+
+    # Returns (N,) signed distances.
+    def batch_signed_distance(self, query_points):
+        return np.array([self.signed_distance(q) for q in vec3s(query_points)],
+                        dtype=np.float64)
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -105,6 +143,34 @@ class EvertedSphereObstacle(Obstacle):
         distance_to_center = (query_point - self.center).length()
         return distance_to_center - self.radius
 
+    # Batch versions of methods above, see Obstacle.
+    def batch_ray_intersection(self, origins, tangents, body_radius):
+        return shape.batch_ray_sphere_intersection(origins, tangents,
+                                                   self.radius,
+                                                   self.center.asarray())
+
+    def batch_normal_at_poi(self, pois, agent_positions):
+        return util.normalize_rows(self.center.asarray() - pois)
+
+    def batch_nearest_point(self, query_points):
+        return (util.normalize_rows(query_points - self.center.asarray()) *
+                self.radius)
+
+    def batch_fly_away(self, agent_positions, agent_forwards,
+                       max_distance, body_radius):
+        offset_to_sphere_center = self.center.asarray() - agent_positions
+        distance_to_sphere_center = util.length_rows(offset_to_sphere_center)
+        dist_from_wall = self.radius - distance_to_sphere_center
+        normal = offset_to_sphere_center / distance_to_sphere_center[:, None]
+        active = ((dist_from_wall < max_distance) &
+                  (util.dot_rows(normal, agent_forwards) < 0.9))
+        weight = 1 - (dist_from_wall / max_distance)
+        return np.where(active[:, None], normal * weight[:, None], 0)
+
+    def batch_signed_distance(self, query_points):
+        offset = query_points - self.center.asarray()
+        return util.length_rows(offset) - self.radius
+
     def draw(self):
         if not self.tri_mesh:
             self.tri_mesh = Draw.make_everted_sphere(self.radius, self.center)
@@ -166,6 +232,40 @@ class PlaneObstacle(Obstacle):
         from_plane_to_query_point = query_point - nearest_point_on_plane
         return from_plane_to_query_point.dot(self.normal)
 
+    # Batch versions of methods above, see Obstacle.
+    def batch_ray_intersection(self, origins, tangents, body_radius):
+        return shape.batch_ray_plane_intersection(origins, tangents,
+                                                  self.center.asarray(),
+                                                  self.normal.asarray())
+
+    def batch_normal_at_poi(self, pois, agent_positions=None):
+        if agent_positions is None:
+            return np.broadcast_to(self.normal.asarray(), pois.shape).copy()
+        on_obstacle = self.batch_nearest_point(agent_positions)
+        return util.normalize_rows(agent_positions - on_obstacle)
+
+    def batch_nearest_point(self, query_points):
+        normal = self.normal.asarray()
+        offset = query_points - self.center.asarray()
+        distance = util.dot_rows(offset, normal)
+        on_plane = offset - (normal * distance[:, None])
+        return on_plane + self.center.asarray()
+
+    def batch_fly_away(self, agent_positions, agent_forwards,
+                       max_distance, body_radius):
+        on_obstacle = self.batch_nearest_point(agent_positions)
+        dist_from_obstacle = util.length_rows(on_obstacle - agent_positions)
+        normal = self.batch_normal_at_poi(on_obstacle, agent_positions)
+        active = ((dist_from_obstacle < max_distance) &
+                  (util.dot_rows(normal, agent_forwards) < 0.9))
+        weight = 1 - (dist_from_obstacle / max_distance)
+        return np.where(active[:, None], normal * weight[:, None], 0)
+
+    def batch_signed_distance(self, query_points):
+        nearest_point_on_plane = self.batch_nearest_point(query_points)
+        return util.dot_rows(query_points - nearest_point_on_plane,
+                             self.normal.asarray())
+
 # A bounded cylinder (between two endpoints) with given radius
 class CylinderObstacle(Obstacle):
     def __init__(self, radius, endpoint0, endpoint1):
@@ -228,6 +328,46 @@ class CylinderObstacle(Obstacle):
         distance_to_axis = (query_point - point_on_axis).length()
         return distance_to_axis - self.radius
 
+    # Batch versions of methods above, see Obstacle.
+    def batch_nearest_point_on_axis(self, query_points):
+        tangent = self.tangent.asarray()
+        offset = query_points - self.endpoint.asarray()
+        projection = util.dot_rows(offset, tangent)
+        return self.endpoint.asarray() + tangent * projection[:, None]
+
+    def batch_ray_intersection(self, origins, tangents, body_radius):
+        radius = self.radius + 2 * np.asarray(body_radius, dtype=np.float64)
+        return shape.batch_ray_cylinder_intersection(origins, tangents,
+                                                     self.endpoint.asarray(),
+                                                     self.tangent.asarray(),
+                                                     radius, self.length)
+
+    def batch_normal_at_poi(self, pois, agent_positions):
+        on_axis = self.batch_nearest_point_on_axis(pois)
+        return util.normalize_rows(pois - on_axis)
+
+    def batch_nearest_point(self, query_points):
+        on_axis = self.batch_nearest_point_on_axis(query_points)
+        return on_axis + (util.normalize_rows(query_points - on_axis) *
+                          self.radius)
+
+    def batch_fly_away(self, agent_positions, agent_forwards,
+                       max_distance, body_radius):
+        path_to_axis_dist = shape.batch_distance_between_lines(
+            agent_positions, agent_forwards,
+            self.endpoint.asarray(), self.tangent.asarray())
+        margin = 3 * np.asarray(body_radius, dtype=np.float64)
+        on_surface = self.batch_nearest_point(agent_positions)
+        offset = on_surface - agent_positions
+        active = ((path_to_axis_dist < self.radius + margin) &
+                  (util.dot_rows(offset, offset) < margin ** 2))
+        normal = self.batch_normal_at_poi(agent_positions, agent_positions)
+        return np.where(active[:, None], normal, 0)
+
+    def batch_signed_distance(self, query_points):
+        point_on_axis = self.batch_nearest_point_on_axis(query_points)
+        return util.length_rows(query_points - point_on_axis) - self.radius
+
     def draw(self):
         if not self.tri_mesh:
             self.tri_mesh = Draw.new_empty_tri_mesh()
@@ -238,6 +378,7 @@ class CylinderObstacle(Obstacle):
                                   sides = 50,
                                   tri_mesh = self.tri_mesh,
                                   flat_end_caps=True)
+            Draw.finish_mesh(self.tri_mesh)
             self.tri_mesh.compute_vertex_normals()
             self.original_center = Vec3.from_array(self.tri_mesh.get_center())
         Draw.adjust_static_scene_object(self.tri_mesh, self.original_center)
@@ -255,3 +396,52 @@ class Collision:
         self.dist_to_collision = dist_to_collision
         self.point_of_impact = point_of_impact
         self.normal_at_poi = normal_at_poi
+
+# Convert an (N,3) array to a list of Vec3s, and a list of Vec3s to an array.
+def vec3s(array):
+    return [Vec3(*row) for row in np.asarray(array).tolist()]
+def rows(vec3_list):
+    return np.array([v.asarray() for v in vec3_list],
+                    dtype=np.float64).reshape(-1, 3)
+
+# Compare batch methods of each Obstacle type with scalar versions, for random
+# rays, plus the base class's default (row by row) batch methods.
+def unit_test():
+    rng = np.random.default_rng(1234567890)
+    count = 200
+    positions = rng.uniform(-12, 12, (count, 3))
+    forwards = util.normalize_rows(rng.normal(size=(count, 3)))
+    body_radius = rng.uniform(0.3, 0.7, count)
+    max_distance = body_radius * 20
+    obstacles = [EvertedSphereObstacle(10, Vec3(1, 2, 3)),
+                 PlaneObstacle(Vec3(1, 2, 3).normalize(), Vec3(0, -2, 0)),
+                 CylinderObstacle(3, Vec3(-1, -10, 1), Vec3(1, 10, -1))]
+    for obstacle in obstacles:
+        for cls in (type(obstacle), Obstacle):
+            def batch(method_name, *args):
+                return getattr(cls, method_name)(obstacle, *args)
+            (points, hit) = batch('batch_ray_intersection',
+                                  positions, forwards, body_radius)
+            hit_normals = batch('batch_normal_at_poi',
+                                points[hit], positions[hit])
+            nearest = batch('batch_nearest_point', positions)
+            fly_away = batch('batch_fly_away', positions, forwards,
+                             max_distance, body_radius)
+            sdf = batch('batch_signed_distance', positions)
+            assert np.any(hit) and np.any(fly_away)
+            h = 0
+            for (i, (p, f)) in enumerate(zip(vec3s(positions),
+                                             vec3s(forwards))):
+                r = body_radius[i]
+                poi = obstacle.ray_intersection(p, f, r)
+                assert hit[i] == (poi is not None)
+                if hit[i]:
+                    assert np.allclose(points[i], poi.asarray())
+                    assert np.allclose(hit_normals[h],
+                                       obstacle.normal_at_poi(poi, p).asarray())
+                    h += 1
+                assert np.allclose(nearest[i],
+                                   obstacle.nearest_point(p).asarray())
+                expected = obstacle.fly_away(p, f, max_distance[i], r)
+                assert np.allclose(fly_away[i], expected.asarray())
+                assert np.isclose(sdf[i], obstacle.signed_distance(p))
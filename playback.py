@@ -2,10 +2,15 @@
 #
 # playback.py -- new flock experiments
 #
-# Utility for visualizing flock simulation computed on c++ side.
-# Reads a .py file containing the results of a flock simulation in c++.
+# Utility for visualizing a recorded flock simulation. Reads a binary recording
+# file (see recording.py, as made by Flock.start_recording(), either raw or
+# quantized, see codec.py) which is memory mapped, so frames are read from disk
+# (and decoded) only as they are played. Also reads the
+# older format: a .py file containing the results of a flock simulation in c++,
+# as a list literal "boid_centers".
 #
 # Usage:
+#     python playback.py ~/Desktop/flock_recording.flock
 #     python playback.py ~/Desktop/boid_centers.py
 #
 # MIT License -- Copyright © 2024 Craig Reynolds
@@ -17,46 +22,100 @@ from Draw import Draw
 from flock import Flock
 from obstacle import EvertedSphereObstacle
 from obstacle import CylinderObstacle
-import Utilities as util
 import open3d as o3d
+import numpy as np
+import recording
 import time
 
 
-# Simple animated version:
+# Simple animated version. Takes a sequence of frames, each an (N,3) array (or
+# list of N xyz lists) of boid centers, as from Recording.positions (or from
+# QuantizedRecording.positions). Frames are shown by a recording.Player, which
+# reads them only as needed, at "rate" times real time, interpolated or not.
+# Keys: space pauses, "," and "." step back and forward a frame, "[" and "]"
+# halve and double rate, "R" reverses, "I" toggles interpolation.
 
-def draw(boid_centers):
-    time_step = 1/ 30  # This should be in the flock data file.
+def draw(boid_centers, time_step=1/30, rate=1, interpolate=False, start=0):
     flock = Flock()
     draw = Draw() ## ?? currently unused but should contain draw state
     Draw.start_visualizer(50, Vec3())
     flock.register_single_key_commands() # For Open3D visualizer GUI.
+    player = recording.Player(boid_centers, time_step, rate, interpolate)
+    player.seek(start)
+    register_playback_key_commands(player)
     Draw.clear_scene()
     add_obstacles_to_scene()
-    boid_meshes = add_boids_to_scene(boid_centers[0])
+    boid_balls = add_boids_to_scene(player.current())
     Draw.update_scene()
+    print('Begin playback')
+    shown = None
+    previous_time = time.perf_counter()
     while flock.still_running():
-        print('Begin playback')
-        step_index = 0
-        while flock.still_running() and (step_index < len(boid_centers)):
-            update_boids_in_scene(boid_centers[step_index], boid_meshes)
-            step_index += 1
-            time.sleep(time_step)
+        now = time.perf_counter()
+        if not flock.simulation_paused:
+            player.advance(now - previous_time)
+        previous_time = now
+        # Only update scene when playback time has changed (not when paused).
+        if shown != player.time:
+            update_boids_in_scene(player.current(), boid_balls)
+            shown = player.time
+        time.sleep(time_step)
     Draw.close_visualizer()
 
+# Bind keys for scrubbing, rate, and interpolation to a recording.Player.
+def register_playback_key_commands(player):
+    def key(character, action):
+        def callback(vis):
+            action()
+            print('frame', round(player.index, 2), 'rate', player.rate,
+                  'interpolate', player.interpolate)
+        Draw.register_key_callback(ord(character), callback)
+    key(',', lambda: player.scrub(-1))
+    key('.', lambda: player.scrub(1))
+    key('[', lambda: setattr(player, 'rate', player.rate / 2))
+    key(']', lambda: setattr(player, 'rate', player.rate * 2))
+    key('R', lambda: setattr(player, 'rate', -player.rate))
+    key('I', lambda: setattr(player, 'interpolate', not player.interpolate))
+
+# All boids drawn as balls in one TriangleMesh: a copy of a template sphere per
+# boid. Triangles and colors are made once. Each frame, vertices are rewritten
+# from the (N,3) array of boid centers in one NumPy operation, so a frame costs
+# one update_geometry() call (one upload to the GPU) however many boids.
+class BoidBalls:
+    """Single mesh of balls for all boids, moved by array assignment."""
+
+    def __init__(self, boid_count, radius=0.5, resolution=3):
+        template = o3d.geometry.TriangleMesh.create_sphere(radius, resolution)
+        self.template = np.asarray(template.vertices)
+        v = len(self.template)
+        triangles = (np.asarray(template.triangles)[None] +
+                     v * np.arange(boid_count)[:, None, None])
+        colors = np.repeat(np.random.uniform(0.4, 0.6, (boid_count, 3)), v,
+                           axis=0)
+        self.vertices = np.zeros((boid_count, v, 3))
+        self.tri_mesh = o3d.geometry.TriangleMesh()
+        self.tri_mesh.vertices = o3d.utility.Vector3dVector(
+            self.vertices.reshape(-1, 3))
+        self.tri_mesh.triangles = o3d.utility.Vector3iVector(
+            triangles.reshape(-1, 3))
+        self.tri_mesh.vertex_colors = o3d.utility.Vector3dVector(colors)
+
+    # Move balls to given (N,3) boid centers.
+    def update(self, boid_centers):
+        np.add(np.asarray(boid_centers, dtype=np.float64)[:, None, :],
+               self.template, out=self.vertices)
+        self.tri_mesh.vertices = o3d.utility.Vector3dVector(
+            self.vertices.reshape(-1, 3))
+
 def add_boids_to_scene(boid_centers_this_step):
-    boid_meshes = []
-    for xyz in boid_centers_this_step:
-        center = Vec3.from_array(xyz)
-        color = Vec3.from_array([util.frandom2(0.4, 0.6) for i in range(3)])
-        mesh = Draw.add_ball(0.5, center, color, shaded=False, reset_bounding_box=False)
-        boid_meshes.append(mesh)
-    return boid_meshes
-
-def update_boids_in_scene(boid_centers_this_step, boid_meshes):
-    assert len(boid_centers_this_step) == len(boid_meshes)
-    for i in range(len(boid_meshes)):
-        boid_meshes[i].translate(boid_centers_this_step[i], relative=False)
-        Draw.vis.update_geometry(boid_meshes[i])
+    boid_balls = BoidBalls(len(boid_centers_this_step))
+    boid_balls.update(boid_centers_this_step)
+    Draw.vis.add_geometry(boid_balls.tri_mesh, False)
+    return boid_balls
+
+def update_boids_in_scene(boid_centers_this_step, boid_balls):
+    boid_balls.update(boid_centers_this_step)
+    Draw.vis.update_geometry(boid_balls.tri_mesh)
 
 def add_obstacles_to_scene():
     # For now: draw the default "evoflock" obstacles.
@@ -163,11 +222,23 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Playback flock data file.')
     parser.add_argument('path', type=str, default=path, const=path, nargs='?',
                         help='pathname of flock data file.')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='playback speed relative to real time.')
+    parser.add_argument('--interpolate', action='store_true',
+                        help='blend between recorded frames.')
+    parser.add_argument('--start', type=int, default=0,
+                        help='index of first frame to show.')
     args = parser.parse_args()
     path = args.path
     
     if path == '':
         print('    Expecting a pathname on the command line.')
+    elif not path.endswith('.py'):
+        # Open binary recording file (without reading frames) and play it.
+        flock_recording = recording.open_recording(path)
+        draw(recording.frames_by_step(flock_recording.positions,
+                                      flock_recording.steps),
+             flock_recording.time_step, args.rate, args.interpolate, args.start)
     else:
         # Load data file from given pathname.
         # (Use method described at: https://stackoverflow.com/a/67692/1991373)
@@ -177,4 +248,5 @@ if __name__ == "__main__":
         spec.loader.exec_module(boid_centers)
 
         # Run playback.
-        draw(boid_centers.boid_centers)
+        draw(boid_centers.boid_centers, rate=args.rate,
+             interpolate=args.interpolate, start=args.start)
@@ -0,0 +1,550 @@
+#-------------------------------------------------------------------------------
+#
+# recording.py -- new flock experiments
+#
+# Binary recordings of flock simulations, for later playback (see playback.py).
+# A recording file is:
+#
+#     8 bytes    magic number b'FLOCKREC'
+#     4 bytes    length of header (little endian uint32)
+#     header     JSON text: boid count, fields per boid, time step, containment
+#                sphere, obstacles, ... padded with spaces so frame data starts
+#                at a multiple of 64 bytes
+#     frames     raw little endian float32 array, shape (frames, boids, width)
+#
+# Each frame holds one row per boid, the concatenation of that boid's fields,
+# in the order listed in the header: always "position" (3 floats), optionally
+# "forward" and "up" (3 each) and "speed" (1). When the header has
+# "frame_steps" (a StreamingRecorder which may drop frames) each frame is
+# preceded by its simulation step number (little endian uint32), so gaps are
+# known on playback (see frames_by_step()). The number of frames is not
+# stored, it is computed from file size, so a recording cut short (say by a
+# crash) is still readable up to its last complete frame.
+#
+# Recording reads a file with np.memmap, so opening even a huge recording is
+# instant, and only frames actually used are read from disk. Since frames are
+# all the same size, the offset of any frame is known, so seeking is O(1). For
+# a smaller, compressed file, see the quantized encoding in codec.py (which
+# ends with an index of frame offsets). open_recording() opens either kind.
+#
+# Player is a playback cursor over a recording's frames: seek to any frame or
+# time, scrub forward or backward, and play at any rate (including negative),
+# either skipping or interpolating between recorded frames.
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import os
+import json
+import math
+import time
+import queue
+import struct
+import tempfile
+import threading
+import numpy as np
+
+magic = b'FLOCKREC'
+version = 1
+alignment = 64
+
+# Number of floats per boid for each field which may be recorded.
+field_widths = {'position': 3, 'forward': 3, 'up': 3, 'speed': 1}
+
+# NumPy dtype of one frame with its step number (see "frame_steps" above).
+def step_frame_dtype(boid_count, width):
+    return np.dtype([('step', '<u4'), ('boids', '<f4', (boid_count, width))])
+
+# Write header (a map, see Recorder.header()) to an open binary file. Returns
+# byte offset of frame data.
+def write_header(file, header):
+    text = json.dumps(header).encode()
+    size = len(magic) + 4 + len(text)
+    text += b' ' * (-size % alignment)
+    file.write(magic + struct.pack('<I', len(text)) + text)
+    return len(magic) + 4 + len(text)
+
+# Read header from an open binary file. Returns header map and byte offset of
+# frame data.
+def read_header(file):
+    assert file.read(len(magic)) == magic, 'not a flock recording'
+    (length,) = struct.unpack('<I', file.read(4))
+    header = json.loads(file.read(length))
+    return (header, len(magic) + 4 + length)
+
+class Recorder:
+    """Writes frames of flock state to a binary recording file."""
+
+    # Open a new recording file for a flock of boid_count boids. "fields" lists
+    # per-boid state to record (see field_widths), position is always first.
+    # Other header info: simulation time step, containment sphere, obstacle
+    # descriptions, and any other JSON-compatible values.
+    def __init__(self, path, boid_count, fields=('position',), time_step=1/30,
+                 sphere_radius=50, sphere_center=(0, 0, 0), obstacles=(),
+                 **other_header_info):
+        self.path = path
+        self.boid_count = boid_count
+        self.fields = ['position'] + [f for f in fields if f != 'position']
+        assert all(f in field_widths for f in self.fields), self.fields
+        self.width = sum(field_widths[f] for f in self.fields)
+        self.frame_count = 0
+        self.frame = np.empty((boid_count, self.width), dtype='<f4')
+        self.file = open(path, 'wb')
+        write_header(self.file, self.header(time_step, sphere_radius,
+                                            sphere_center, obstacles,
+                                            other_header_info))
+
+    # Header map for recording.
+    def header(self, time_step, sphere_radius, sphere_center, obstacles, other):
+        return dict({'format': 'flock recording',
+                     'version': version,
+                     'boid_count': self.boid_count,
+                     'fields': [[f, field_widths[f]] for f in self.fields],
+                     'time_step': time_step,
+                     'sphere_radius': sphere_radius,
+                     'sphere_center': list(sphere_center),
+                     'obstacles': list(obstacles)}, **other)
+
+    # Add one frame, given a map from field name to (N,3) or (N,) array.
+    def write_frame(self, arrays):
+        self.file.write(self.pack_frame(arrays, self.frame).tobytes())
+        self.frame_count += 1
+
+    # Copy given arrays into an (N,width) float32 frame array.
+    def pack_frame(self, arrays, frame):
+        column = 0
+        for f in self.fields:
+            width = field_widths[f]
+            frame[:, column : column + width] = np.reshape(arrays[f],
+                                                           (-1, width))
+            column += width
+        return frame
+
+    # Add a frame of the current state of a Flock's boids.
+    def record(self, flock):
+        self.write_frame(flock.boid_arrays())
+
+    # Finish recording.
+    def close(self):
+        self.file.close()
+
+    # Map of statistics (see StreamingRecorder.stats()).
+    def stats(self):
+        return {'frames_recorded': self.frame_count}
+
+class StreamingRecorder(Recorder):
+    """Recorder which writes to disk on a background thread."""
+
+    # Like Recorder, plus: frames are copied into a ring of buffer_count
+    # preallocated buffers, each holding chunk_frames frames. A full buffer is
+    # handed to a writer thread, which writes it with one large sequential
+    # write then returns it to the pool. If no buffer is free (the disk is not
+    # keeping up) "when_full" says what to do: 'block' waits for the writer
+    # (backpressure, slowing the simulation) while 'drop' discards the frame
+    # (leaving a gap in the recording, so each frame is recorded with its step
+    # number). Either is counted, see stats(). An error on the writer thread
+    # (say disk full) is raised by the next write_frame() or close().
+    def __init__(self, path, boid_count, fields=('position',),
+                 chunk_frames=64, buffer_count=4, when_full='block', **kwargs):
+        assert when_full in ('block', 'drop')
+        self.frame_steps = when_full == 'drop'
+        if self.frame_steps:
+            kwargs['frame_steps'] = True
+        super().__init__(path, boid_count, fields, **kwargs)
+        self.when_full = when_full
+        if self.frame_steps:
+            dtype = step_frame_dtype(boid_count, self.width)
+            self.buffers = [np.empty(chunk_frames, dtype)
+                            for i in range(buffer_count)]
+        else:
+            self.buffers = [np.empty((chunk_frames, boid_count, self.width),
+                                     dtype='<f4') for i in range(buffer_count)]
+        self.free = queue.Queue()   # Indices of buffers ready to be filled.
+        self.full = queue.Queue()   # (index, frame count) to be written.
+        for i in range(buffer_count):
+            self.free.put(i)
+        self.current = self.free.get()
+        self.filled = 0             # Frames in current buffer.
+        self.step = 0               # Frames given to write_frame() so far.
+        self.error = None           # Exception raised on writer thread.
+        # Statistics.
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_blocked = 0
+        self.blocked_seconds = 0
+        self.chunks_written = 0
+        self.max_queue_depth = 0
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    # Copy one frame into current buffer, handing it to writer thread if full.
+    # Called on the simulation thread.
+    def write_frame(self, arrays):
+        self.check_writer()
+        self.step += 1
+        if self.current is None and not self.next_buffer():
+            self.frames_dropped += 1
+            return
+        buffer = self.buffers[self.current]
+        if self.frame_steps:
+            buffer['step'][self.filled] = self.step - 1
+            buffer = buffer['boids']
+        self.pack_frame(arrays, buffer[self.filled])
+        self.filled += 1
+        self.frame_count += 1
+        if self.filled == len(self.buffers[self.current]):
+            self.send_current_buffer()
+
+    # Hand current buffer to writer thread. The next frame gets a free one.
+    def send_current_buffer(self):
+        self.full.put((self.current, self.filled))
+        self.max_queue_depth = max(self.max_queue_depth, self.full.qsize())
+        self.current = None
+        self.filled = 0
+
+    # Get a free buffer to fill, waiting for one if when_full is 'block'.
+    # Returns False if none is free (when_full is 'drop'). While waiting,
+    # checks that the writer thread is still working.
+    def next_buffer(self):
+        if self.current is None:
+            try:
+                self.current = self.free.get_nowait()
+            except queue.Empty:
+                if self.when_full == 'drop':
+                    return False
+                start = time.perf_counter()
+                while self.current is None:
+                    self.check_writer()
+                    try:
+                        self.current = self.free.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                self.frames_blocked += 1
+                self.blocked_seconds += time.perf_counter() - start
+        return True
+
+    # On the simulation thread: raise any error from the writer thread.
+    def check_writer(self):
+        if self.error is not None:
+            raise self.error
+        assert self.writer.is_alive(), 'recording writer thread has stopped'
+
+    # Writer thread: write full buffers in order until sent None. After an
+    # error, saved for check_writer(), later buffers are not written. Either
+    # way each buffer goes back to the pool, so write_frame() never waits
+    # forever for one.
+    def write_chunks(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            (index, count) = item
+            try:
+                if self.error is None:
+                    self.write_chunk(self.buffers[index][:count])
+                    self.chunks_written += 1
+                    self.frames_written += count
+            except Exception as error:
+                self.error = error
+            finally:
+                self.free.put(index)
+
+    # Write one chunk of frames to file.
+    def write_chunk(self, frames):
+        self.file.write(memoryview(frames).cast('B'))
+
+    # Write remaining frames, stop writer thread, close file. Then raise any
+    # error from the writer thread.
+    def close(self):
+        if self.writer.is_alive():
+            if self.current is not None and self.filled > 0:
+                self.send_current_buffer()
+            self.full.put(None)
+            self.writer.join()
+        super().close()
+        if self.error is not None:
+            raise self.error
+
+    # Map of statistics: frames recorded (written to file), dropped, and
+    # blocked (waited for a free buffer) with total seconds blocked, chunks
+    # written, and maximum number of chunks waiting for the writer.
+    def stats(self):
+        return {'frames_recorded': self.frames_written,
+                'frames_dropped': self.frames_dropped,
+                'frames_blocked': self.frames_blocked,
+                'blocked_seconds': self.blocked_seconds,
+                'chunks_written': self.chunks_written,
+                'max_queue_depth': self.max_queue_depth}
+
+class Recording:
+    """Read-only, memory-mapped view of a recording file."""
+
+    # Open recording file, map its frames into memory (without reading them).
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            (self.header, self.data_offset) = read_header(file)
+        self.boid_count = self.header['boid_count']
+        self.fields = [f for (f, w) in self.header['fields']]
+        self.width = sum(w for (f, w) in self.header['fields'])
+        self.time_step = self.header['time_step']
+        frame_steps = self.header.get('frame_steps', False)
+        frame_bytes = 4 * self.boid_count * self.width
+        if frame_steps:
+            frame_bytes += 4
+        self.frame_count = ((os.path.getsize(path) - self.data_offset) //
+                            frame_bytes if frame_bytes else 0)
+        if frame_steps:
+            frames = np.memmap(path, mode='r', offset=self.data_offset,
+                               dtype=step_frame_dtype(self.boid_count,
+                                                      self.width),
+                               shape=(self.frame_count,))
+            self.frames = frames['boids']
+            self.steps = frames['step']
+        else:
+            self.frames = np.memmap(path, dtype='<f4', mode='r',
+                                    offset=self.data_offset,
+                                    shape=(self.frame_count, self.boid_count,
+                                           self.width))
+            self.steps = np.arange(self.frame_count)
+
+    def __len__(self):
+        return self.frame_count
+
+    # View of a field for all frames: (frames, N, 3) or for speed (frames, N).
+    # Like any slice of the memmap, reading it only touches the pages used.
+    def field(self, name):
+        column = 0
+        for (f, width) in self.header['fields']:
+            if f == name:
+                view = self.frames[:, :, column : column + width]
+                return view[:, :, 0] if width == 1 else view
+            column += width
+        assert False, 'field not recorded: ' + name
+
+    # (frames, N, 3) positions of all boids on all frames.
+    @property
+    def positions(self):
+        return self.field('position')
+
+    # Map from field name to array for one frame.
+    def frame(self, index):
+        return {f: self.field(f)[index] for f in self.fields}
+
+# Open a recording file of either encoding: a Recording for raw float32 frames
+# or a codec.QuantizedRecording. Both have header, fields, time_step, len(),
+# frame(index), field(name), positions, and steps (simulation step number of
+# each frame).
+def open_recording(path):
+    with open(path, 'rb') as file:
+        (header, data_offset) = read_header(file)
+    if header.get('encoding') == 'quantized':
+        import codec
+        return codec.QuantizedRecording(path)
+    return Recording(path)
+
+# Given a recording's "frames" (eg its positions) and the simulation step of
+# each, a sequence indexed by step: for steps in a gap (frames dropped while
+# recording) the last frame before it. So playback keeps the simulation's time
+# base. When there are no gaps, returns "frames".
+def frames_by_step(frames, steps):
+    if len(steps) == 0 or steps[-1] == len(steps) - 1:
+        return frames
+    return FramesByStep(frames, steps)
+
+class FramesByStep:
+    """Sequence of recorded frames indexed by simulation step (with gaps)."""
+
+    def __init__(self, frames, steps):
+        self.frames = frames
+        self.steps = np.asarray(steps)
+
+    def __len__(self):
+        return int(self.steps[-1]) + 1
+
+    def __getitem__(self, step):
+        assert 0 <= step < len(self)
+        return self.frames[np.searchsorted(self.steps, step, 'right') - 1]
+
+class Player:
+    """Playback cursor over a sequence of frames, for seeking and scrubbing."""
+
+    # "frames" is any sequence of frames (arrays of the same shape), such as
+    # Recording.positions, which is indexed only as frames are shown. Frames
+    # are time_step seconds apart. Playback speed is "rate" (2 is twice as
+    # fast, -1 is backward). When "interpolate" the current frame is blended
+    # from the two recorded frames around the current time, otherwise it is
+    # the nearest one (so fast rates skip frames). When "loop", playback wraps
+    # around at either end, otherwise it stops there.
+    def __init__(self, frames, time_step=1/30, rate=1, interpolate=False,
+                 loop=True):
+        assert len(frames) > 0
+        self.frames = frames
+        self.time_step = time_step
+        self.rate = rate
+        self.interpolate = interpolate
+        self.loop = loop
+        self.time = 0           # Seconds from first frame.
+
+    def __len__(self):
+        return len(self.frames)
+
+    # Current position as a (possibly fractional) frame index.
+    @property
+    def index(self):
+        return self.time / self.time_step
+
+    # Go to a given time in seconds, wrapped (if loop) or clamped to the
+    # recording.
+    def seek_time(self, seconds):
+        if self.loop:
+            self.time = seconds % (len(self) * self.time_step)
+        else:
+            self.time = min(max(0, seconds), (len(self) - 1) * self.time_step)
+
+    # Go to a given (possibly fractional) frame index.
+    def seek(self, index):
+        self.seek_time(index * self.time_step)
+
+    # Move forward (or for negative, backward) by a number of frames.
+    def scrub(self, frames):
+        self.seek(self.index + frames)
+
+    # Advance playback by "seconds" of real time, scaled by rate.
+    def advance(self, seconds):
+        self.seek_time(self.time + seconds * self.rate)
+
+    # The frame at the current time (see "interpolate" above).
+    def current(self):
+        if not self.interpolate:
+            nearest = math.floor(self.index + 0.5) % len(self)
+            return np.asarray(self.frames[nearest])
+        i = math.floor(self.index)
+        f = self.index - i
+        a = np.asarray(self.frames[i], dtype=np.float64)
+        if f == 0:
+            return a
+        b = np.asarray(self.frames[(i + 1) % len(self) if self.loop else
+                                   min(i + 1, len(self) - 1)],
+                       dtype=np.float64)
+        return a + (b - a) * f
+
+def unit_test():
+    rng = np.random.default_rng(1234567890)
+    frames = [{'position': rng.uniform(-50, 50, (10, 3)),
+               'forward': rng.normal(size=(10, 3)),
+               'speed': rng.uniform(0, 20, 10)} for i in range(5)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.flock')
+        recorder = Recorder(path, 10, ['speed', 'forward'], time_step=0.1,
+                            seed=123)
+        for f in frames[:4]:
+            recorder.write_frame(f)
+        recorder.file.flush()
+        # Readable while still recording: sees complete frames only.
+        recorder.file.write(b'\0' * 20)
+        recorder.file.flush()
+        recording = Recording(path)
+        assert len(recording) == 4
+        recorder.close()
+        assert recording.fields == ['position', 'speed', 'forward']
+        assert recording.header['seed'] == 123 and recording.time_step == 0.1
+        assert recording.data_offset % alignment == 0
+        assert recording.positions.shape == (4, 10, 3)
+        assert np.array_equal(recording.positions[2],
+                              frames[2]['position'].astype(np.float32))
+        assert np.array_equal(recording.frame(3)['speed'],
+                              frames[3]['speed'].astype(np.float32))
+        assert np.allclose(recording.field('forward')[1], frames[1]['forward'])
+        del recording  # Release memory map before directory is removed.
+        # Streaming recorder writes the same file as Recorder.
+        stream_path = os.path.join(directory, 'stream.flock')
+        streaming = StreamingRecorder(stream_path, 10, ['speed', 'forward'],
+                                      chunk_frames=2, buffer_count=2,
+                                      time_step=0.1, seed=123)
+        for f in frames:
+            streaming.write_frame(f)
+        streaming.close()
+        assert streaming.stats()['chunks_written'] == 3
+        recorder = Recorder(path, 10, ['speed', 'forward'], time_step=0.1,
+                            seed=123)
+        for f in frames:
+            recorder.write_frame(f)
+        recorder.close()
+        with open(path, 'rb') as a, open(stream_path, 'rb') as b:
+            assert a.read() == b.read()
+        # When writer is stalled, frames are dropped once buffers are full.
+        streaming = StreamingRecorder(stream_path, 10, chunk_frames=1,
+                                      buffer_count=2, when_full='drop')
+        unstall = threading.Event()
+        def stalled_write(frames, write=streaming.write_chunk):
+            unstall.wait()
+            write(frames)
+        streaming.write_chunk = stalled_write
+        for f in frames:
+            streaming.write_frame(f)
+        unstall.set()
+        # Once the writer catches up, frames are recorded again, each with its
+        # step number, so gaps are filled on playback.
+        while streaming.chunks_written < 2:
+            time.sleep(0.001)
+        streaming.write_frame(frames[0])
+        streaming.close()
+        stats = streaming.stats()
+        assert stats['frames_recorded'] == 3 and stats['frames_dropped'] == 3
+        dropped = Recording(stream_path)
+        assert dropped.steps.tolist() == [0, 1, 5]
+        assert np.array_equal(dropped.positions[2],
+                              frames[0]['position'].astype(np.float32))
+        by_step = frames_by_step(dropped.positions, dropped.steps)
+        assert len(by_step) == 6
+        assert [by_step[s][0, 0] for s in (1, 3, 5)] == [
+            dropped.positions[i][0, 0] for i in (1, 1, 2)]
+        del dropped, by_step
+        # Errors on the writer thread are raised on the simulation thread.
+        failing = StreamingRecorder(stream_path, 10, chunk_frames=1,
+                                    buffer_count=2)
+        def failed_write(frames):
+            raise OSError('disk full')
+        failing.write_chunk = failed_write
+        errors = 0
+        for f in frames:
+            try:
+                failing.write_frame(f)
+            except OSError:
+                errors += 1
+        try:
+            failing.close()
+        except OSError:
+            errors += 1
+        assert errors > 0 and failing.stats()['frames_recorded'] == 0
+    # Player only reads frames it shows, wherever it seeks.
+    class CountedFrames(list):
+        reads = 0
+        def __getitem__(self, index):
+            CountedFrames.reads += 1
+            return list.__getitem__(self, index)
+    frames = CountedFrames([np.full(3, float(i)) for i in range(10)])
+    player = Player(frames, time_step=0.5)
+    player.seek(7)
+    assert player.current()[0] == 7 and CountedFrames.reads == 1
+    player.scrub(-3)
+    assert player.current()[0] == 4 and player.time == 2
+    player.rate = -4
+    player.advance(0.625)  # Back 5 frames, wraps from 4 to 9.
+    assert player.current()[0] == 9
+    player.interpolate = True
+    player.seek(2.25)
+    assert player.current()[0] == 2.25
+    player.seek(9.5)       # Blends last frame with first.
+    assert player.current()[0] == 4.5
+    player.interpolate = False
+    player.rate = 3
+    player.advance(0.5)    # Skips to nearest frame: 9.5 + 3 wraps to 2.5.
+    assert player.index == 2.5 and player.current()[0] == 3
+    player.loop = False
+    player.seek(20)
+    assert player.index == 9 and player.current()[0] == 9
+    player.scrub(-100)
+    assert player.index == 0
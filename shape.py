@@ -10,9 +10,10 @@
 #-------------------------------------------------------------------------------
 
 import math
+import numpy as np
 from Vec3 import Vec3
+import Utilities as util
 #from Draw import Draw
-#import Utilities as util
 
 # Returns the point of intersection of a ray (half-line) and sphere. Used
 # for finding intersection of an Agent's "forward" axis with a spherical
@@ -120,6 +121,92 @@ def distance_between_lines(origin1, tangent1, origin2, tangent2):
         distance = abs(n.dot(rd)) / n.length()
     return distance
 
+# Batch versions of the functions above: for many rays at once, given as (N,3)
+# arrays of origins and unit tangents, one row per ray (eg one per Boid). Shape
+# parameters may be single values or (N,) arrays (eg radius plus per-boid body
+# radius). Intersection functions return an (N,3) array of points and an (N,)
+# boolean "hit" mask. Rows for misses (where the scalar versions return None)
+# have hit False and points filled with NaN.
+
+# Batch version of ray_sphere_intersection().
+def batch_ray_sphere_intersection(ray_origins, ray_tangents,
+                                  sphere_radius, sphere_center):
+    o = ray_origins
+    u = ray_tangents
+    oc = o - np.asarray(sphere_center, dtype=np.float64)
+    r = np.asarray(sphere_radius, dtype=np.float64)
+    u_dot_oc = util.dot_rows(u, oc)
+    delta = (u_dot_oc ** 2) - ((util.length_rows(oc) ** 2) - r ** 2)
+    line_hit = delta >= 0
+    sqrt_delta = np.sqrt(np.where(line_hit, delta, 0))
+    d1 = -u_dot_oc + sqrt_delta
+    d2 = -u_dot_oc - sqrt_delta
+    return select_ray_distance(o, u, line_hit, d1, d2)
+
+# Batch version of ray_plane_intersection().
+def batch_ray_plane_intersection(ray_origins, ray_tangents,
+                                 plane_origin, plane_normal):
+    plane_origin = np.asarray(plane_origin, dtype=np.float64)
+    plane_normal = np.asarray(plane_normal, dtype=np.float64)
+    numerator = util.dot_rows(plane_origin - ray_origins, plane_normal)
+    denominator = util.dot_rows(ray_tangents, plane_normal)
+    nonparallel = denominator != 0
+    d = numerator / np.where(nonparallel, denominator, 1)
+    hit = nonparallel & (d > 0)
+    return ray_points(ray_origins, ray_tangents, d, hit)
+
+# Batch version of ray_cylinder_intersection(). (Also infinitely long.)
+def batch_ray_cylinder_intersection(ray_endpoints, ray_tangents,
+                                    cyl_endpoint, cyl_tangent,
+                                    cyl_radius, cyl_length):
+    a = np.asarray(cyl_tangent, dtype=np.float64)
+    r = np.asarray(cyl_radius, dtype=np.float64)
+    o = ray_endpoints
+    n = ray_tangents
+    b = np.asarray(cyl_endpoint, dtype=np.float64) - o
+    na = util.cross_rows(n, a)
+    nana = util.dot_rows(na, na)
+    radicand = (nana * r ** 2) - util.dot_rows(b, na) ** 2
+    # Ray parallel to axis (nana == 0) never intersects an infinite cylinder.
+    line_hit = (radicand >= 0) & (nana > 0)
+    radical = np.sqrt(np.where(line_hit, radicand, 0))
+    naba = util.dot_rows(na, util.cross_rows(b, a))
+    nana = np.where(line_hit, nana, 1)
+    d1 = (naba + radical) / nana
+    d2 = (naba - radical) / nana
+    return select_ray_distance(o, n, line_hit, d1, d2)
+
+# Batch version of distance_between_lines(). The second line may be a single
+# line (eg a cylinder's axis) given as a 3 element origin and tangent.
+def batch_distance_between_lines(origins1, tangents1, origin2, tangent2):
+    origin2 = np.asarray(origin2, dtype=np.float64)
+    tangent2 = np.asarray(tangent2, dtype=np.float64)
+    rd = origins1 - origin2
+    parallel = util.within_epsilon(np.abs(util.dot_rows(tangents1, tangent2)), 1)
+    # Distance between parallel lines.
+    q = util.cross_rows(rd, tangents1)
+    parallel_distance = np.sqrt(util.dot_rows(q, q) /
+                                util.length_rows(tangent2) ** 2)
+    # Distance between skew lines.
+    n = util.cross_rows(tangents1, tangent2)
+    n_length = util.length_rows(n)
+    skew_distance = (np.abs(util.dot_rows(n, rd)) /
+                     np.where(parallel, 1, n_length))
+    return np.where(parallel, parallel_distance, skew_distance)
+
+# Given distances d1 and d2 along each ray to the two intersections of the line
+# containing it, select the one on the ray, or if both, the one nearer origin.
+def select_ray_distance(origins, tangents, line_hit, d1, d2):
+    use_d2 = line_hit & (d2 >= 0) & (d2 < d1)
+    hit = (line_hit & (d1 >= 0)) | use_d2
+    return ray_points(origins, tangents, np.where(use_d2, d2, d1), hit)
+
+# Points at distance d along each ray, NaN where not hit.
+def ray_points(origins, tangents, d, hit):
+    points = origins + tangents * d[:, None]
+    points[~hit] = np.nan
+    return (points, hit)
+
 def unit_test():
     zzz = Vec3()
     ooo = Vec3(1, 1, 1)
@@ -185,3 +272,33 @@ def unit_test():
     # https://onlinemschool.com/math/assistance/cartesian_coordinate/p_line/
     assert (math.sqrt(2) / math.sqrt(3) ==
             distance_between_lines(zzz, ddd, ozo, Vec3(-1, 0, 1).normalize()))
+
+
+    # Batch versions agree with scalar versions, for random rays.
+    rng = np.random.default_rng(1234567890)
+    origins = rng.uniform(-2, 2, (200, 3))
+    tangents = util.normalize_rows(rng.normal(size=(200, 3)))
+    tangents[0] = [0, 1, 0]  # Parallel to cylinder axis below.
+    cyl_tangent = Vec3(0, 1, 0)
+    def rows_as_vec3s(array):
+        return [Vec3.from_array(row) for row in array]
+    def check(batch, scalar):
+        (points, hit) = batch
+        for (point, h, expected) in zip(points, hit, scalar):
+            assert h == (expected is not None)
+            assert (not h) or np.allclose(point, expected.asarray())
+    rays = list(zip(rows_as_vec3s(origins), rows_as_vec3s(tangents)))
+    check(batch_ray_sphere_intersection(origins, tangents, 1.5, [0, 0.5, 0]),
+          [ray_sphere_intersection(o, t, 1.5, Vec3(0, 0.5, 0))
+           for (o, t) in rays])
+    check(batch_ray_plane_intersection(origins, tangents, [0, 1, 0], ddd.asarray()),
+          [ray_plane_intersection(o, t, zoz, ddd) for (o, t) in rays])
+    check(batch_ray_cylinder_intersection(origins, tangents, [0, -1, 0.5],
+                                          cyl_tangent.asarray(), 1, 2),
+          [ray_cylinder_intersection(o, t, Vec3(0, -1, 0.5), cyl_tangent, 1, 2)
+           if not t.is_parallel(cyl_tangent) else None
+           for (o, t) in rays])
+    assert np.allclose(batch_distance_between_lines(origins, tangents,
+                                                    [1, 0, 0], [0, 1, 0]),
+                       [distance_between_lines(o, t, ozz, zoz)
+                        for (o, t) in rays])
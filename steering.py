@@ -0,0 +1,121 @@
+#-------------------------------------------------------------------------------
+#
+# steering.py -- new flock experiments
+#
+# Batch versions of the Boid flocking behaviors: separation, alignment, and
+# cohesion. Rather than a Python loop over one boid's neighbors, these take an
+# (N,3) array of boid positions, an (N,3) array of forward vectors, and an
+# (N,k) matrix of neighbor indices into those arrays, then return an (N,3)
+# array of steering vectors, one row per boid. Results match the three vectors
+# returned by the scalar method Boid.steer_to_separate_align_cohere() up to
+# round-off.
+#
+# Tuning parameters (max_dist, exponent, angle, weight) may be scalars, or (N,)
+# arrays of per-boid values (like Boid.max_dist_separate, etc.).
+#
+# MIT License -- Copyright © 2024 Craig Reynolds
+#
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import Utilities as util
+
+# Geometry shared by the three behaviors: for each boid and each neighbor, the
+# (N,k,3) offset from neighbor to boid, its (N,k) length, and the (N,k)
+# projection of the direction to the neighbor onto the boid's forward axis.
+def neighbor_geometry(position, forward, neighbors):
+    offset = position[:, None, :] - position[neighbors]
+    dist = util.length_rows(offset)
+    projection = -util.dot_rows(offset / dist[..., None], forward[:, None, :])
+    return (offset, dist, projection)
+
+# (N,k,1) weight of each neighbor: falls off with distance, and is reduced for
+# neighbors outside the boid's field of view (see Boid.angle_weight()).
+def neighbor_weights(geometry, max_dist, exponent, angle):
+    (offset, dist, projection) = geometry
+    (max_dist, exponent, angle) = [per_boid(x) for x in (max_dist, exponent,
+                                                         angle)]
+    weight = 1 / (dist ** exponent)
+    weight *= 1 - util.unit_sigmoid_on_01_array(dist / max_dist)
+    weight *= np.where(projection > angle, 1, 0.1)
+    return weight[..., None]
+
+# Steering to move away from neighbors.
+def steer_to_separate(position, forward, neighbors,
+                      max_dist, exponent, angle, weight=1, geometry=None):
+    geometry = geometry or neighbor_geometry(position, forward, neighbors)
+    w = neighbor_weights(geometry, max_dist, exponent, angle)
+    direction = (geometry[0] * w).sum(axis=1)
+    return scale_rows(util.normalize_rows_or_0(direction), weight)
+
+# Steering to align heading with neighbors.
+def steer_to_align(position, forward, neighbors,
+                   max_dist, exponent, angle, weight=1, geometry=None):
+    geometry = geometry or neighbor_geometry(position, forward, neighbors)
+    w = neighbor_weights(geometry, max_dist, exponent, angle)
+    heading_offset = forward[neighbors] - forward[:, None, :]
+    direction = (util.normalize_rows_or_0(heading_offset) * w).sum(axis=1)
+    return scale_rows(util.normalize_rows_or_0(direction), weight)
+
+# Steering toward weighted center of neighbors.
+def steer_to_cohere(position, forward, neighbors,
+                    max_dist, exponent, angle, weight=1, geometry=None):
+    geometry = geometry or neighbor_geometry(position, forward, neighbors)
+    w = neighbor_weights(geometry, max_dist, exponent, angle)
+    total_weight = w.sum(axis=1)
+    center = (position[neighbors] * w).sum(axis=1)
+    positive = total_weight > 0
+    center = np.where(positive, center / np.where(positive, total_weight, 1),
+                      center)
+    return scale_rows(util.normalize_rows_or_0(center - position), weight)
+
+# Given a scalar or (N,) array, return something which broadcasts over (N,k).
+def per_boid(x):
+    x = np.asarray(x, dtype=np.float64)
+    return x[:, None] if x.ndim == 1 else x
+
+# Multiply each row of an (N,3) array by a scalar or (N,) array.
+def scale_rows(a, scale):
+    scale = np.asarray(scale, dtype=np.float64)
+    return a * (scale[:, None] if scale.ndim == 1 else scale)
+
+# Compare batch behaviors with Boid.steer_to_separate_align_cohere() for a
+# random flock, with per-boid parameters.
+def unit_test():
+    from Boid import Boid
+    from Vec3 import Vec3
+    rng = np.random.default_rng(1234567890)
+    count = 50
+    position = rng.uniform(-10, 10, (count, 3))
+    forward = util.normalize_rows(rng.normal(size=(count, 3)))
+    forward[1] = forward[0]  # Case of zero heading offset.
+    order = np.argsort(((position[:, None] - position) ** 2).sum(axis=2), 1)
+    neighbors = order[:, 1:8]
+    boids = [Boid() for i in range(count)]
+    for (i, b) in enumerate(boids):
+        b.ls.p = Vec3.from_array(position[i])
+        b.ls.k = Vec3.from_array(forward[i])
+        b.max_dist_separate = rng.uniform(2, 10)
+        b.exponent_align = rng.choice([1, 2])
+        b.angle_cohere = rng.uniform(-1, 1)
+    def per_boid_array(name):
+        return np.array([getattr(b, name) for b in boids])
+    scalar = [b.steer_to_separate_align_cohere([boids[j] for j in n])
+              for (b, n) in zip(boids, neighbors)]
+    for (k, (kernel, name)) in enumerate([(steer_to_separate, 'separate'),
+                                          (steer_to_align, 'align'),
+                                          (steer_to_cohere, 'cohere')]):
+        batch = kernel(position, forward, neighbors,
+                       per_boid_array('max_dist_' + name),
+                       per_boid_array('exponent_' + name),
+                       per_boid_array('angle_' + name))
+        weighted = kernel(position, forward, neighbors,
+                          per_boid_array('max_dist_' + name),
+                          per_boid_array('exponent_' + name),
+                          per_boid_array('angle_' + name),
+                          per_boid_array('weight_' + name))
+        for (i, b) in enumerate(boids):
+            expected = scalar[i][k].asarray()
+            assert np.allclose(batch[i], expected, atol=1e-12)
+            assert np.allclose(weighted[i],
+                               expected * getattr(b, 'weight_' + name))